@@ -19,5 +19,7 @@ if sys.version_info[:2] < (2, 7):
 del sys
 
 from vissim_objs import *
+from inpx_diff import *
 from osm_to_vissim import *
+from osm_tiles import *
 from vissim_to_geojson import *
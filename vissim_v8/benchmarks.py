@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+""" Benchmarks
+    Times the main operations of the object model on synthetic grid and
+    corridor networks built on default/default.inpx, and records the peak
+    memory of each run. Results are written as JSON so that a later run can
+    be compared against them (run from the repository root):
+        python -m vissim_v8.benchmarks --sizes 100,1000 --output base.json
+        python -m vissim_v8.benchmarks --sizes 100,1000 --compare base.json
+    The default sizes stop at 10000 links; pass --sizes ...,100000 for the
+    full range (a 100000 link grid needs several GB of memory).
+    Each network is benchmarked in a forked process so that memory peaks
+    and caches do not carry over from one network to the next.
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import vissim_v8 as vissim
+
+NETWORKS = ('corridor', 'grid')
+SIZES = (100, 1000, 10000)
+# Calls made by the per-call operations
+SAMPLE = 100
+# Runs faster than this are too noisy to compare
+NOISE = 0.005
+
+
+def corridor(v, links):
+    """ A straight road of two-lane links joined end to end by connectors.
+        Input: Vissim, number of links
+        Output: list of entry link numbers
+    """
+    nums = v.Links.createLinks([{'point3D': [(i * 100.0, 0, 0),
+                                             ((i + 1) * 100.0, 0, 0)],
+                                 'lane': ['3.5', '3.5']}
+                                for i in range(links)])
+    v.Links.createConnectors([{'fromLink': a, 'fromLane': 1, 'toLink': b,
+                               'toLane': 1, 'lanes': 2}
+                              for a, b in zip(nums[:-1], nums[1:])])
+    return nums[:1]
+
+
+def grid(v, links):
+    """ A square grid of two-lane eastbound and northbound links between
+        intersections, with a through and a turning connector for every
+        approach.
+        Input: Vissim, number of links (rounded to fill the grid)
+        Output: list of entry link numbers
+    """
+    k = max(2, int(math.ceil((1 + math.sqrt(1 + 2 * links)) / 2)))
+    records = []
+    keys = []
+    for row in range(k):
+        for col in range(k - 1):
+            # Eastbound along rows, northbound along columns
+            records.append({'point3D': [(col * 100.0, row * 100.0, 0),
+                                        ((col + 1) * 100.0, row * 100.0, 0)],
+                            'lane': ['3.5', '3.5']})
+            keys.append(('e', row, col))
+            records.append({'point3D': [(row * 100.0, col * 100.0, 0),
+                                        (row * 100.0, (col + 1) * 100.0, 0)],
+                            'lane': ['3.5', '3.5']})
+            keys.append(('n', row, col))
+    num = dict(zip(keys, v.Links.createLinks(records)))
+    connectors = []
+    for (way, row, col), link in num.items():
+        ahead = num.get((way, row, col + 1))
+        if ahead is not None:
+            connectors.append({'fromLink': link, 'fromLane': 1,
+                               'toLink': ahead, 'toLane': 1, 'lanes': 2})
+        # Turn in to the crossing link that starts where this one ends
+        if way == 'e':
+            turn = num.get(('n', col + 1, row))
+        else:
+            turn = num.get(('e', col + 1, row))
+        if turn is not None:
+            connectors.append({'fromLink': link, 'fromLane': 1,
+                               'toLink': turn, 'toLane': 1, 'lanes': 1})
+    v.Links.createConnectors(connectors)
+    return [num[('e', row, 0)] for row in range(k)] + \
+        [num[('n', col, 0)] for col in range(k)]
+
+
+def _peak():
+    """ Peak resident memory of this process in kilobytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _run(results, network, links, operation, function, calls=1):
+    before = _peak()
+    start = time.time()
+    function()
+    seconds = time.time() - start
+    after = _peak()
+    results.append({'network': network, 'links': links,
+                    'operation': operation, 'calls': calls,
+                    'seconds': seconds, 'peakKb': after,
+                    'growthKb': after - before})
+
+
+def benchmark(network, links, directory):
+    """ Build a synthetic network and time the main operations on it.
+        Input: network type ('corridor' or 'grid'), number of links, scratch
+               directory
+        Output: list of result dicts
+    """
+    results = []
+    filename = os.path.join(directory, '%s_%d.inpx' % (network, links))
+    state = {}
+
+    def build():
+        v = vissim.Vissim()
+        entries = {'corridor': corridor, 'grid': grid}[network](v, links)
+        for link in entries:
+            v.Inputs.createInput(link, 500)
+        v.export(filename)
+    _run(results, network, links, 'build', build)
+
+    def load():
+        state['v'] = vissim.Vissim(filename)
+    _run(results, network, links, 'load', load)
+    _run(results, network, links, 'loadLazy',
+         lambda: vissim.Vissim(filename, lazy=True))
+    v = state['v']
+    connectors = v.Links.topology.connectors
+    nums = [num for num in v.Links if num not in connectors]
+    sample = nums[::max(1, len(nums) // SAMPLE)][:SAMPLE]
+    inputs = list(v.Inputs)
+
+    def lookup():
+        for num in sample:
+            v.Links.getLink(num)
+    _run(results, network, links, 'getLink', lookup, len(sample))
+    _run(results, network, links, 'getLinkLengths', v.Links.getLinkLengths)
+
+    def nearest():
+        for i in range(SAMPLE):
+            v.Links.getNearestSegment(i * 37.0, i * 11.0)
+    _run(results, network, links, 'getNearestSegment', nearest, SAMPLE)
+
+    def createLink():
+        for i in range(SAMPLE):
+            v.Links.createLink(point3D=[(i, -50.0, 0), (i + 1, -50.0, 0)])
+    _run(results, network, links, 'createLink', createLink, SAMPLE)
+
+    def createConnector():
+        for a, b in zip(sample[:-1], sample[1:]):
+            v.Links.createConnector(a, 1, b, 1, 1)
+    _run(results, network, links, 'createConnector', createConnector,
+         len(sample) - 1)
+
+    def updateVol():
+        for i in range(SAMPLE):
+            v.Inputs.updateVol(inputs[i % len(inputs)], 0, i)
+    _run(results, network, links, 'updateVol', updateVol, SAMPLE)
+    _run(results, network, links, 'validate', v.validate)
+    _run(results, network, links, 'export',
+         lambda: v.export(filename + '.out', incremental=True))
+    _run(results, network, links, 'exportFull',
+         lambda: v.export(filename + '.out'))
+    return results
+
+
+def _child(args):
+    network, links, directory = args
+    return benchmark(network, links, directory)
+
+
+def runAll(networks=NETWORKS, sizes=SIZES):
+    """ Benchmark every network type and size, each in its own process.
+        Input: network types, numbers of links
+        Output: dict with run metadata and results
+    """
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for network in networks:
+            for links in sizes:
+                pool = multiprocessing.Pool(1, maxtasksperchild=1)
+                try:
+                    results.extend(pool.apply(_child,
+                                              ((network, links, directory),)))
+                finally:
+                    pool.terminate()
+                    pool.join()
+                print '%s %d links done' % (network, links)
+    finally:
+        shutil.rmtree(directory)
+    meta = {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    return {'meta': meta, 'results': results}
+
+
+def compare(old, new, tolerance=0.25):
+    """ Compare two runs.
+        Input: old and new result dicts, allowed slowdown (fraction)
+        Output: list of (network, links, operation, old seconds,
+                new seconds) tuples that got slower than allowed
+    """
+    key = lambda r: (r['network'], r['links'], r['operation'])
+    before = {key(r): r for r in old['results']}
+    slower = []
+    for r in new['results']:
+        base = before.get(key(r))
+        if base is None or max(base['seconds'], r['seconds']) < NOISE:
+            continue
+        if r['seconds'] > base['seconds'] * (1 + tolerance):
+            slower.append(key(r) + (base['seconds'], r['seconds']))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--networks', default=','.join(NETWORKS))
+    parser.add_argument('--sizes', default=','.join(str(i) for i in SIZES))
+    parser.add_argument('--output', default='benchmarks.json')
+    parser.add_argument('--compare', help='earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+    run = runAll(args.networks.split(','),
+                 [int(i) for i in args.sizes.split(',')])
+    with open(args.output, 'w') as f:
+        json.dump(run, f, indent=1, sort_keys=True)
+    for r in run['results']:
+        print '%-9s %7d %-18s %9.4f s %9d kB' % (
+            r['network'], r['links'], r['operation'], r['seconds'],
+            r['peakKb'])
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(json.load(f), run, args.tolerance)
+        for network, links, operation, old, new in slower:
+            print 'SLOWER %s %d %s: %.4f s -> %.4f s' % (
+                network, links, operation, old, new)
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,6 +17,7 @@ def offsetParallel(points, distance, clockwise=True):
         elif not clockwise:
             b[:, 0] = -norm[:, 1]
             b[:, 1] = norm[:, 0]
+        return b
     A = np.array(points, dtype='float')
     B = np.vstack([-A[1], A[0], A[1:-1]])
     C = np.vstack([-A[0], A[1:]])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+""" INPX Cache
+    On-disk snapshots of parsed VISSIM networks keyed by the SHA-1 of the
+    .inpx file contents. A snapshot holds the section layout of the file, the
+    parameter registry and the columnar link geometry so that reopening an
+    unchanged network skips the XML parse. Editing the file changes its
+    hash, so stale snapshots are never read.
+"""
+import os
+import tempfile
+import cPickle as pickle
+from hashlib import sha1
+
+SNAPSHOT_VERSION = 2
+
+
+class SnapshotCache(object):
+    """ Directory of network snapshots.
+        Input: cache directory (created if missing)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, raw):
+        """ Content hash of a network file.
+            Input: file bytes
+            Output: hex digest
+        """
+        return sha1(raw).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.snapshot')
+
+    def load(self, key):
+        """ Read a snapshot.
+            Input: content hash
+            Output: snapshot dict, None if missing, unreadable or written by
+                    another snapshot version
+        """
+        try:
+            with open(self._path(key), 'rb') as f:
+                snapshot = pickle.load(f)
+        except Exception:
+            return None
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            return None
+        return snapshot
+
+    def save(self, key, snapshot):
+        """ Write a snapshot. The file is renamed in to place so concurrent
+            readers never see a partial snapshot.
+            Input: content hash, snapshot dict
+            Output: None
+        """
+        snapshot = dict(snapshot, version=SNAPSHOT_VERSION)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+        try:
+            os.rename(tmp, self._path(key))
+        except OSError:
+            # Another process already stored the same snapshot
+            os.remove(tmp)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+""" INPX Diff
+    Structural diff between two VISSIM networks. Objects are matched by
+    section and number (routes by routing decision and route number) so
+    the comparison is linear in the size of the networks. The result is a
+    Patch that reports added, removed and changed objects with attribute
+    level deltas and that can be applied to another network.
+"""
+from collections import OrderedDict
+from lxml import etree
+
+__all__ = ['Patch', 'diff']
+
+# Object kinds in the order their changes are applied
+KINDS = ('links', 'connectors', 'ptStops', 'inputs', 'routings', 'routes')
+_ROUTES = 'vehRoutSta'
+
+
+def _wrapper(v, kind):
+    """ Object type of a network that holds a kind of object.
+    """
+    if kind in ('links', 'connectors'):
+        return v.Links
+    elif kind == 'ptStops':
+        return v.PTStop
+    elif kind == 'inputs':
+        return v.Inputs
+    return v.StaticRouting
+
+
+def _objects(v, kind):
+    """ Elements of a kind of object keyed by number.
+        Input: Vissim, object kind
+        Output: dict of number (routing and route number for routes) ->
+                element
+    """
+    obj = _wrapper(v, kind)
+    objects = OrderedDict()
+    for element in obj._objects():
+        num = element.get('no')
+        if kind == 'routes':
+            for route in element.iterfind(_ROUTES + '/vehicleRouteStatic'):
+                objects[(num, route.get('no'))] = route
+        elif kind == 'links' and element.find('fromLinkEndPt') is not None:
+            continue
+        elif kind == 'connectors' and element.find('fromLinkEndPt') is None:
+            continue
+        else:
+            objects[num] = element
+    return objects
+
+
+def _canon(element):
+    """ Comparable form of an element subtree that ignores attribute order.
+    """
+    return (element.tag, tuple(sorted(element.attrib.items())),
+            (element.text or '').strip(),
+            tuple(_canon(i) for i in element.iterchildren(tag=etree.Element)))
+
+
+def _children(element, kind):
+    """ Child elements grouped by tag. Routes of a routing decision are
+        compared as objects of their own.
+    """
+    children = OrderedDict()
+    for child in element.iterchildren(tag=etree.Element):
+        if kind == 'routings' and child.tag == _ROUTES:
+            continue
+        children.setdefault(child.tag, []).append(child)
+    return children
+
+
+def _leaves(elements):
+    """ Attributes of the innermost elements of a list of subtrees, e.g.
+        the points of a <geometry> element.
+    """
+    leaves = []
+    for element in elements:
+        for i in element.iter(tag=etree.Element):
+            if len(i) == 0:
+                leaves.append(dict(i.attrib))
+    return leaves
+
+
+def _sameSection(a, b, tag):
+    """ True if neither network changed a section since it was read and
+        both read the same bytes, so the section's objects need no
+        comparison.
+    """
+    raw = a.sections.rawSection(tag)
+    return raw is not None and raw == b.sections.rawSection(tag)
+
+
+class Patch(object):
+    """ Changes that turn one network in to another.
+        added: dict of kind -> OrderedDict of number -> serialized element
+        removed: dict of kind -> list of numbers
+        changed: dict of kind -> OrderedDict of number -> delta, where a
+                 delta has 'attrib' (name -> (old, new) values, None if
+                 missing) and 'children' (child tag -> (old, new) lists of
+                 innermost attributes) entries
+        Numbers of routes are (routing decision number, route number).
+    """
+    def __init__(self):
+        self.added = {kind: OrderedDict() for kind in KINDS}
+        self.removed = {kind: [] for kind in KINDS}
+        self.changed = {kind: OrderedDict() for kind in KINDS}
+        # number -> (child tag order, tag -> serialized new children)
+        self._children = {kind: {} for kind in KINDS}
+
+    def __len__(self):
+        return sum(len(self.added[k]) + len(self.removed[k]) +
+                   len(self.changed[k]) for k in KINDS)
+
+    def __repr__(self):
+        counts = ['%s +%d -%d ~%d' % (k, len(self.added[k]),
+                                      len(self.removed[k]),
+                                      len(self.changed[k]))
+                  for k in KINDS if self.added[k] or self.removed[k] or
+                  self.changed[k]]
+        return '<Patch %s>' % (', '.join(counts) or 'empty')
+
+    def _compare(self, kind, num, old, new):
+        if etree.tostring(old) == etree.tostring(new):
+            # Identical bytes, the common case; canonical forms are only
+            # needed when attribute order or content differ
+            return
+        delta = {'attrib': {}, 'children': {}}
+        for name in set(old.attrib.keys()) | set(new.attrib.keys()):
+            if old.get(name) != new.get(name):
+                delta['attrib'][name] = (old.get(name), new.get(name))
+        oldChildren = _children(old, kind)
+        newChildren = _children(new, kind)
+        replace = {}
+        for tag in set(oldChildren) | set(newChildren):
+            before = oldChildren.get(tag, [])
+            after = newChildren.get(tag, [])
+            if [_canon(i) for i in before] != [_canon(i) for i in after]:
+                delta['children'][tag] = (_leaves(before), _leaves(after))
+                replace[tag] = [etree.tostring(i) for i in after]
+        if delta['attrib'] or delta['children']:
+            self.changed[kind][num] = delta
+            self._children[kind][num] = (list(newChildren), replace)
+
+    def _check(self, v):
+        """ Make sure every object the patch touches is in the expected
+            state before anything is changed.
+        """
+        for kind in KINDS:
+            obj = _wrapper(v, kind)
+            if kind == 'routes':
+                targets = {}
+                for routingNum, routeNum in (self.removed[kind] +
+                                             list(self.changed[kind]) +
+                                             list(self.added[kind])):
+                    if routingNum not in obj.index:
+                        raise KeyError('Routing decision %s does not exist' %
+                                       (routingNum))
+                    if routingNum not in targets:
+                        targets[routingNum] = {
+                            i.get('no') for i in obj.index[routingNum]
+                            .iterfind(_ROUTES + '/vehicleRouteStatic')}
+                exists = lambda key: key[1] in targets[key[0]]
+            else:
+                exists = lambda key: key in obj.index
+            for num in self.removed[kind] + list(self.changed[kind]):
+                if not exists(num):
+                    raise KeyError('%s %s does not exist' % (kind, num))
+            for num in self.added[kind]:
+                if exists(num):
+                    raise KeyError('%s %s already exists' % (kind, num))
+
+    def _target(self, v, kind, num):
+        """ Writable element of a changed object.
+        """
+        obj = _wrapper(v, kind)
+        if kind != 'routes':
+            return obj._edit(obj.index[num])
+        routes = obj._edit(obj.index[num[0]]).find(_ROUTES)
+        return routes.find('vehicleRouteStatic[@no="%s"]' % (num[1]))
+
+    def apply(self, v):
+        """ Apply the changes to a network. Every target is checked first,
+            so a patch that does not fit leaves the network as it was.
+            Changed objects only get the attributes and children that
+            changed, so other edits to the same objects are kept.
+            Input: Vissim (or Scenario)
+            Output: number of objects added, removed or changed
+        """
+        self._check(v)
+        parser = etree.XMLParser(remove_blank_text=True)
+        touched = []
+        for kind in reversed(KINDS):
+            obj = _wrapper(v, kind)
+            for num in self.removed[kind]:
+                if kind == 'routes':
+                    obj.removeRoute(*num)
+                else:
+                    obj._removeObject(num)
+                    touched.append((kind, num))
+        for kind in KINDS:
+            for num, delta in self.changed[kind].items():
+                element = self._target(v, kind, num)
+                for name, (old, new) in delta['attrib'].items():
+                    if new is None:
+                        element.attrib.pop(name, None)
+                    else:
+                        element.set(name, new)
+                order, replace = self._children[kind][num]
+                for tag, children in replace.items():
+                    for child in element.findall(tag):
+                        element.remove(child)
+                    for child in children:
+                        element.append(etree.fromstring(child, parser))
+                # Keep the child order of the network the patch came from
+                rank = {tag: i for i, tag in enumerate(order)}
+                kids = sorted(element.iterchildren(tag=etree.Element),
+                              key=lambda i: rank.get(i.tag, len(rank)))
+                for child in kids:
+                    element.append(child)
+                touched.append((kind, num))
+        for kind in KINDS:
+            obj = _wrapper(v, kind)
+            for num, text in self.added[kind].items():
+                element = etree.fromstring(text, parser)
+                if kind == 'routes':
+                    routing = obj._edit(obj.index[num[0]])
+                    routes = routing.find(_ROUTES)
+                    if routes is None:
+                        routes = etree.SubElement(routing, _ROUTES)
+                    routes.append(element)
+                else:
+                    obj._editSection().append(element)
+                    obj._addToIndex(element)
+                    touched.append((kind, num))
+        for kind, num in touched:
+            if kind in ('links', 'connectors'):
+                v.Links._syncLink(num)
+        return len(self)
+
+
+def diff(a, b):
+    """ Compare two networks.
+        Input: old Vissim, new Vissim
+        Output: Patch that turns a in to b
+    """
+    patch = Patch()
+    for kind in KINDS:
+        obj = _wrapper(a, kind)
+        if _sameSection(a, b, obj.path.split('/')[1]):
+            continue
+        old = _objects(a, kind)
+        new = _objects(b, kind)
+        if kind == 'routes':
+            # Routes of added or removed decisions travel with them
+            routings = set(_wrapper(a, kind).index) & \
+                set(_wrapper(b, kind).index)
+            old = OrderedDict((k, e) for k, e in old.items()
+                              if k[0] in routings)
+            new = OrderedDict((k, e) for k, e in new.items()
+                              if k[0] in routings)
+        for num, element in old.items():
+            if num not in new:
+                patch.removed[kind].append(num)
+            else:
+                patch._compare(kind, num, element, new[num])
+        for num, element in new.items():
+            if num not in old:
+                patch.added[kind][num] = etree.tostring(element)
+    return patch
@@ -0,0 +1,632 @@
+#!/usr/bin/env python
+""" INPX Sections
+    Byte-level view of the top-level sections of a VISSIM .inpx file
+    (<links>, <vehicleInputs>, <vehicleRoutingDecisionsStatic>, ...).
+    In lazy mode only the top level is parsed and each section is parsed the
+    first time it is used. On export only sections marked dirty are
+    serialized again; all others are copied from the source file verbatim,
+    so an export can also be handed to another process as the source file
+    name plus the serialized sections (see pieces() and writePieces()).
+    An Overlay shares the sections of another Sections object and copies
+    an object element only when it is first changed.
+"""
+import re
+from copy import deepcopy
+from lxml import etree
+
+# Start tag, with quoted attribute values that may contain '>'
+_START = re.compile(r'<([^\s/>!?]+)(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+_SPACE = re.compile(r'\s*')
+_INDENT = re.compile(r'^((?:  )*)', re.M)
+_CHILD = re.compile(r'^', re.M)
+_CHARREF = re.compile(r'&#x([0-9A-F]+);')
+_MULTILINE = etree.XPath('boolean(.//text()[contains(., "\n")])')
+
+
+def skipMisc(raw, pos):
+    """ Skip whitespace, comments, processing instructions and doctype.
+        Input: file bytes, position
+        Output: position of the next element tag
+    """
+    while True:
+        pos = _SPACE.match(raw, pos).end()
+        if raw.startswith('<!--', pos):
+            pos = raw.index('-->', pos) + 3
+        elif raw.startswith('<?', pos):
+            pos = raw.index('?>', pos) + 2
+        elif raw.startswith('<!', pos):
+            pos = raw.index('>', pos) + 1
+        else:
+            return pos
+
+
+def closeTag(raw, tag, pos):
+    """ Find the end of an element whose start tag ends at pos.
+        Input: file bytes, element tag, position after the start tag
+        Output: position after the matching end tag
+    """
+    pattern = re.compile(r'<(/?)' + re.escape(tag) + r'[\s/>]')
+    depth = 1
+    while True:
+        m = pattern.search(raw, pos)
+        if m is None:
+            raise ValueError('Unclosed <%s> element' % (tag))
+        if m.group(1):
+            pos = raw.index('>', m.end() - 1) + 1
+            depth -= 1
+            if depth == 0:
+                return pos
+        else:
+            start = _START.match(raw, m.start())
+            if raw[start.end() - 2] != '/':
+                depth += 1
+            pos = start.end()
+
+
+def scanSections(raw):
+    """ Locate the root element and the byte ranges of its children.
+        Input: file bytes
+        Output: root start tag end, root tag, list of
+                (tag, gap start, start, start tag end, end) tuples,
+                start of the file tail
+    """
+    root = _START.match(raw, skipMisc(raw, 0))
+    if root is None:
+        raise ValueError('No root element found')
+    spans = []
+    pos = root.end()
+    while True:
+        start = skipMisc(raw, pos)
+        if raw.startswith('</', start):
+            return root.end(), root.group(1), spans, pos
+        m = _START.match(raw, start)
+        if m is None:
+            raise ValueError('Malformed element at byte %d' % (start))
+        if raw[m.end() - 2] == '/':
+            end = m.end()
+        else:
+            end = closeTag(raw, m.group(1), m.end())
+        spans.append((m.group(1), pos, start, m.end(), end))
+        pos = end
+
+
+def writePieces(f, raw, pieces):
+    """ Write an export made of source file ranges and serialized bytes.
+        Input: open file, source file bytes, list of byte strings and
+               (start, end) ranges of the source file
+        Output: None
+    """
+    for piece in pieces:
+        if isinstance(piece, tuple):
+            f.write(raw[piece[0]:piece[1]])
+        else:
+            f.write(piece)
+
+
+class Section(object):
+    """ A top-level section of the source file and its current element.
+    """
+    def __init__(self, tag, gap, start, end, element=None, loaded=True):
+        self.tag = tag
+        self.gap = gap
+        self.start = start
+        self.end = end
+        self.element = element
+        self.loaded = loaded
+
+
+class Sections(object):
+    """ Top-level sections of an .inpx file and the document built from
+        them.
+        Input: filename, lazy flag, file bytes and scanSections() layout
+               (optional, read from the file if not given)
+    """
+    def __init__(self, filename, lazy=False, raw=None, layout=None):
+        self.filename = filename
+        self.lazy = lazy
+        self.parser = etree.XMLParser(remove_blank_text=True)
+        self.dirty = set()
+        if raw is None:
+            with open(filename, 'rb') as f:
+                raw = f.read()
+        self.raw = raw
+        if layout is None:
+            layout = scanSections(raw)
+        self.layout = layout
+        headEnd, rootTag, spans, tailStart = layout
+        self.head = self.raw[:headEnd]
+        self.close = '</' + rootTag + '>'
+        self.tail = self.raw[tailStart:]
+        self.newline = '\r\n' if '\r\n' in self.head else '\n'
+        self.sections = []
+        if lazy:
+            skeleton = [self.head]
+            for tag, gapStart, start, startEnd, end in spans:
+                if startEnd == end:
+                    # Self-closing sections have nothing to defer
+                    skeleton.append(self.raw[start:end])
+                else:
+                    skeleton.append(self.raw[start:startEnd - 1] + '/>')
+                self.sections.append(Section(tag, self.raw[gapStart:start],
+                                             start, end,
+                                             loaded=startEnd == end))
+            skeleton.append(self.close)
+            text = ''.join(skeleton)
+        else:
+            for tag, gapStart, start, startEnd, end in spans:
+                self.sections.append(Section(tag, self.raw[gapStart:start],
+                                             start, end))
+            text = self.raw
+        root = etree.fromstring(text, self.parser, base_url=filename)
+        for section, element in zip(self.sections,
+                                    root.iterchildren(tag=etree.Element)):
+            section.element = element
+        self.data = root.getroottree()
+        self.encoding = self.data.docinfo.encoding
+        self.byTag = {}
+        for section in reversed(self.sections):
+            self.byTag[section.tag] = section
+
+    def load(self, tag):
+        """ Return a top-level section element, parsing it first if it was
+            deferred.
+            Input: section tag
+            Output: section element, None if the document has no such section
+        """
+        section = self.byTag.get(tag)
+        if section is None:
+            return self.data.getroot().find(tag)
+        if not section.loaded:
+            text = self.head + self.raw[section.start:section.end] + self.close
+            element = etree.fromstring(text, self.parser)[0]
+            self.data.getroot().replace(section.element, element)
+            section.element = element
+            section.loaded = True
+        return section.element
+
+    def loadAll(self):
+        """ Parse every deferred section.
+        """
+        for section in self.sections:
+            self.load(section.tag)
+
+    def attach(self, tag):
+        """ Make a section part of the document in self.data.
+            Input: section tag
+            Output: section element, None if the document has no such section
+        """
+        return self.load(tag)
+
+    def objects(self, tag, name=None):
+        """ Child elements of a section in document order.
+            Input: section tag, child tag (all elements by default)
+            Output: iterator of elements
+        """
+        section = self.load(tag)
+        if section is None:
+            return iter([])
+        return section.iterchildren(name or etree.Element)
+
+    def xpath(self, tag, path):
+        """ Evaluate an XPath over a section.
+            Input: section tag, path relative to the section that starts at
+                   its children, e.g. './link/@no'
+            Output: list of results
+        """
+        section = self.load(tag)
+        if section is None:
+            return []
+        return section.xpath(path)
+
+    def edit(self, tag, element):
+        """ Flag a section as changed before one of its children is edited.
+            Input: section tag, child element
+            Output: the element to change
+        """
+        self.markDirty(tag)
+        return element
+
+    def remove(self, tag, element):
+        """ Remove a child element from a section.
+            Input: section tag, child element
+            Output: None
+        """
+        self.markDirty(tag)
+        element.getparent().remove(element)
+
+    def parent(self, tag):
+        """ Flag a section as changed before children are added to it.
+            Input: section tag
+            Output: element new children are appended to, None if the
+                    document has no such section
+        """
+        self.markDirty(tag)
+        return self.load(tag)
+
+    def version(self, tag):
+        """ Token that changes whenever the children of a section are
+            replaced, e.g. by a lazy parse, so element indexes know when to
+            rebuild.
+            Input: section tag
+            Output: token to compare with ==
+        """
+        return self.load(tag)
+
+    def markDirty(self, tag):
+        """ Flag a section as changed so that it is serialized on export.
+            Input: section tag
+            Output: None
+        """
+        self.dirty.add(tag)
+
+    def rawSection(self, tag):
+        """ Source bytes of a section that has not changed since it was read.
+            Input: section tag
+            Output: section bytes, None if the section is new or dirty
+        """
+        section = self.byTag.get(tag)
+        if section is None or section.loaded and tag in self.dirty:
+            return None
+        return self.raw[section.start:section.end]
+
+    def _gap(self, tag):
+        """ Whitespace written before a section.
+        """
+        section = self.byTag.get(tag)
+        if section is not None:
+            return section.gap
+        return self.sections[0].gap if self.sections else self.newline
+
+    def _piece(self, element):
+        """ What is written for a top-level element, including the whitespace
+            before it.
+            Input: top-level element of self.data
+            Output: (start, end) range of the source file if the section is
+                    unchanged, serialized element otherwise
+        """
+        section = self.byTag.get(element.tag)
+        if section is None or section.element is not element:
+            gap = self._gap(element.tag)
+            return gap + self._serialize(element, gap)
+        if not section.loaded or section.tag not in self.dirty:
+            return (section.start - len(section.gap), section.end)
+        return section.gap + self._serialize(element, section.gap)
+
+    def pieces(self):
+        """ Contents of an incremental export, with the unchanged parts
+            left in the source file.
+            Input: None
+            Output: list of byte strings and (start, end) ranges of the
+                    source file self.raw
+        """
+        pieces = [(0, len(self.head))]
+        for element in self.data.getroot().iterchildren(tag=etree.Element):
+            pieces.append(self._piece(element))
+        pieces.append((len(self.raw) - len(self.tail), len(self.raw)))
+        return pieces
+
+    def _serializeTag(self, tag, gap):
+        """ Serialize a section by tag.
+            Input: section tag, whitespace preceding the section
+            Output: serialized section
+        """
+        return self._serialize(self.load(tag), gap)
+
+    def _serialize(self, element, gap):
+        """ Serialize a section element with the source file's newlines and
+            indentation.
+            Input: section element, whitespace preceding the section
+            Output: serialized section
+        """
+        text = etree.tostring(element, pretty_print=True,
+                              encoding=self.encoding,
+                              xml_declaration=False).rstrip('\n')
+        return self._layout(text, gap, lambda: _MULTILINE(element))
+
+    def _layout(self, text, gap, multiline):
+        """ Apply the source file's newlines and indentation to a serialized
+            section.
+            Input: pretty printed section, whitespace preceding the section,
+                   function telling whether the section has multi-line text
+            Output: serialized section
+        """
+        indent = gap.split('\n')[-1]
+        if indent and not indent.strip() and not multiline():
+            # Swap lxml's two-space indentation for the file's own
+            level = lambda m: indent * (len(m.group(1)) // 2 + 1)
+            text = _INDENT.sub(level, text)[len(indent):]
+        return text.replace('\n', self.newline)
+
+    def write(self, filename, incremental=True):
+        """ Write the document to disk. Sections that were not marked dirty
+            are copied from the source file verbatim.
+            Input: filename, incremental flag (serialize every section if
+                   False)
+            Output: written file
+        """
+        if not incremental:
+            self.loadAll()
+            self.data.write(filename, encoding="UTF-8", standalone=False,
+                            pretty_print=True)
+            return
+        with open(filename, 'wb') as f:
+            writePieces(f, self.raw, self.pieces())
+
+
+class Overlay(Sections):
+    """ Copy-on-write view of another Sections object. Reads are served from
+        the base sections; an object element is copied in to the overlay the
+        first time it is edited and removals are recorded against the base
+        element, so the base document is never changed and memory grows with
+        the elements that were edited. Sections follow the base except for
+        those edits, so the base should not be edited while the overlay is
+        in use. markDirty() and load() still copy a whole section, for code
+        that works on the section element directly.
+        Input: base Sections (or Overlay)
+    """
+    def __init__(self, base):
+        self.base = base
+        self.filename = base.filename
+        self.lazy = True
+        self.parser = base.parser
+        self.dirty = set()
+        self.owned = set()
+        # Section tag -> {base element: copy, None if removed}
+        self.copies = {}
+        # Copy -> base element
+        self.origin = {}
+        self.raw = base.raw
+        self.layout = base.layout
+        self.head = base.head
+        self.close = base.close
+        self.tail = base.tail
+        self.newline = base.newline
+        self.encoding = base.encoding
+        self.sections = base.sections
+        self.byTag = base.byTag
+        # Empty stand-ins keep the section order and attributes, and hold
+        # the copied and new elements of each section
+        root = base.data.getroot()
+        skeleton = etree.Element(root.tag, attrib=root.attrib,
+                                 nsmap=root.nsmap)
+        for element in root.iterchildren(tag=etree.Element):
+            etree.SubElement(skeleton, element.tag, attrib=element.attrib)
+        self.data = skeleton.getroottree()
+        self.root = skeleton
+
+    def _inBase(self, tag):
+        return self.base.data.getroot().find(tag) is not None
+
+    def _owns(self, element):
+        """ True if an element is part of the overlay's own document.
+        """
+        return element.getroottree().getroot() is self.root
+
+    def load(self, tag):
+        """ Return a top-level section element: the overlay's copy if the
+            section was changed, the shared base section otherwise. A section
+            with element copies is copied whole first.
+            Input: section tag
+            Output: section element, None if the document has no such section
+        """
+        if tag in self.copies:
+            return self.attach(tag)
+        if tag in self.owned:
+            return self.root.find(tag)
+        element = self.base.load(tag)
+        if element is None:
+            # Sections created in the overlay itself
+            return self.root.find(tag)
+        return element
+
+    def loadAll(self):
+        """ Copy every section in to the overlay.
+        """
+        for element in self.root.iterchildren(tag=etree.Element):
+            self.attach(element.tag)
+
+    def attach(self, tag):
+        """ Copy a base section in to self.data, leaving it clean. Element
+            copies made so far take the place of their base elements.
+            Input: section tag
+            Output: section element, None if the document has no such section
+        """
+        if tag not in self.owned and self._inBase(tag):
+            stub = self.root.find(tag)
+            if tag in self.copies or isinstance(self.base, Overlay):
+                children = [i if self._owns(i) else deepcopy(i)
+                            for i in self.objects(tag)]
+                for copy in self.copies.pop(tag, {}).values():
+                    self.origin.pop(copy, None)
+                for child in list(stub):
+                    stub.remove(child)
+                stub.extend(children)
+            else:
+                self.root.replace(stub, deepcopy(self.base.load(tag)))
+            self.owned.add(tag)
+        return self.root.find(tag)
+
+    def objects(self, tag, name=None):
+        """ Child elements of a section in document order, with element
+            copies in place of their base elements and new elements last.
+            Input: section tag, child tag (all elements by default)
+            Output: iterator of elements
+        """
+        if tag in self.copies:
+            return self._merged(tag, name)
+        if tag in self.owned or not self._inBase(tag):
+            stub = self.root.find(tag)
+            if stub is None:
+                return iter([])
+            return stub.iterchildren(name or etree.Element)
+        return self.base.objects(tag, name)
+
+    def _merged(self, tag, name=None):
+        copies = self.copies[tag]
+        for element in self.base.objects(tag, name):
+            if element in copies:
+                element = copies[element]
+                if element is None:
+                    continue
+            yield element
+        for element in self.root.find(tag).iterchildren(name or
+                                                       etree.Element):
+            if element not in self.origin:
+                yield element
+
+    def xpath(self, tag, path):
+        """ Evaluate an XPath over a section. With element copies the path
+            is evaluated on each child in turn.
+            Input: section tag, path relative to the section that starts at
+                   its children, e.g. './link/@no'
+            Output: list of results
+        """
+        if tag not in self.copies:
+            if tag in self.owned or not self._inBase(tag):
+                stub = self.root.find(tag)
+                return [] if stub is None else stub.xpath(path)
+            return self.base.xpath(tag, path)
+        if not path.startswith('./'):
+            raise ValueError('XPath %s must start at the children' % (path))
+        find = etree.XPath('self::' + path[2:])
+        return [i for element in self.objects(tag) for i in find(element)]
+
+    def edit(self, tag, element):
+        """ Copy a base element in to the overlay before it is edited.
+            Input: section tag, child element
+            Output: the overlay's copy of the element
+        """
+        self.dirty.add(tag)
+        if tag in self.owned or self._owns(element):
+            return element
+        copy = deepcopy(element)
+        self.copies.setdefault(tag, {})[element] = copy
+        self.origin[copy] = element
+        self.root.find(tag).append(copy)
+        return copy
+
+    def remove(self, tag, element):
+        """ Remove a child element, recording the removal of a base element
+            without changing the base.
+            Input: section tag, child element
+            Output: None
+        """
+        self.dirty.add(tag)
+        if tag in self.owned:
+            element.getparent().remove(element)
+            return
+        copies = self.copies.setdefault(tag, {})
+        if self._owns(element):
+            element.getparent().remove(element)
+            element = self.origin.pop(element, None)
+            if element is None:
+                return
+        copies[element] = None
+
+    def parent(self, tag):
+        """ Flag a section as changed before children are added to it.
+            Input: section tag
+            Output: element new children are appended to, None if the
+                    document has no such section
+        """
+        self.dirty.add(tag)
+        if tag not in self.owned:
+            if self._inBase(tag):
+                self.copies.setdefault(tag, {})
+            else:
+                self.owned.add(tag)
+        return self.root.find(tag)
+
+    def changes(self, tag):
+        """ Element edits of a section.
+            Input: section tag
+            Output: list of (base element, copy) pairs, the copy is None for
+                    removed elements and the base element None for new ones
+        """
+        copies = self.copies.get(tag, {})
+        stub = self.root.find(tag)
+        added = [] if stub is None else [
+            (None, i) for i in stub.iterchildren(tag=etree.Element)
+            if i not in self.origin]
+        return copies.items() + added
+
+    def version(self, tag):
+        return (tag in self.owned, self.base.version(tag))
+
+    def markDirty(self, tag):
+        """ Flag a section as changed, copying it from the base first. Call
+            before resolving the elements that will change.
+            Input: section tag
+            Output: None
+        """
+        self.attach(tag)
+        self.dirty.add(tag)
+
+    def rawSection(self, tag):
+        if tag in self.dirty:
+            return None
+        return self.base.rawSection(tag)
+
+    def _piece(self, element):
+        tag = element.tag
+        shared = self.base.data.getroot().find(tag)
+        if tag in self.dirty or shared is None:
+            gap = self._gap(tag)
+            return gap + self._serializeTag(tag, gap)
+        return self.base._piece(shared)
+
+    def _serializeTag(self, tag, gap):
+        if tag in self.copies:
+            return self._serializeMerged(tag, gap)
+        if tag in self.owned or not self._inBase(tag):
+            return self._serialize(self.root.find(tag), gap)
+        return self.base._serializeTag(tag, gap)
+
+    def _serializeMerged(self, tag, gap):
+        """ Serialize a section with element copies one child at a time,
+            without copying the base section.
+            Input: section tag, whitespace preceding the section
+            Output: serialized section
+        """
+        stub = self.root.find(tag)
+        children = list(self.objects(tag))
+        shell = etree.Element(tag, attrib=stub.attrib, nsmap=stub.nsmap)
+        if not children or any(_MULTILINE(i) for i in children):
+            # Text that spans lines can not be indented line by line
+            shell.extend(deepcopy(i) for i in children)
+            return self._serialize(shell, gap)
+        shell.text = 'x'
+        text = etree.tostring(shell, encoding=self.encoding,
+                              xml_declaration=False)
+        parts = [text[:text.rindex('x</')], '\n']
+        for child in children:
+            text = etree.tostring(child, pretty_print=True,
+                                  encoding=self.encoding,
+                                  xml_declaration=False,
+                                  with_tail=False).rstrip('\n')
+            # A child serialized on its own has the non-ASCII characters of
+            # its attributes escaped, unlike inside its section
+            end = text.index('>')
+            text = _CHARREF.sub(self._unescape, text[:end]) + text[end:]
+            parts.append(_CHILD.sub('  ', text) + '\n')
+        parts.append('</' + tag + '>')
+        return self._layout(''.join(parts), gap, lambda: False)
+
+    def _unescape(self, match):
+        return unichr(int(match.group(1), 16)).encode(self.encoding)
+
+    def write(self, filename, incremental=True):
+        """ Write the overlay to disk. Unchanged sections are written as the
+            base would write them.
+            Input: filename, incremental flag (serialize every section if
+                   False)
+            Output: written file
+        """
+        if incremental:
+            return Sections.write(self, filename)
+        with open(filename, 'wb') as f:
+            f.write(self.head)
+            for element in self.root.iterchildren(tag=etree.Element):
+                gap = self._gap(element.tag)
+                f.write(gap + self._serializeTag(element.tag, gap))
+            f.write(self.tail)
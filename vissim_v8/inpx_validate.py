@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+""" INPX Validate
+    Referential integrity checks for VISSIM networks: connector end points,
+    routes, vehicle inputs, routing decisions and public transport stops
+    are checked against the links, lanes and numbers they refer to. Every
+    check reads from indexes built once per run (link lengths from the
+    geometry store, connectors from the topology), so a run is linear in
+    the size of the network.
+"""
+
+# Slack for positions stored with fewer decimals than the link length
+TOLERANCE = 1e-3
+
+
+class _Checker(object):
+    def __init__(self, v):
+        self.v = v
+        self.findings = []
+        self.topology = v.Links.topology
+        self.lengths = v.Links.getLinkLengths()
+        self.lanes = {}
+        for link in v.Links._objects():
+            self.lanes[link.get('no')] = len(link.findall('lanes/lane'))
+
+    def report(self, objType, num, field, message):
+        self.findings.append({'type': objType, 'no': num, 'field': field,
+                              'message': message})
+
+    def link(self, objType, num, field, linkNum, connector=False):
+        """ Check that a link exists. Connectors are only accepted if
+            connector is True.
+            Output: True if the link can be used
+        """
+        if linkNum not in self.lanes:
+            self.report(objType, num, field,
+                        'link %s does not exist' % (linkNum))
+            return False
+        if not connector and linkNum in self.topology.connectors:
+            self.report(objType, num, field,
+                        'link %s is a connector' % (linkNum))
+            return False
+        return True
+
+    def lane(self, objType, num, field, value, lanes=1):
+        """ Check a 'link lane' reference, covering lanes lane to
+            lane + lanes - 1.
+            Output: link number if the link exists, None otherwise
+        """
+        try:
+            linkNum, lane = value.split(' ')
+            lane = int(lane)
+        except (AttributeError, ValueError):
+            self.report(objType, num, field,
+                        'malformed lane reference %r' % (value))
+            return None
+        if not self.link(objType, num, field, linkNum):
+            return None
+        if lane < 1 or lane + lanes - 1 > self.lanes[linkNum]:
+            self.report(objType, num, field,
+                        'lanes %d-%d exceed the %d lanes of link %s' %
+                        (lane, lane + lanes - 1, self.lanes[linkNum],
+                         linkNum))
+        return linkNum
+
+    def position(self, objType, num, field, linkNum, pos, length=0.0):
+        """ Check that a position (plus a length) lies on a link. An empty
+            position is left unset, e.g. by createptStop.
+        """
+        if linkNum is None or pos is None or pos == '':
+            return
+        try:
+            start = float(pos)
+            end = start + float(length)
+        except ValueError:
+            self.report(objType, num, field,
+                        'malformed position %r' % (pos))
+            return
+        linkLength = self.lengths.get(linkNum)
+        if start < -TOLERANCE or (linkLength is not None and
+                                  end > linkLength + TOLERANCE):
+            self.report(objType, num, field,
+                        'position %s is off link %s (length %.3f)' %
+                        (pos, linkNum, linkLength or 0.0))
+
+    def numbers(self, objType, num, field, key, refs):
+        """ Check references to numbered objects such as vehicle classes.
+        """
+        known = self.v.params[key]
+        for ref in refs:
+            try:
+                missing = int(ref) not in known
+            except (TypeError, ValueError):
+                missing = True
+            if missing:
+                self.report(objType, num, field,
+                            '%s %s does not exist' % (key, ref))
+
+    def connectors(self):
+        for link in self.v.Links._objects():
+            num = link.get('no')
+            lanes = self.lanes[num]
+            for field in ('fromLinkEndPt', 'toLinkEndPt'):
+                end = link.find(field)
+                if end is None:
+                    continue
+                linkNum = self.lane('link', num, field, end.get('lane'),
+                                    lanes)
+                self.position('link', num, field, linkNum, end.get('pos'))
+
+    def step(self, a, b):
+        """ True if a route can move from link a to link b.
+        """
+        if a == b:
+            return True
+        connector = self.topology.connectors.get(a)
+        if connector is not None:
+            return connector[2] == b
+        connector = self.topology.connectors.get(b)
+        return connector is not None and connector[0] == a
+
+    def routing(self):
+        name = 'vehicleRoutingDecisionStatic'
+        for routing in self.v.StaticRouting._objects():
+            num = routing.get('no')
+            start = routing.get('link')
+            if self.link(name, num, 'link', start):
+                self.position(name, num, 'pos', start, routing.get('pos'))
+            else:
+                start = None
+            self.numbers(name, num, 'vehClasses', 'vehicleClass',
+                         [i.get('key') for i in
+                          routing.iterfind('vehClasses/intObjectRef')])
+            for route in routing.iterfind('vehRoutSta/vehicleRouteStatic'):
+                self.route(num, start, route)
+
+    def route(self, routingNum, start, route):
+        name = 'vehicleRouteStatic'
+        num = (routingNum, route.get('no'))
+        dest = route.get('destLink')
+        if self.link(name, num, 'destLink', dest):
+            self.position(name, num, 'destPos', dest, route.get('destPos'))
+        else:
+            dest = None
+        seq = [i.get('key') for i in route.iterfind('linkSeq/intObjectRef')]
+        path = [start]
+        for key in seq:
+            if not self.link(name, num, 'linkSeq', key, connector=True):
+                # The path can not be followed past a missing link
+                return
+            path.append(key)
+        path.append(dest)
+        for a, b in zip(path[:-1], path[1:]):
+            if a is not None and b is not None and not self.step(a, b):
+                self.report(name, num, 'linkSeq',
+                            'link %s does not lead to link %s' % (a, b))
+
+    def inputs(self):
+        name = 'vehicleInput'
+        for element in self.v.Inputs._objects():
+            num = element.get('no')
+            self.link(name, num, 'link', element.get('link'))
+            self.numbers(name, num, 'vehComp', 'vehicleComposition',
+                         [i.get('vehComp') for i in element.iterfind(
+                          'timeIntVehVols/timeIntervalVehVolume')])
+
+    def ptStops(self):
+        name = 'ptStop'
+        for element in self.v.PTStop._objects():
+            num = element.get('no')
+            linkNum = self.lane(name, num, 'lane', element.get('lane'))
+            self.position(name, num, 'pos', linkNum, element.get('pos'),
+                          element.get('length', 0.0))
+
+
+def checkReferences(v):
+    """ Check every cross-reference of a network in one pass.
+        Input: Vissim
+        Output: list of finding dicts with type (element name), no (routing
+                decision and route number for routes), field and message
+    """
+    checker = _Checker(v)
+    checker.connectors()
+    checker.inputs()
+    checker.routing()
+    checker.ptStops()
+    return checker.findings
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+""" OSM Tiles
+    Local store of OSM extracts. A bbox is split in to tiles on a fixed
+    grid, every tile that is not stored yet is fetched once (several at a
+    time) and kept gzip compressed, and the tiles of a bbox are merged in
+    to one OSM stream, with every node and way written once, for read_osm.
+    Converting an area that overlaps one converted before only fetches the
+    tiles that were not needed then, so repeated runs work offline.
+"""
+import gzip
+import math
+import os
+import tempfile
+import urllib2
+from hashlib import sha1
+from lxml import etree
+from multiprocessing.pool import ThreadPool
+from osm_to_graph import _iterElements
+
+__all__ = ['TileStore', 'urlFetcher', 'fileFetcher']
+
+# Tile edge in degrees
+TILE_SIZE = 0.05
+# Tiles fetched at the same time
+FETCH_THREADS = 4
+OVERPASS_URL = ('http://www.overpass-api.de/api/xapi?way[highway=%(highway)s]'
+                '[bbox=%(left)f,%(bottom)f,%(right)f,%(top)f]')
+
+
+def urlFetcher(url=OVERPASS_URL, timeout=120):
+    """ Fetcher that downloads tiles, by default from the Overpass xapi.
+        Input: URL template with highway, left, bottom, right and top
+               fields, timeout in seconds
+        Output: fetcher function
+    """
+    def fetch(left, bottom, right, top, highway_cat):
+        f = urllib2.urlopen(url % {'highway': highway_cat, 'left': left,
+                                   'bottom': bottom, 'right': right,
+                                   'top': top}, timeout=timeout)
+        try:
+            return f.read()
+        finally:
+            f.close()
+    return fetch
+
+
+def fileFetcher(filename):
+    """ Fetcher that cuts tiles out of a local OSM file the way the xapi
+        does: the ways of highway_cat with a node in the tile, and all of
+        their nodes.
+        Input: OSM file name
+        Output: fetcher function
+    """
+    def fetch(left, bottom, right, top, highway_cat):
+        categories = set(highway_cat.split('|'))
+        inside = set()
+        for node in _iterElements(filename, 'node'):
+            if (left <= float(node.get('lon')) <= right and
+                    bottom <= float(node.get('lat')) <= top):
+                inside.add(node.get('id'))
+        ways = []
+        used = set()
+        for way in _iterElements(filename, 'way'):
+            refs = [i.get('ref') for i in way.iterchildren('nd')]
+            highway = way.find('tag[@k="highway"]')
+            if (highway is not None and highway.get('v') in categories and
+                    inside.intersection(refs)):
+                ways.append(etree.tostring(way, with_tail=False))
+                used.update(refs)
+        nodes = [etree.tostring(i, with_tail=False)
+                 for i in _iterElements(filename, 'node')
+                 if i.get('id') in used]
+        return '<osm version="0.6">%s</osm>' % (''.join(nodes + ways))
+    return fetch
+
+
+class TileStore(object):
+    """ Directory of OSM tiles.
+        Input: store directory (created if missing), fetcher function
+               (left, bottom, right, top, highway_cat) -> OSM bytes, tile
+               edge in degrees, number of tiles fetched at the same time
+    """
+    def __init__(self, directory, fetcher=None, tileSize=TILE_SIZE,
+                 threads=FETCH_THREADS):
+        self.directory = directory
+        self.fetcher = fetcher or urlFetcher()
+        self.tileSize = tileSize
+        self.threads = threads
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def tiles(self, left, bottom, right, top):
+        """ Tiles that cover a bbox.
+            Input: WGS84 bbox
+            Output: list of (column, row) tiles
+        """
+        if left > right or bottom > top:
+            raise ValueError('bbox must be (left, bottom, right, top)')
+        return [(col, row) for row in self._span(bottom, top)
+                for col in self._span(left, right)]
+
+    def _span(self, low, high):
+        # A bbox edge on a tile edge does not take in the next tile
+        first = int(math.floor(low / self.tileSize))
+        last = int(math.ceil(high / self.tileSize)) - 1
+        return range(first, max(first, last) + 1)
+
+    def tileBox(self, tile):
+        """ Input: (column, row) tile
+            Output: WGS84 bbox of the tile
+        """
+        col, row = tile
+        size = self.tileSize
+        return (col * size, row * size, (col + 1) * size, (row + 1) * size)
+
+    def _path(self, tile, highway_cat):
+        # Tiles of other categories or sizes are stored separately
+        query = sha1('%s|%r' % (highway_cat, self.tileSize)).hexdigest()
+        return os.path.join(self.directory, query[:12],
+                            '%d_%d.osm.gz' % tile)
+
+    def _fetch(self, job):
+        tile, highway_cat = job
+        data = self.fetcher(*(self.tileBox(tile) + (highway_cat,)))
+        if etree.fromstring(data).tag != 'osm':
+            raise IOError('Tile %d_%d is not OSM data' % tile)
+        path = self._path(tile, highway_cat)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Made by another fetch
+                pass
+        # Renamed in to place so readers never see a partial tile
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            gz = gzip.GzipFile(fileobj=f, mode='wb')
+            gz.write(data)
+            gz.close()
+        os.rename(tmp, path)
+        return tile
+
+    def fetch(self, left, bottom, right, top, highway_cat):
+        """ Fetch the tiles of a bbox that are not stored yet. Tiles that
+            were fetched are kept even if another one fails.
+            Input: WGS84 bbox, highway tag values separated by pipes
+            Output: list of the tiles that were fetched
+        """
+        missing = [(tile, highway_cat)
+                   for tile in self.tiles(left, bottom, right, top)
+                   if not os.path.exists(self._path(tile, highway_cat))]
+        if len(missing) < 2 or self.threads < 2:
+            return [self._fetch(i) for i in missing]
+        pool = ThreadPool(min(self.threads, len(missing)))
+        try:
+            return pool.map(self._fetch, missing)
+        finally:
+            pool.close()
+            pool.join()
+
+    def open(self, left, bottom, right, top, highway_cat):
+        """ Fetch the missing tiles of a bbox and merge all of them. Nodes
+            come before ways and relations, and an element that is in
+            several tiles is written once.
+            Input: WGS84 bbox, highway tag values separated by pipes
+            Output: OSM stream for read_osm (a temporary file)
+        """
+        self.fetch(left, bottom, right, top, highway_cat)
+        paths = [self._path(tile, highway_cat)
+                 for tile in self.tiles(left, bottom, right, top)]
+        out = tempfile.TemporaryFile()
+        out.write("<?xml version='1.0' encoding='UTF-8'?>\n"
+                  '<osm version="0.6" generator="vissim_v8">\n')
+        for tag in ('node', 'way', 'relation'):
+            seen = set()
+            for path in paths:
+                with gzip.open(path, 'rb') as f:
+                    for element in _iterElements(f, tag):
+                        num = element.get('id')
+                        if num not in seen:
+                            seen.add(num)
+                            out.write(etree.tostring(element,
+                                                     with_tail=False))
+                            out.write('\n')
+        out.write('</osm>\n')
+        out.seek(0)
+        return out
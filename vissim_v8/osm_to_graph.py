@@ -7,18 +7,27 @@ http://github.com/bmander/graphserver/tree/master and is copyright (c)
 2007, Brandon Martin-Anderson under the BSD License
 """
 
+from collections import Mapping
 from lxml import etree
 import copy
 import networkx
+import numpy as np
+import shutil
+import tempfile
 
 import sys
 
 highway_cat = 'motorway|trunk|primary|secondary|tertiary|road|residential|service|motorway_link|trunk_link|primary_link|secondary_link|teriary_link'
 
+# Nodes read in to a list before they are moved to arrays
+BLOCK = 65536
+# Keys of the node tags that are kept, e.g. highway=traffic_signals
+NODE_TAGS = ('highway', 'public_transport', 'railway', 'crossing', 'barrier')
+
 #RV
 gIncBusStop = '--include-bus-stops' in sys.argv
 
-def download_osm(left,bottom,right,top,highway_cat):
+def download_osm(left,bottom,right,top,highway_cat,cache=None):
     """
     Downloads OSM street (only highway-tagged) Data using a BBOX,
     plus a specification of highway tag values to use
@@ -28,6 +37,9 @@ def download_osm(left,bottom,right,top,highway_cat):
     left,bottom,right,top : BBOX of left,bottom,right,top coordinates in WGS84
     highway_cat : highway tag values to use, separated by pipes (|), for
     instance 'motorway|trunk|primary'
+    cache : TileStore, or the directory of one, to fetch the bbox in tiles
+    that are stored and reused by later calls; failed downloads raise
+    instead of returning None
 
     Returns
     ----------
@@ -35,6 +47,11 @@ def download_osm(left,bottom,right,top,highway_cat):
 
     """
     # Return a filehandle to the downloaded data."""
+    if cache is not None:
+        from osm_tiles import TileStore
+        if not isinstance(cache, TileStore):
+            cache = TileStore(cache)
+        return cache.open(left, bottom, right, top, highway_cat)
     from urllib import urlopen
     # fp = urlopen( "http://api.openstreetmap.org/api/0.6/map?bbox=%f,%f,%f,%f"%(left,bottom,right,top) )
     # fp = urlopen( "http://www.overpass-api.de/api/xapi?way[highway=*][bbox=%f,%f,%f,%f]"%(left,bottom,right,top) )
@@ -50,25 +67,39 @@ def download_osm(left,bottom,right,top,highway_cat):
         print "osm data download unsuccessful"
 
 
-def read_osm(filename_or_stream, only_roads=True):
+def read_osm(filename_or_stream, only_roads=True, highway_cat=None,
+             osm_filter=None):
     """Read graph in OSM format from file specified by name or by stream object.
 
     Parameters
     ----------
     filename_or_stream : filename or stream object
+    only_roads : read only ways with a highway tag; other ways and their
+    nodes are skipped while the file is parsed
+    highway_cat : highway tag values of the ways to read, separated by pipes
+    (|), or None to read every way
+    osm_filter : OSMFilter of the ways to read, instead of highway_cat
 
     Returns
     -------
     G : Graph
-    osm : struct holding ways and nodes
+    osm : struct holding ways and nodes, node coordinates are read with
+    osm.nodes.getLatLng
 
     Examples
     --------
     >>> G=nx.read_osm(nx.download_osm(-122.33,47.60,-122.31,47.61))
-    >>> plot([G.node[n]['data'].lat for n in G], [G.node[n]['data'].lon for n
-        in G], ',')
+    >>> plot(*osm.nodes.getLatLngs(G.nodes()), ',')
     """
-    osm = OSM(filename_or_stream)
+    if osm_filter is None:
+        osm_filter = OSMFilter(highway=highway_cat,
+                               require=['highway'] if only_roads else None)
+    elif highway_cat is not None:
+        raise ValueError('Give either highway_cat or osm_filter')
+    elif only_roads and 'highway' not in osm_filter.require:
+        osm_filter = copy.copy(osm_filter)
+        osm_filter.require = dict(osm_filter.require, highway=None)
+    osm = OSM(filename_or_stream, osm_filter)
     G = networkx.DiGraph()
 
     def addEdges(w):
@@ -87,26 +118,14 @@ def read_osm(filename_or_stream, only_roads=True):
                 G.add_path(reversed(w.nds), **attr)"""
 
     for w in osm.ways.itervalues():
-        # Skip w if no highway tag
-        if only_roads and 'highway' not in w.tags:
-            continue
         addEdges(w)
 
     #RV
     #print '>> Num of nodes in G is %d' %(len(G.nodes()))
     #RV
     
-    c = 0
-    for n in osm.nodes:
-	if (type(osm.nodes[n]) is BusStopNode):
-		c += 1
-	pass
-    pass
-    print "Number of busstop nodes is %d" %(c)
-    
-    for n_id in G.nodes_iter():
-        n = osm.nodes[n_id]
-        G.node[n_id] = dict(lon=n.lon, lat=n.lat)
+    print "Number of busstop nodes is %d" % (osm.BsCount)
+
     return G, osm
 
 
@@ -127,130 +146,395 @@ class BusStopNode(NonWayNode):
         NonWayNode.__init__(self, id, lon, lat, 'bus_stop')
 
 
-class Way:
+class Way(object):
+    __slots__ = ('osm', 'id', 'nds', 'tags', 'parent', 'span')
+
     def __init__(self, id, osm):
         self.osm = osm
         self.id = id
         self.nds = []
         self.tags = {}
+        # id of the way this one was split from and the range of its nodes
+        # in that way (first, last)
+        self.parent = id
+        self.span = None
 
     def split(self, dividers):
-        # slice the node-array using this nifty recursive function
-
-        def slice_array(ar, dividers):
-            for i in range(1, len(ar)-1):
-                if dividers[ar[i]] > 1:
-                    # print "slice at %s"%ar[i]
-                    left = ar[:i + 1]
-                    right = ar[i:]
-                    rightsliced = slice_array(right, dividers)
-                    return [left]+rightsliced
-            return [ar]
-        slices = slice_array(self.nds, dividers)
-        # create a way object for each node-array slice
+        """ Split the way at every inner node that more than one way uses.
+            The cuts are found in one pass over the nodes, and each piece
+            records the range of nodes it covers in this way.
+            Input: dict of node id -> number of ways that use it
+            Output: list of ways
+        """
+        nds = self.nds
+        cuts = [0]
+        cuts.extend(i for i in xrange(1, len(nds) - 1)
+                    if dividers[nds[i]] > 1)
+        cuts.append(len(nds) - 1)
+        # create a way object for each range of nodes
         ret = []
-        i = 0
-        for slice in slices:
+        for i in xrange(len(cuts) - 1):
             littleway = copy.copy(self)
-            littleway.id += "-%d" % i
-            littleway.nds = slice
+            littleway.id = "%s-%d" % (self.id, i)
+            littleway.nds = nds[cuts[i]:cuts[i + 1] + 1]
+            littleway.parent = self.id
+            littleway.span = (cuts[i], cuts[i + 1])
             ret.append(littleway)
-            i += 1
         return ret
 
 
+class NodeStore(Mapping):
+    """ Nodes used by the ways of an OSM file, in int64 id and float64
+        lat/lon arrays sorted by id. Lookups are a binary search of the ids
+        (searchsorted), so a node costs 24 bytes instead of an object and a
+        dict. Tags are only kept for nodes with NODE_TAGS keys, such as
+        traffic signals and bus stops. Looking up a node id returns a Node
+        (BusStopNode for bus stops) built on the fly; coordinates are best
+        read with getLatLng and getLatLngs.
+    """
+    def __init__(self):
+        self.ids = np.empty(0, np.int64)
+        self.lat = np.empty(0, np.float64)
+        self.lon = np.empty(0, np.float64)
+        # id -> tags, bus stop ids
+        self.tags = {}
+        self.stops = set()
+        # Nodes added since the arrays were last sorted, as blocks of arrays
+        # and lists of the latest ones
+        self._blocks = []
+        self._pending = ([], [], [])
+
+    def add(self, id, lon, lat, tags=None, busStop=False):
+        key = int(id)
+        ids, lats, lons = self._pending
+        ids.append(key)
+        lats.append(lat)
+        lons.append(lon)
+        if len(ids) == BLOCK:
+            self._flush()
+        if busStop:
+            self.stops.add(key)
+        if tags and (busStop or any(k in tags for k in NODE_TAGS)):
+            self.tags[key] = tags
+
+    def _flush(self):
+        ids, lats, lons = self._pending
+        if ids:
+            self._blocks.append((np.array(ids, np.int64),
+                                 np.array(lats, np.float64),
+                                 np.array(lons, np.float64)))
+            self._pending = ([], [], [])
+
+    def freeze(self):
+        """ Sort the nodes added so far in to the lookup arrays. The first
+            of several nodes with the same id is kept.
+        """
+        self._flush()
+        if not self._blocks:
+            return
+        blocks = [(self.ids, self.lat, self.lon)] + self._blocks
+        self._blocks = []
+        ids, lats, lons = [np.concatenate(i) for i in zip(*blocks)]
+        if len(ids) > 1 and not (ids[1:] > ids[:-1]).all():
+            order = np.argsort(ids, kind='mergesort')
+            ids = ids[order]
+            keep = np.concatenate([[True], ids[1:] != ids[:-1]])
+            order = order[keep]
+            ids = ids[keep]
+            lats = lats[order]
+            lons = lons[order]
+        self.ids = ids
+        self.lat = lats
+        self.lon = lons
+
+    def _rows(self, ids):
+        """ Rows of an array of ids, -1 where the id is missing.
+        """
+        self.freeze()
+        rows = self.ids.searchsorted(ids)
+        rows[rows == len(self.ids)] = 0
+        if len(self.ids):
+            rows[self.ids[rows] != ids] = -1
+        else:
+            rows[:] = -1
+        return rows
+
+    def _row(self, id):
+        try:
+            key = int(id)
+        except (TypeError, ValueError):
+            raise KeyError(id)
+        row = self._rows(np.array([key], np.int64))[0]
+        if row < 0:
+            raise KeyError(id)
+        return key, row
+
+    def retain(self, ids):
+        """ Drop every node but the given ones and the bus stops.
+            Input: iterable of node ids
+        """
+        self.freeze()
+        keys = np.fromiter((int(i) for i in ids), np.int64)
+        keep = np.in1d(self.ids, keys)
+        keep |= np.in1d(self.ids, np.fromiter(self.stops, np.int64,
+                                              len(self.stops)))
+        for key in self.ids[~keep].tolist():
+            self.tags.pop(key, None)
+        self.ids = self.ids[keep]
+        self.lat = self.lat[keep]
+        self.lon = self.lon[keep]
+
+    def getLatLng(self, id):
+        """ Input: node id
+            Output: lat, lon tuple
+        """
+        key, row = self._row(id)
+        return float(self.lat[row]), float(self.lon[row])
+
+    def getLatLngs(self, ids):
+        """ Input: list of node ids
+            Output: lat array, lon array
+        """
+        keys = np.fromiter((int(i) for i in ids), np.int64, len(ids))
+        rows = self._rows(keys)
+        if (rows < 0).any():
+            raise KeyError(ids[int(np.argmin(rows))])
+        return self.lat[rows], self.lon[rows]
+
+    def missing(self, ids):
+        """ Input: iterable of node ids
+            Output: list of the ids that are not in the store
+        """
+        ids = list(ids)
+        keys = np.fromiter((int(i) for i in ids), np.int64, len(ids))
+        return [ids[i] for i in np.flatnonzero(self._rows(keys) < 0)]
+
+    def __getitem__(self, id):
+        key, row = self._row(id)
+        if key in self.stops:
+            node = BusStopNode(id, float(self.lon[row]), float(self.lat[row]))
+        else:
+            node = Node(id, float(self.lon[row]), float(self.lat[row]))
+        node.tags.update(self.tags.get(key, ()))
+        return node
+
+    def __contains__(self, id):
+        try:
+            self._row(id)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        self.freeze()
+        for key in self.ids:
+            yield str(key)
+
+    def __len__(self):
+        self.freeze()
+        return len(self.ids)
+
+
+def _tagMatch(tags, key, value):
+    if key not in tags:
+        return False
+    if value is None:
+        return True
+    if isinstance(value, basestring):
+        return tags[key] == value
+    return tags[key] in value
+
+
+class OSMFilter(object):
+    """ Ways to read from an OSM file. The filter is applied while the file
+        is parsed, so the tags and nodes of other ways are never kept.
+        highway: highway tag values to keep, as a list or separated by
+                 pipes (|) as for download_osm
+        require: tags a way must have and exclude: tags it must not have,
+                 each as a list of keys or a dict of key -> value (a string,
+                 a list of values or None for any value)
+        bbox: (left, bottom, right, top) in WGS84; as with download_osm,
+              ways with no node in the box are left out, the others are
+              kept whole
+    """
+    def __init__(self, highway=None, require=None, exclude=None, bbox=None):
+        if isinstance(highway, basestring):
+            highway = highway.split('|')
+        self.highway = None if highway is None else set(highway)
+        self.require = self._tags(require)
+        self.exclude = self._tags(exclude)
+        self.bbox = None if bbox is None else tuple(float(i) for i in bbox)
+        if self.bbox is not None and (len(self.bbox) != 4 or
+                                      self.bbox[0] > self.bbox[2] or
+                                      self.bbox[1] > self.bbox[3]):
+            raise ValueError('bbox must be (left, bottom, right, top)')
+
+    @staticmethod
+    def _tags(tags):
+        if tags is None:
+            return {}
+        if isinstance(tags, basestring):
+            tags = [tags]
+        if not isinstance(tags, Mapping):
+            tags = dict.fromkeys(tags)
+        return dict(tags)
+
+    def match(self, tags):
+        """ Input: way tags
+            Output: True if the way is kept, not counting the bbox
+        """
+        if self.highway is not None and tags.get('highway') not in \
+                self.highway:
+            return False
+        for key, value in self.require.iteritems():
+            if not _tagMatch(tags, key, value):
+                return False
+        for key, value in self.exclude.iteritems():
+            if _tagMatch(tags, key, value):
+                return False
+        return True
+
+    def inBox(self, lon, lat):
+        """ Input: WGS84 lon, lat (numbers or arrays)
+            Output: True where the point is in the bbox
+        """
+        if self.bbox is None:
+            return True
+        left, bottom, right, top = self.bbox
+        return ((lon >= left) & (lon <= right) &
+                (lat >= bottom) & (lat <= top))
+
+
+def _iterElements(source, tag):
+    """ Stream the top level elements of an OSM file with the given tag.
+        Every element is freed once it has been handled, so memory does not
+        grow with the size of the file. Elements marked for deletion are
+        skipped.
+    """
+    context = etree.iterparse(source, events=('end',),
+                              tag=('node', 'way', 'relation'))
+    for _, element in context:
+        if element.tag == tag:
+            if element.get('action', '').startswith('delete'):
+                print "Deleting %s" % (element.get('id'))
+            else:
+                yield element
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    del context
+
+
 class OSM:
-    def __init__(self, filename_or_stream):
-        """ File can be either a filename or stream/file object."""
-        nodes = {}
+    def __init__(self, filename_or_stream, osm_filter=None):
+        """ File can be either a filename or stream/file object.
+            The file is read twice: the first pass keeps the ways that
+            osm_filter (an OSMFilter, or highway tag values separated by
+            pipes) matches and the node ids they use, the second keeps the
+            coordinates of those nodes and of bus stops only.
+        """
+        if osm_filter is None:
+            osm_filter = OSMFilter()
+        elif not isinstance(osm_filter, OSMFilter):
+            osm_filter = OSMFilter(highway=osm_filter)
+        source = filename_or_stream
+        spool = None
+        start = 0
+        if not isinstance(source, basestring):
+            try:
+                start = source.tell()
+            except (AttributeError, IOError):
+                # Downloads can only be read once, keep a copy for the
+                # second pass
+                spool = source = tempfile.TemporaryFile()
+                shutil.copyfileobj(filename_or_stream, spool)
+                spool.seek(start)
+        self.BsCount = 0
         ways = {}
-	busStops = {} # these are from NonWayNodes
-        superself = self
-	BsCount = 0
-
-        class OSMHandler(object):
-    	    def __init__(self, creator=None):
-	    	self.creator = creator
-		creator.BsCount = 0
-
-            @classmethod
-            def start(self, name, attrs):
-    	    	try:
-                	if attrs['action'].startswith("delete"):
-                    		print "Deleting %s" %(attrs['id'])
-				return  # ignore this element 
-			pass
-    	    	except:
-                	if name == 'node':
-                    		self.currElem = Node(attrs['id'], float(attrs['lon']), float(attrs['lat']))
-                    		self.currElem.tags.update({'addBusstop': False})
-                	elif name == 'way':
-                    		self.currElem = Way(attrs['id'], superself)
-				self.saveFirstNode = True
-                    		self.currElem.tags.update({'addBusstop': False})
-                	elif name == 'tag':
-				if ((gIncBusStop == True) and ( (type(self.currElem) == Node) and attrs['v'] == 'bus_stop')):
-					print 'Add bus stop node %s ' %(self.currElem.id)
-                    			self.currElem.tags.update({'addBusstop': True})
-				elif ((gIncBusStop == True) and ( isinstance(self.currElem, Way) and attrs['v'] == 'bus_stop')): # sometimes, busstops were found marked on a nd referred to by a way 
-					print 'Found Way/busstop'
-                    			lastitm = self.currElem.nds[-1]
-                    			self.currElem.nds.remove(lastitm)
-                    			self.currElem.tags.update({'addBusstop': True})
-				pass
-                    		self.currElem.tags[attrs['k']] = attrs['v']
-				pass
-                	elif name == 'nd':
-                  		self.currElem.nds.append(attrs['ref'])
-	    		pass
-
-            @classmethod
-            def end(self, name):
-                if name == 'node':
-                    newNode = tmpNode = self.currElem
-		    if (tmpNode.tags.has_key('addBusstop')  and (tmpNode.tags['addBusstop']  == True)):
-				if ( tmpNode.tags.has_key('asset_ref')):
-					superself.BsCount += 1
-					newNode = BusStopNode(tmpNode.id, float(tmpNode.lon), float(tmpNode.lat) )
-					newNode.tags.update(tmpNode.tags)
-					#print 'In end(): node %s %s at %f %f' % (newNode.id, newNode.tags['asset_ref'], newNode.lat, newNode.lon)
-				else:
-					print 'Bus stop without bus stop id -- skip'
-				pass
-		    pass
-                    nodes[self.currElem.id] = newNode
-                elif name == 'way':
-                    ways[self.currElem.id] = self.currElem
-
-            @classmethod
-            def close(self):
-                pass
-
-        parser = etree.XMLParser(remove_blank_text=True, target=OSMHandler(self))
-        etree.parse(filename_or_stream, parser)
-        self.nodes = nodes
-        #print '++Num of nodes is %d' %(len(self.nodes))
-        self.ways = ways
         # count times each node is used
-        node_histogram = dict.fromkeys(self.nodes.keys(), 0)
-        for way in self.ways.values():
+        node_histogram = {}
+        for element in _iterElements(source, 'way'):
+            if not osm_filter.match(dict((i.get('k'), i.get('v')) for i in
+                                         element.iterchildren('tag'))):
+                continue
+            way = Way(element.get('id'), self)
+            way.tags['addBusstop'] = False
+            for child in element:
+                if child.tag == 'nd':
+                    way.nds.append(child.get('ref'))
+                elif child.tag == 'tag':
+                    # sometimes, busstops were found marked on a nd
+                    # referred to by a way
+                    if gIncBusStop and child.get('v') == 'bus_stop':
+                        print 'Found Way/busstop'
+                        way.nds.pop()
+                        way.tags['addBusstop'] = True
+                    way.tags[child.get('k')] = child.get('v')
+            # a way with only one node is left out of the osm collection
             if len(way.nds) < 2:
-            # if a way has only one node, delete it out of the osm collection
-                del self.ways[way.id]
-            else:
-                for node in way.nds:
-                    node_histogram[node] += 1
+                continue
+            ways[way.id] = way
+            for node in way.nds:
+                node_histogram[node] = node_histogram.get(node, 0) + 1
+        if not isinstance(source, basestring):
+            source.seek(start)
+        nodes = NodeStore()
+        for element in _iterElements(source, 'node'):
+            id = element.get('id')
+            tags = dict((i.get('k'), i.get('v'))
+                        for i in element.iterchildren('tag'))
+            lon = float(element.get('lon'))
+            lat = float(element.get('lat'))
+            busStop = False
+            if (gIncBusStop and 'bus_stop' in tags.values() and
+                    osm_filter.inBox(lon, lat)):
+                print 'Add bus stop node %s ' % (id)
+                if 'asset_ref' in tags:
+                    self.BsCount += 1
+                    tags['addBusstop'] = busStop = True
+                else:
+                    print 'Bus stop without bus stop id -- skip'
+            if busStop or id in node_histogram:
+                nodes.add(id, lon, lat, tags, busStop)
+        if spool is not None:
+            spool.close()
+        nodes.freeze()
+        missing = nodes.missing(node_histogram)
+        if missing:
+            raise KeyError('Ways use nodes that are not in the file: %s' %
+                           (', '.join(sorted(missing)[:10])))
+        if osm_filter.bbox is not None:
+            self._clip(ways, nodes, node_histogram, osm_filter)
+        self.nodes = nodes
         # use that histogram to split all ways, replacing the member set of
-        # ways
+        # ways; pieces maps the id of every way read to its pieces, in order
         new_ways = {}
-        for id, way in self.ways.iteritems():
+        self.pieces = {}
+        for id, way in ways.iteritems():
             split_ways = way.split(node_histogram)
             for split_way in split_ways:
                 new_ways[split_way.id] = split_way
+            self.pieces[id] = [i.id for i in split_ways]
         self.ways = new_ways
 
-        #print '--Num of nodes is %d' %(len(self.nodes))
-        #print '--Num of bus stops is %d' %(self.BsCount)
+    def _clip(self, ways, nodes, node_histogram, osm_filter):
+        """ Leave out the ways with no node in the bbox, and the nodes that
+            only they used.
+        """
+        ids = list(ways)
+        counts = [len(ways[i].nds) for i in ids]
+        if not ids:
+            nodes.retain([])
+            return
+        lat, lon = nodes.getLatLngs([n for i in ids for n in ways[i].nds])
+        inside = np.add.reduceat(osm_filter.inBox(lon, lat).astype(int),
+                                 np.cumsum([0] + counts[:-1]))
+        for i in np.flatnonzero(inside == 0):
+            for node in ways[ids[i]].nds:
+                node_histogram[node] -= 1
+                if not node_histogram[node]:
+                    del node_histogram[node]
+            del ways[ids[i]]
+        nodes.retain(node_histogram)
 
-		
 #read_osm("map.osm")
@@ -4,6 +4,7 @@ from vissim_objs import Vissim
 import networkx as nx
 from osm_to_graph import read_osm
 from osm_to_graph import BusStopNode
+from osm_to_graph import OSMFilter
 from collections import OrderedDict
 import geo_math as geo
 import math
@@ -32,21 +33,20 @@ def stringify(iterable):
                                                                                 
  
 class OSM(Vissim):
-    def __init__(self, osmFile ):
-
+    def __init__(self, osmFile, osmFilter=None):
+        """ Convert an OSM file to a VISSIM network. Only the ways that
+            osmFilter (an OSMFilter, by default the ways of roadTypes)
+            matches are read.
+        """
         self.includeBusStops = '--include-bus-stops' in sys.argv  #RV
-        self.G, self.osm = read_osm(osmFile)
-	#RV
-	c = 0
-    	for n in self.osm.nodes:
-		if (type(self.osm.nodes[n]) is BusStopNode):
-			c += 1
-		pass
-	pass
-	print "Number of bs nodes is %d" %(c)
-        self.v = Vissim()
         self.roadTypes = ['motorway', 'motorway_link', 'primary', 'secondary',
                           'tertiary', 'traffic_signals', 'bus_stop']
+        if osmFilter is None:
+            osmFilter = OSMFilter(highway=self.roadTypes)
+        self.G, self.osm = read_osm(osmFile, osm_filter=osmFilter)
+	#RV
+	print "Number of bs nodes is %d" %(len(self.osm.nodes.stops))
+        self.v = Vissim()
         self.refLat, self.refLng = self.getRefLatLng()
         self.refX, self.refY = self.latLngToMeters(self.refLat, self.refLng)
         self.intersections = self.createIntersectionDict()
@@ -85,8 +85,7 @@ class OSM(Vissim):
             Input: Graph
             Output: lat, long tuple
         """
-        latlng = self.G.node.itervalues().next()
-        return latlng['lat'], latlng['lon']
+        return self.getLatLng(next(self.G.nodes_iter()))
 
     # Boolean helper functions
     def isOneway(self, attr):
@@ -190,12 +189,12 @@ class OSM(Vissim):
             Output: dictionary of intersection attributes
         """
         intersection = {}
-        nodePoint = (self.G.node[node]['lat'], self.G.node[node]['lon'])
+        nodePoint = self.getLatLng(node)
         for n in self.G.successors(node):
             attr = self.G.edge[node][n]
             if attr['highway'] not in self.roadTypes:
                 continue
-            nPoint = (self.G.node[n]['lat'], self.G.node[n]['lon'])
+            nPoint = self.getLatLng(n)
             intersection[n] = {'beginning': True, 'lanes':
                                attr.get('lanes', 1), 'bearing':
                                self.compassBearing(nodePoint, nPoint),
@@ -206,7 +205,7 @@ class OSM(Vissim):
             attr = self.G.edge[n][node]
             if attr['highway'] not in self.roadTypes:
                 continue
-            nPoint = (self.G.node[n]['lat'], self.G.node[n]['lon'])
+            nPoint = self.getLatLng(n)
             intersection[n] = {'beginning': False, 'lanes':
                                attr.get('lanes', 1), 'bearing':
                                self.compassBearing(nodePoint, nPoint),
@@ -698,7 +697,7 @@ class OSM(Vissim):
     def getLatLng(self, n):
         """ Return lat/lng tuple for a given node.
         """
-        return self.G.node[n]['lat'], self.G.node[n]['lon']
+        return self.osm.nodes.getLatLng(n)
 
     def nodeToScaledMeters(self, n):
         """ Apply Mercator scaling factor based on latitude to xy points.
@@ -712,6 +711,21 @@ class OSM(Vissim):
         scaleY = (y - self.refY) / scale
         return (scaleX, scaleY, 0)
 
+    def nodesToScaledMeters(self, nodes):
+        """ nodeToScaledMeters for all the nodes of a way at once.
+            Input: list of nodes
+            Output: list of correctly scaled xy
+        """
+        lat, lng = self.osm.nodes.getLatLngs(nodes)
+        extent = 20015085  # height/width in meters of the VISSIM map
+        x = lng * extent / 180.0
+        y = np.log(np.tan((90 + lat) * math.pi / 360.0)) / (math.pi / 180.0)
+        y = y * extent / 180.0
+        scale = 1 / math.cos(math.radians(self.refLat))
+        scaleX = ((x - self.refX) / scale).tolist()
+        scaleY = ((y - self.refY) / scale).tolist()
+        return [(i, j, 0) for i, j in zip(scaleX, scaleY)]
+
     def nodesToXY(self, attr):
         """ Process links dictionary to calculate proper XY coordinates.
             Input: links dictionary
@@ -720,7 +734,7 @@ class OSM(Vissim):
         width = self.v.defaultWidth
         nodes = attr['nodes']
         #print "#######", nodes		
-        point3D = attr['point3D'] = [self.nodeToScaledMeters(n) for n in nodes]
+        point3D = attr['point3D'] = self.nodesToScaledMeters(nodes)
         #print point3D  		
         		
         # Parallel
@@ -772,18 +786,33 @@ class OSM(Vissim):
             Input: xy dictionary
             Output: modifies vissim object in place
         """
+        records = []
+        taken = set()
         for wayID, attr in self.xy.items():
             point3D = attr['point3D']
             lanes = int(attr['laneNumber']) * [self.v.defaultWidth]
-	    tmp = self.wayIDToVissimLinkNumber(wayID)
-	    try:
-            	self.v.Links.createLink(**{'point3D': point3D, 'lane': lanes,
-                                       'no': tmp})
-	    except:
-		print 'Could not create link for %s' %(tmp)
-		continue
-	pass
-    pass
+            tmp = self.wayIDToVissimLinkNumber(wayID)
+            if not self.isValidLink(tmp, point3D, taken):
+                print 'Could not create link for %s' %(tmp)
+                continue
+            taken.add(int(tmp))
+            records.append({'point3D': point3D, 'lane': lanes, 'no': tmp})
+        self.v.Links.createLinks(records)
+
+    def isValidLink(self, linkNum, point3D, taken):
+        """ Check that a link can be created, so that one bad way does not
+            fail the whole batch.
+            Input: link number, list of x,y,z tuples, numbers already used
+                   by the batch
+            Output: bool
+        """
+        try:
+            num = int(linkNum)
+            [(float(x), float(y), float(z)) for x, y, z in point3D]
+        except (TypeError, ValueError):
+            return False
+        return (isinstance(point3D, list) and num not in taken and
+                num not in self.v.params['link'])
 
     def hasTurn(self, turnLanes, turn):
         """ Check if a turning movement exists at an approach.
@@ -798,66 +827,77 @@ class OSM(Vissim):
         return False
 
     def processTurns(self, fromLink, turnTo, turnLanes, turn):
+        """ Collect the connectors for one turning movement at an approach.
+            Input: from link, turn dict, turn lanes, turning movement
+            Output: list of connector records for Links.createConnectors
+        """
+        records = []
         turns = sum([1 if turn in lane else 0 for lane in turnLanes])
         fromLane = min([i+1 if turn in v else '' for i, v in
                         enumerate(reversed(turnLanes))])
+        fromLanes = len(self.v.Links.getLanes(fromLink))
         for wayID in turnTo[turn]:
-	    #RV
-	    tmp = self.wayIDToVissimLinkNumber(wayID)
-	    print 'Processing wayid old %s new %s' %(wayID, tmp)
-	    try:
-            	attr = self.v.Links._getAttributes('no', tmp)
+            #RV
+            tmp = self.wayIDToVissimLinkNumber(wayID)
+            print 'Processing wayid old %s new %s' %(wayID, tmp)
+            try:
                 toLink = self.v.Links._getAttributes('no', tmp)['no']
                 lanes = len(self.v.Links.getLanes(toLink))
-	    except:
-		print ' Attribute/lanes not found for way %s' %(tmp)
-		continue
-	    pass
+            except KeyError:
+                print ' Attribute/lanes not found for way %s' %(tmp)
+                continue
             if lanes < turns:
                 turns = lanes
             toLane = lanes - turns + 1
-	    try:
-            	self.v.Links.createConnector(fromLink, fromLane, toLink, toLane, turns)
-	    except:
-		print ' creat connector failed ' 
-		continue
-	    pass
+            if (fromLanes < turns or
+                    len(self.v.Links.geometry.points(fromLink)) < 2 or
+                    len(self.v.Links.geometry.points(toLink)) < 2):
+                print ' creat connector failed '
+                continue
+            records.append({'fromLink': fromLink, 'fromLane': fromLane,
+                            'toLink': toLink, 'toLane': toLane,
+                            'lanes': turns})
+        return records
 
     def importConnectors(self):
         """ Create connectors based on xy dictionary.
             Input: xy dictionary
             Output: modifies vissim object in place
         """
+        records = []
         for wayID, attr in self.xy.items():
             if 'turns' in attr:
                 if wayID[-1] == 'B':
                     direction = 'backward'
                 else:
                     direction = 'forward'
-	    	#RV
-	    	tmp = self.wayIDToVissimLinkNumber(wayID)
-		print 'Processing wayid %s' %(tmp)
-		try:
-                	fromLink = self.v.Links._getAttributes('no', tmp)['no']
-		except:
-			print 'Discarding wayID %s' %(tmp)
-			continue
-		pass
+                #RV
+                tmp = self.wayIDToVissimLinkNumber(wayID)
+                print 'Processing wayid %s' %(tmp)
+                try:
+                    fromLink = self.v.Links._getAttributes('no', tmp)['no']
+                except KeyError:
+                    print 'Discarding wayID %s' %(tmp)
+                    continue
                 turnTo = attr['turns']
                 turnLanes = self.getTurnLanes(attr, direction=direction)
                 if len(turnTo['left']) > 0 and self.hasTurn(turnLanes, 'left'):
-                    self.processTurns(fromLink, turnTo, turnLanes, 'left')
+                    records += self.processTurns(fromLink, turnTo, turnLanes,
+                                                 'left')
                 if (len(turnTo['through']) > 0 and
                         self.hasTurn(turnLanes, 'through')):
-                    self.processTurns(fromLink, turnTo, turnLanes, 'through')
+                    records += self.processTurns(fromLink, turnTo, turnLanes,
+                                                 'through')
                 if (len(turnTo['right']) > 0 and
                         self.hasTurn(turnLanes, 'right')):
-                    self.processTurns(fromLink, turnTo, turnLanes, 'right')
+                    records += self.processTurns(fromLink, turnTo, turnLanes,
+                                                 'right')
+        self.v.Links.createConnectors(records)
 
         
     def processBusStops(self):
 	ptStops = []
-    	for n in self.osm.nodes:
+    	for n in sorted(self.osm.nodes.stops):
 		if (type(self.osm.nodes[n]) is BusStopNode):
 			try:
 			    locName = self.osm.nodes[n].tags['location']
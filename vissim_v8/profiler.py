@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+""" Profiler
+    Opt-in instrumentation of a network's object model. While profiling is
+    on, the methods of the network's objects are wrapped per instance to
+    count calls, XPath evaluations, elements scanned and results returned
+    by lookups, and wall time. Nothing is wrapped otherwise, so a network
+    that is not being profiled runs the plain class methods.
+"""
+import inspect
+from functools import partial
+from contextlib import contextmanager
+from timeit import default_timer
+
+# Section methods that parse, copy or serialize XML
+SECTION_METHODS = ('load', 'attach', 'edit', 'write', '_serialize')
+# Lookups and the number of XPath evaluations they make
+LOOKUPS = {
+    '_getElements': lambda attr, value, children=None, edit=False:
+        int(attr != 'no' or bool(children)),
+    '_listAttributes': lambda attr, children=None: 1,
+    '_buildIndex': lambda: 1,
+    '_paramNums': lambda key: 1,
+}
+
+
+def _size(obj, tag=None):
+    """ Number of children of a section.
+    """
+    return sum(1 for i in obj.sections.objects(tag or obj._sectionTag()))
+
+
+def _scanElements(obj, attr, value, children=None, edit=False):
+    # Keyed lookups search the subtree of one object, if anything
+    if attr != 'no':
+        return _size(obj)
+    element = obj.index.get(str(value))
+    if not children or element is None:
+        return 0
+    return sum(1 for i in element.iterdescendants())
+
+
+# Elements each lookup walks: every object of the section for section-wide
+# XPath, the descendants of one object for child paths of keyed lookups
+SCANS = {
+    '_getElements': _scanElements,
+    '_listAttributes': lambda obj, attr, children=None: _size(obj),
+    '_buildIndex': lambda obj: _size(obj),
+    '_paramNums': lambda obj, key: _size(obj, obj._paramSection(key)),
+}
+# Model methods that are not wrapped
+SKIP = ('profile', 'stats')
+
+
+class _Record(object):
+    __slots__ = ('calls', 'time', 'xpath', 'scanned', 'returned', 'depth')
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.xpath = 0
+        self.scanned = 0
+        self.returned = 0
+        self.depth = 0
+
+
+class Profiler(object):
+    """ Counters per method, keyed by 'Class.method'. Time, XPath
+        evaluations, scanned elements and returned results are inclusive: a
+        method is charged for the lookups made by the methods it calls.
+    """
+    def __init__(self):
+        self.records = {}
+        self.stack = []
+        self.patched = []
+        # Set while scans are counted, so their reads are not recorded
+        self.paused = False
+
+    def _wrap(self, name, method, xpath=None, scan=None):
+        record = self.records.setdefault(name, _Record())
+        stack = self.stack
+
+        def wrapper(*args, **kwargs):
+            if self.paused:
+                return method(*args, **kwargs)
+            record.calls += 1
+            record.depth += 1
+            stack.append(record)
+            start = default_timer()
+            try:
+                result = method(*args, **kwargs)
+                if xpath is None:
+                    return result
+                if inspect.isgenerator(result) or not hasattr(result,
+                                                              '__len__'):
+                    # Iterators are counted by reading them in full
+                    result = list(result)
+                    self._count(xpath(*args, **kwargs),
+                                self._scan(scan, args, kwargs), result)
+                    return iter(result)
+                self._count(xpath(*args, **kwargs),
+                            self._scan(scan, args, kwargs), result)
+                return result
+            finally:
+                stack.pop()
+                record.depth -= 1
+                if record.depth == 0:
+                    # Recursive calls are timed once, by the outermost call
+                    record.time += default_timer() - start
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    def _scan(self, scan, args, kwargs):
+        """ Elements walked by a lookup, read with recording paused.
+        """
+        self.paused = True
+        try:
+            return scan(*args, **kwargs)
+        finally:
+            self.paused = False
+
+    def _count(self, xpath, scanned, result):
+        """ Charge XPath evaluations, scanned elements and returned results
+            to every method on the call stack.
+        """
+        for record in set(self.stack):
+            record.xpath += xpath
+            record.scanned += scanned
+            record.returned += len(result)
+
+    def enable(self, objects, sections):
+        """ Wrap the methods of a network's objects and its sections.
+            Input: list of Vissim objects, Sections
+            Output: None
+        """
+        for obj in objects:
+            prefix = type(obj).__name__ + '.'
+            for name, _ in inspect.getmembers(type(obj), inspect.ismethod):
+                if name in SKIP or (name.startswith('_') and
+                                    name not in LOOKUPS):
+                    continue
+                scan = SCANS.get(name)
+                if scan is not None:
+                    scan = partial(scan, obj)
+                setattr(obj, name, self._wrap(prefix + name,
+                                              getattr(obj, name),
+                                              LOOKUPS.get(name), scan))
+                self.patched.append((obj, name))
+        prefix = type(sections).__name__ + '.'
+        for name in SECTION_METHODS:
+            setattr(sections, name,
+                    self._wrap(prefix + name, getattr(sections, name)))
+            self.patched.append((sections, name))
+
+    def disable(self):
+        """ Restore the plain methods.
+        """
+        for obj, name in self.patched:
+            delattr(obj, name)
+        self.patched = []
+
+    @contextmanager
+    def scope(self, objects, sections):
+        """ Profile the objects while the context is open. Nested scopes
+            share the outermost one.
+        """
+        if self.patched:
+            yield self
+            return
+        self.enable(objects, sections)
+        try:
+            yield self
+        finally:
+            self.disable()
+
+    def report(self, reset=False):
+        """ Counters of every method called so far.
+            Input: reset flag (clear the counters after reading them)
+            Output: dict of 'Class.method' -> dict of calls, time (seconds),
+                    xpath, scanned and returned
+        """
+        report = {name: {'calls': r.calls, 'time': r.time,
+                         'xpath': r.xpath, 'scanned': r.scanned,
+                         'returned': r.returned}
+                  for name, r in self.records.items() if r.calls}
+        if reset:
+            # Wrapped methods keep their records, so clear them in place
+            for record in self.records.values():
+                record.calls = record.xpath = record.scanned = 0
+                record.returned = 0
+                record.time = 0.0
+        return report
+
+    def table(self, limit=20):
+        """ Report as text, slowest methods first.
+            Input: number of rows
+            Output: string
+        """
+        rows = sorted(self.report().items(), key=lambda i: -i[1]['time'])
+        lines = ['%-40s %8s %10s %8s %10s %10s' % ('method', 'calls',
+                                                    'time (s)', 'xpath',
+                                                    'scanned', 'returned')]
+        for name, r in rows[:limit]:
+            lines.append('%-40s %8d %10.4f %8d %10d %10d' %
+                         (name, r['calls'], r['time'], r['xpath'],
+                          r['scanned'], r['returned']))
+        return '\n'.join(lines)
@@ -23,15 +23,9 @@ volsDict = {i[0].value: {i[1].value[-2:] + 'L': i[2].value, i[1].value[-2:] +
 v = vissim.Vissim('test_networks/temescal.inpx')
 
 # Update inputs
-for no, demand in inputsDict.items():
-    index = 0
-    v.inputs.updateVol(no, index, demand)
+v.Inputs.updateVols({no: {0: demand} for no, demand in inputsDict.items()})
 
 # Update turn vols
-for routingNum, turns in volsDict.items():
-    for turn, vol in turns.items():
-        if vol == '':
-            continue
-        else:
-            routeNum = v.routing.getRoute(routingNum, 'name', turn)['no']
-            v.routing.updateFlow(routingNum, routeNum, vol)
+flows = [(routingNum, turn, vol) for routingNum, turns in volsDict.items()
+         for turn, vol in turns.items() if vol != '']
+v.StaticRouting.updateFlows(flows, by='name')
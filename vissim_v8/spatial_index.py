@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+""" Spatial Index
+    Uniform grid over the segments of link point sets for nearest, radius and
+    bounding box queries. Queries are answered in the x, y plane; offsets are
+    measured along the link's full x, y, zOffset geometry like
+    Links.getChainages. Edited links are taken out of the grid and put back
+    in to the cells their new segments touch, without a rebuild.
+"""
+import numpy as np
+
+
+class SegmentIndex(object):
+    """ Grid index of link segments. Segments longer than a cell are split
+        in to cell-sized pieces before they are registered, so the grid
+        stays linear in the total length of the network. Segments of links
+        edited after the build are kept apart from the built arrays and
+        looked up in a cell dict.
+        Input: link numbers, (m + 1,) row offsets, (n, 3) coordinates as
+               returned by GeometryStore.columns(), cell size (optional)
+    """
+    def __init__(self, nums, offsets, coords, cellSize=None):
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        self.nums = list(nums)
+        # A segment joins each point to the next one of the same link
+        mask = np.ones(max(len(coords) - 1, 0), dtype=bool)
+        starts = offsets[1:-1]
+        mask[starts[(starts > 0) & (starts < len(coords))] - 1] = False
+        start = np.nonzero(mask)[0]
+        steps = np.sqrt((np.diff(coords, axis=0) ** 2).sum(axis=1))
+        distance = np.concatenate([[0.0], np.cumsum(steps)])
+        self.row = np.searchsorted(offsets, start, side='right') - 1
+        self.segment = start - offsets[self.row]
+        self.chainage = distance[start] - distance[offsets[self.row]]
+        self.length = steps[start]
+        self.a = coords[start, :2]
+        self.b = coords[start + 1, :2]
+        self._buildGrid(cellSize)
+        self.rowOf = {num: i for i, num in enumerate(self.nums)}
+        self.alive = np.ones(len(self.a), dtype=bool)
+        # Segments of edited links, numbered on from the built ones
+        self.extra = {'num': [], 'segment': [], 'chainage': [],
+                      'length': [], 'a': [], 'b': [], 'cells': []}
+        self.extraIds = {}
+        self.extraCells = {}
+        self.lo = np.zeros(2, dtype=np.int64)
+        self.hi = np.array(self.shape, dtype=np.int64) - 1
+
+    def _buildGrid(self, cellSize):
+        """ Register segment pieces in the cells their bounding boxes touch.
+        """
+        a, b = self.a, self.b
+        span = np.sqrt(((b - a) ** 2).sum(axis=1))
+        if cellSize is None:
+            cellSize = np.median(span) if len(span) else 1.0
+        self.cell = float(cellSize) if cellSize > 0 else 1.0
+        if len(a) == 0:
+            self.origin = np.zeros(2)
+            self.shape = (0, 0)
+            self.keys = np.zeros(0, dtype=np.int64)
+            self.bounds = np.zeros(1, dtype=np.int64)
+            self.items = np.zeros(0, dtype=np.int64)
+            return
+        self.origin = np.minimum(a.min(axis=0), b.min(axis=0))
+        item, cx, cy = self._cells(a, b)
+        self.shape = (cx.max() + 1, cy.max() + 1)
+        key = cx * self.shape[1] + cy
+        order = np.lexsort((item, key))
+        key, item = key[order], item[order]
+        keep = np.ones(len(key), dtype=bool)
+        keep[1:] = (key[1:] != key[:-1]) | (item[1:] != item[:-1])
+        key, self.items = key[keep], item[keep]
+        self.keys, first = np.unique(key, return_index=True)
+        self.bounds = np.append(first, len(key))
+
+    def _cells(self, a, b):
+        """ Cells touched by segments.
+            Input: (k, 2) start and end points
+            Output: arrays of segment position, cell x, cell y (a segment is
+                    listed once per cell, possibly more than once)
+        """
+        span = np.sqrt(((b - a) ** 2).sum(axis=1))
+        # Split segments in to pieces no longer than a cell
+        pieces = np.maximum(np.ceil(span / self.cell), 1).astype(np.int64)
+        ids = np.repeat(np.arange(len(a)), pieces)
+        first = np.repeat(np.cumsum(pieces) - pieces, pieces)
+        step = np.arange(len(ids)) - first
+        frac0 = (step / pieces[ids].astype(float))[:, None]
+        frac1 = ((step + 1) / pieces[ids].astype(float))[:, None]
+        p0 = a[ids] + (b - a)[ids] * frac0
+        p1 = a[ids] + (b - a)[ids] * frac1
+        lo = self._cellOf(np.minimum(p0, p1))
+        hi = self._cellOf(np.maximum(p0, p1))
+        # Expand each piece's bounding box in to its cells
+        width = hi[:, 0] - lo[:, 0] + 1
+        counts = width * (hi[:, 1] - lo[:, 1] + 1)
+        item = np.repeat(ids, counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                    counts)
+        cx = np.repeat(lo[:, 0], counts) + local % np.repeat(width, counts)
+        cy = np.repeat(lo[:, 1], counts) + local // np.repeat(width, counts)
+        return item, cx, cy
+
+    def _cellOf(self, points):
+        return np.floor((points - self.origin) / self.cell).astype(np.int64)
+
+    def edited(self):
+        """ Number of segments registered since the grid was built.
+        """
+        return len(self.extra['num'])
+
+    def remove(self, num):
+        """ Take a link's segments out of the grid.
+            Input: link number
+            Output: None
+        """
+        num = str(num)
+        row = self.rowOf.pop(num, None)
+        if row is not None:
+            lo = np.searchsorted(self.row, row, side='left')
+            hi = np.searchsorted(self.row, row, side='right')
+            self.alive[lo:hi] = False
+        for i in self.extraIds.pop(num, []):
+            for cell in self.extra['cells'][i - len(self.a)]:
+                items = self.extraCells[cell]
+                items.discard(i)
+                if not items:
+                    del self.extraCells[cell]
+
+    def update(self, num, points):
+        """ Put a link's new geometry in to the grid, replacing its old
+            segments.
+            Input: link number, (k, 3) array of x, y, zOffset
+            Output: None
+        """
+        num = str(num)
+        self.remove(num)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        if len(points) < 2:
+            return
+        steps = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+        chainage = np.concatenate([[0.0], np.cumsum(steps)[:-1]])
+        a, b = points[:-1, :2], points[1:, :2]
+        item, cx, cy = self._cells(a, b)
+        cells = [set() for i in range(len(a))]
+        for i, x, y in zip(item.tolist(), cx.tolist(), cy.tolist()):
+            cells[i].add((x, y))
+        extra = self.extra
+        first = len(self.a) + len(extra['num'])
+        ids = range(first, first + len(a))
+        for i, segment in enumerate(ids):
+            extra['num'].append(num)
+            extra['segment'].append(i)
+            extra['chainage'].append(chainage[i])
+            extra['length'].append(steps[i])
+            extra['a'].append(a[i])
+            extra['b'].append(b[i])
+            extra['cells'].append(cells[i])
+            for cell in cells[i]:
+                self.extraCells.setdefault(cell, set()).add(segment)
+        self.extraIds[num] = ids
+        self.lo = np.minimum(self.lo, [cx.min(), cy.min()])
+        self.hi = np.maximum(self.hi, [cx.max(), cy.max()])
+
+    def rename(self, old, new):
+        """ Move a link's segments to a new number.
+            Input: old link number, new link number
+            Output: None
+        """
+        old, new = str(old), str(new)
+        if old in self.rowOf:
+            row = self.rowOf.pop(old)
+            self.nums[row] = new
+            self.rowOf[new] = row
+        if old in self.extraIds:
+            ids = self.extraIds.pop(old)
+            for i in ids:
+                self.extra['num'][i - len(self.a)] = new
+            self.extraIds[new] = ids
+
+    def _ends(self, ids):
+        """ End points of segments.
+            Input: segment ids
+            Output: (k, 2) start points, (k, 2) end points
+        """
+        if len(self.extra['num']) == 0:
+            return self.a[ids], self.b[ids]
+        built = ids[ids < len(self.a)]
+        added = ids[ids >= len(self.a)] - len(self.a)
+        a = [self.a[built]] + [np.array([self.extra['a'][i] for i in added])
+                               .reshape(-1, 2)]
+        b = [self.b[built]] + [np.array([self.extra['b'][i] for i in added])
+                               .reshape(-1, 2)]
+        return np.concatenate(a), np.concatenate(b)
+
+    def _candidates(self, x0, x1, y0, y1):
+        """ Segments registered in a block of cells.
+            Input: cell index ranges (inclusive)
+            Output: array of segment ids
+        """
+        ids = np.zeros(0, dtype=np.int64)
+        bx0, by0 = max(x0, 0), max(y0, 0)
+        bx1, by1 = min(x1, self.shape[0] - 1), min(y1, self.shape[1] - 1)
+        if bx0 <= bx1 and by0 <= by1:
+            cx, cy = np.meshgrid(np.arange(bx0, bx1 + 1),
+                                 np.arange(by0, by1 + 1))
+            ids = self._lookup((cx * self.shape[1] + cy).ravel())
+            ids = ids[self.alive[ids]]
+        if self.extraCells:
+            added = set()
+            cells = self.extraCells
+            if (x1 - x0 + 1) * (y1 - y0 + 1) < len(cells):
+                # Probe the cells of a small block instead of every edit
+                for cx in xrange(x0, x1 + 1):
+                    for cy in xrange(y0, y1 + 1):
+                        items = cells.get((cx, cy))
+                        if items:
+                            added.update(items)
+            else:
+                for (cx, cy), items in cells.items():
+                    if x0 <= cx <= x1 and y0 <= cy <= y1:
+                        added.update(items)
+            if added:
+                ids = np.concatenate([ids, sorted(added)]).astype(np.int64)
+        return ids
+
+    def _lookup(self, keys):
+        pos = np.searchsorted(self.keys, keys)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == keys[found]
+        pos = pos[found]
+        if len(pos) == 0:
+            return np.zeros(0, dtype=np.int64)
+        slices = [self.items[self.bounds[i]:self.bounds[i + 1]] for i in pos]
+        return np.unique(np.concatenate(slices))
+
+    def _project(self, point, ids):
+        """ Closest points of segments to a point.
+            Input: x, y point, segment ids
+            Output: distances, fractions along the segments
+        """
+        a, b = self._ends(ids)
+        d = b - a
+        norm = (d ** 2).sum(axis=1)
+        t = ((point - a) * d).sum(axis=1) / np.where(norm > 0, norm, 1.0)
+        t = np.clip(np.where(norm > 0, t, 0.0), 0.0, 1.0)
+        closest = a + d * t[:, None]
+        return np.sqrt(((closest - point) ** 2).sum(axis=1)), t
+
+    def _hit(self, i, t, distance):
+        if i >= len(self.a):
+            i -= len(self.a)
+            extra = self.extra
+            return {'link': extra['num'][i],
+                    'segment': extra['segment'][i],
+                    'offset': float(extra['chainage'][i] +
+                                    t * extra['length'][i]),
+                    'distance': float(distance)}
+        return {'link': self.nums[self.row[i]],
+                'segment': int(self.segment[i]),
+                'offset': float(self.chainage[i] + t * self.length[i]),
+                'distance': float(distance)}
+
+    def _nearest(self, point):
+        cx, cy = self._cellOf(point)
+        (lx, ly), (hx, hy) = self.lo, self.hi
+        # Rings closer than the grid hold no segments
+        r = max(0, lx - cx, ly - cy, cx - hx, cy - hy)
+        last = max(cx - lx, cy - ly, hx - cx, hy - cy)
+        best = None
+        while r <= last:
+            if r == 0:
+                ids = self._candidates(cx, cx, cy, cy)
+            else:
+                ids = np.concatenate([
+                    self._candidates(cx - r, cx + r, cy - r, cy - r),
+                    self._candidates(cx - r, cx + r, cy + r, cy + r),
+                    self._candidates(cx - r, cx - r, cy - r + 1, cy + r - 1),
+                    self._candidates(cx + r, cx + r, cy - r + 1, cy + r - 1)])
+            if len(ids):
+                dist, t = self._project(point, ids)
+                i = np.argmin(dist)
+                if best is None or dist[i] < best[2]:
+                    best = (ids[i], t[i], dist[i])
+            # Everything within r cells of the point has been seen
+            if best is not None and best[2] <= r * self.cell:
+                break
+            r += 1
+        if best is None:
+            return None
+        return self._hit(*best)
+
+    def nearest(self, points):
+        """ Nearest segment to each point.
+            Input: list of x, y points
+            Output: list of hit dicts with link, segment, offset along the
+                    link and distance (None if the index is empty)
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return [self._nearest(point) for point in points]
+
+    def radius(self, points, radius):
+        """ Segments within a distance of each point.
+            Input: list of x, y points, radius
+            Output: list of lists of hit dicts, nearest first
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        results = []
+        for point in points:
+            x0, y0 = self._cellOf(point - radius)
+            x1, y1 = self._cellOf(point + radius)
+            ids = self._candidates(x0, x1, y0, y1)
+            dist, t = self._project(point, ids)
+            inside = np.nonzero(dist <= radius)[0]
+            inside = inside[np.argsort(dist[inside], kind='mergesort')]
+            results.append([self._hit(ids[i], t[i], dist[i])
+                            for i in inside])
+        return results
+
+    def bbox(self, boxes):
+        """ Segments crossing each bounding box. The offset is where the
+            segment enters the box.
+            Input: list of (xmin, ymin, xmax, ymax) boxes
+            Output: list of lists of hit dicts (distance 0)
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        results = []
+        for box in boxes:
+            x0, y0 = self._cellOf(box[:2])
+            x1, y1 = self._cellOf(box[2:])
+            ids = self._candidates(x0, x1, y0, y1)
+            a, b = self._ends(ids)
+            d = b - a
+            # Liang-Barsky clipping of each segment against the box
+            t0 = np.zeros(len(ids))
+            t1 = np.ones(len(ids))
+            ok = np.ones(len(ids), dtype=bool)
+            for axis in (0, 1):
+                for p, q in ((-d[:, axis], a[:, axis] - box[axis]),
+                             (d[:, axis], box[axis + 2] - a[:, axis])):
+                    parallel = p == 0
+                    ok &= ~(parallel & (q < 0))
+                    r = q / np.where(parallel, 1.0, p)
+                    t0 = np.where(~parallel & (p < 0), np.maximum(t0, r), t0)
+                    t1 = np.where(~parallel & (p > 0), np.minimum(t1, r), t1)
+            hits = np.nonzero(ok & (t0 <= t1))[0]
+            hits = hits[np.argsort(ids[hits], kind='mergesort')]
+            results.append([self._hit(ids[i], t0[i], 0.0) for i in hits])
+        return results
@@ -1,4 +1,9 @@
+import os
+import shutil
+import tempfile
 import unittest
+import urllib
+from collections import OrderedDict
 import vissim_v8 as vissim
 
 network_path = 'test_networks/Busmall.inpx'
@@ -7,7 +12,7 @@ osm_path = 'test_networks/temescal.osm'
 class link_unittest(unittest.TestCase):
     def setUp(self):
         self.v = vissim.Vissim(network_path)
-        self.links = self.v.links
+        self.links = self.v.Links
         self.maxDiff = None
 
     def test_getLink(self):
@@ -28,6 +33,16 @@ class link_unittest(unittest.TestCase):
                   'vehRecAct': 'true'}
         self.assertEqual(self.links.getLink(1), answer)
 
+    def test_getLinkView(self):
+        link = self.links.getLink(1)
+        with self.assertRaises(TypeError):
+            link['name'] = 'test'
+        self.links.setLink(1, 'name', 'test')
+        self.assertEqual(link['name'], 'test')
+        copy = self.links._getAttributes('no', 1, duplicate=True)
+        self.assertTrue(isinstance(copy, dict))
+        self.assertEqual(copy, link)
+
     def test_getConnector(self):
         answer = {'assumSpeedOncom': '60.000000', 'costPerKm': '0.000000',
                   'direction': 'ALL', 'displayType': '1',
@@ -191,6 +206,35 @@ class link_unittest(unittest.TestCase):
         self.assertEqual(self.links.createConnector(2, 1, 3, 1, 1, **defaults),
                          answer)
 
+    def test_createLinks(self):
+        records = [{'point3D': [(0, 0, 0), (10, 0, 0)], 'lane': [3.5, 3.5]},
+                   {'point3D': [(10, 0, 0), (20, 0, 0)], 'no': '20000'}]
+        num = self.links._getNewNum('link')
+        self.assertEqual(self.links.createLinks(records), [num, '20000'])
+        self.assertEqual(self.links.getLanes(num), [{'width': '3.5'},
+                                                    {'width': '3.5'}])
+        self.assertEqual(self.links.getGeometries(20000),
+                         [{'x': '10', 'y': '0', 'zOffset': '0'},
+                          {'x': '20', 'y': '0', 'zOffset': '0'}])
+        self.assertEqual(self.links._getNewNum('link'), '20001')
+        count = len(list(self.links))
+        self.assertRaises(KeyError, self.links.createLinks,
+                          [{}, {'no': '1'}])
+        self.assertRaises(KeyError, self.links.createLinks,
+                          [{'no': '30000'}, {'no': '30000'}])
+        self.assertEqual(len(list(self.links)), count)
+
+    def test_createConnectors(self):
+        records = [{'fromLink': 2, 'fromLane': 1, 'toLink': 3, 'toLane': 1,
+                    'lanes': 1, 'toPos': '5.000', 'no': '90000'}]
+        self.assertEqual(self.links.createConnectors(records), ['90000'])
+        connector = self.links.getConnector(90000)
+        self.assertEqual(connector['from']['connectLink'], '2')
+        self.assertEqual(connector['to'], {'connectLink': '3',
+                                           'connectLane': '1',
+                                           'pos': '5.000'})
+        self.assertEqual(len(self.links.getGeometries(90000)), 2)
+
     def test_removeLink(self):
         answer = {'showVeh': 'true', 'assumSpeedOncom': '60.000000',
                   'hasOvtLn': 'false', 'costPerKm': '0.000000',
@@ -211,11 +255,128 @@ class link_unittest(unittest.TestCase):
         self.links.removeLink(1)
         self.assertRaises(KeyError, self.links.getLink, 1)
 
+    def test_geometryStore(self):
+        geometry = self.links.geometry
+        self.links.addGeometry(1, [(5, 5, 0)])
+        self.links.updateGeometry(1, 0, (9, 9, 0))
+        points = geometry.points(1)
+        self.assertEqual(points[0].tolist(), [9.0, 9.0, 0.0])
+        self.assertEqual(points[-1].tolist(), [5.0, 5.0, 0.0])
+        self.links.removeLink(2)
+        nums, offsets, coords = geometry.columns()
+        self.assertFalse('2' in nums)
+        self.assertEqual(offsets[-1], len(coords))
+        self.assertEqual(len(offsets), len(list(self.links)) + 1)
+
+    def test_getLinkLengths(self):
+        num = self.links.createLink(point3D=[(0, 0, 0), (3, 4, 0),
+                                             (3, 10, 0)])['no']
+        self.assertAlmostEqual(self.links.getLinkLength(num), 11.0)
+        lengths = self.links.getLinkLengths()
+        self.assertEqual(len(lengths), len(list(self.links)))
+        self.assertAlmostEqual(lengths[num], 11.0)
+        self.assertAlmostEqual(lengths['1'], self.links.getLinkLength(1))
+        chainage = self.links.getChainages([num])[num]
+        self.assertEqual(chainage.tolist(), [0.0, 5.0, 11.0])
+        self.assertRaises(KeyError, self.links.getLinkLengths, [99999])
+
+    def test_getNearestSegment(self):
+        num = self.links.createLink(point3D=[(-5000, -5000, 0),
+                                             (-4990, -5000, 0),
+                                             (-4990, -4980, 0)])['no']
+        hit = self.links.getNearestSegment(-4988, -4990)
+        self.assertEqual((hit['link'], hit['segment']), (num, 1))
+        self.assertAlmostEqual(hit['offset'], 20.0)
+        self.assertAlmostEqual(hit['distance'], 2.0)
+        hits = self.links.getNearestSegments([(-4988, -4990), (-4995, -5001)])
+        self.assertEqual([i['segment'] for i in hits], [1, 0])
+        hits = self.links.getSegmentsInRadius(-4991, -5001, 1.5)
+        self.assertEqual([i['segment'] for i in hits], [0, 1])
+        hits = self.links.getSegmentsInBox(-5001, -5001, -4995, -4995)
+        self.assertEqual([(i['link'], i['offset']) for i in hits], [(num, 0)])
+        self.links.removeLink(num)
+        hit = self.links.getNearestSegment(-4988, -4990)
+        self.assertNotEqual(hit['link'], num)
+
+    def test_segmentIndexEdits(self):
+        index = self.links.geometry.segments()
+        num = self.links.createLink(point3D=[(-5000, -5000, 0),
+                                             (-4990, -5000, 0)])['no']
+        self.links.updateGeometry(num, 1, (-5000, -4990, 0))
+        hit = self.links.getNearestSegment(-4999, -4995)
+        self.assertEqual((hit['link'], hit['offset']), (num, 5.0))
+        self.links.setLink(num, 'no', 70000)
+        hit = self.links.getNearestSegment(-4999, -4995)
+        self.assertEqual(hit['link'], '70000')
+        self.links.removeLink(70000)
+        self.assertEqual(self.links.getSegmentsInBox(-5001, -5001, -4999,
+                                                     -4989), [])
+        # Edits update the cells of the links they touch
+        self.assertIs(self.links.geometry.segments(), index)
+
+    def test_segmentIndexProbes(self):
+        index = self.links.geometry.segments()
+        nums = self.links.createLinks([
+            {'point3D': [(-5000 - 50 * i, -5000, 0),
+                         (-5000 - 50 * i, -4990, 0)]} for i in range(100)])
+        self.assertIs(self.links.geometry.segments(), index)
+
+        class Cells(dict):
+            scans = 0
+
+            def items(self):
+                Cells.scans += 1
+                return dict.items(self)
+        index.extraCells = Cells(index.extraCells)
+        # Small blocks look up their own cells instead of every edited one
+        hit = self.links.getNearestSegment(-5001, -4995)
+        self.assertEqual((hit['link'], hit['distance']), (nums[0], 1.0))
+        self.links.getSegmentsInBox(-5002, -5002, -4998, -4988)
+        self.assertEqual(Cells.scans, 0)
+
+    def test_topology(self):
+        topology = self.links.topology
+        connector = self.links.getConnector(10032)
+        fromLink = connector['from']['connectLink']
+        toLink = connector['to']['connectLink']
+        self.assertTrue(toLink in topology.downstream(fromLink))
+        self.assertTrue(fromLink in topology.upstream(toLink))
+        self.assertEqual(topology.downstream(10032), [toLink])
+        num = self.links.createConnector(1, 1, 36, 1, 1)['no']
+        self.assertTrue('36' in topology.downstream(1))
+        self.assertTrue((num, '36', 1) in topology.downstreamLanes(1, 1))
+        self.assertTrue((num, '1', 1) in topology.upstreamLanes(36, 1))
+        self.links.removeLink(num)
+        self.assertFalse(num in topology.connectors)
+
+    def test_getNewNum(self):
+        num = self.links._getNewNum('link')
+        self.links.createLink()
+        self.assertEqual(self.links._getNewNum('link'), str(int(num) + 1))
+        self.links.removeLink(num)
+        self.assertEqual(self.links._getNewNum('link'), num)
+
+    def test_renumberLink(self):
+        self.links.setLink(1, 'no', 7000)
+        self.assertEqual(self.links.getLink(7000)['no'], '7000')
+        self.assertRaises(KeyError, self.links.getLink, 1)
+
+    def test_renumberRemovedLink(self):
+        length = self.links.getLinkLength(7)
+        points = self.links.geometry.points(7).copy()
+        self.links.removeLink(5)
+        self.links.setLink(7, 'no', 5)
+        self.assertAlmostEqual(self.links.getLinkLength(5), length)
+        self.assertAlmostEqual(self.links.getLinkLengths(['5'])['5'], length)
+        self.assertRaises(KeyError, self.links.getLinkLength, 7)
+        hit = self.links.getNearestSegment(*points[0][:2])
+        self.assertEqual((hit['link'], hit['distance']), ('5', 0.0))
+
 
 class input_unittest(unittest.TestCase):
     def setUp(self):
         self.v = vissim.Vissim(network_path)
-        self.inputs = self.v.inputs
+        self.inputs = self.v.Inputs
 
     def test_getInput(self):
         answer = {'no': '1', 'link': '3', 'name': '', 'anmFlag': 'false'}
@@ -242,6 +403,39 @@ class input_unittest(unittest.TestCase):
                    'cont': 'false', 'volType': 'STOCHASTIC'}]
         self.assertEqual(self.inputs.updateVol(1, 0, '1000.000000'), answer)
 
+    def test_updateVols(self):
+        nums = list(self.inputs)
+        self.assertEqual(self.inputs.updateVols({nums[0]: {0: 100},
+                                                 nums[1]: {'1 0': 200}}), 2)
+        self.assertEqual(self.inputs.getVols(nums[0])[0]['volume'], '100')
+        self.assertEqual(self.inputs.getVols(nums[1])[0]['volume'], '200')
+        volumes = [[float('nan')]] * len(nums)
+        volumes[2] = [300]
+        self.assertEqual(self.inputs.updateVols(volumes), 1)
+        self.assertEqual(self.inputs.getVols(nums[2])[0]['volume'], '300.0')
+        self.assertRaises(IndexError, self.inputs.updateVols,
+                          {nums[0]: {0: 1, 5: 1}})
+        self.assertEqual(self.inputs.getVols(nums[0])[0]['volume'], '100')
+        self.assertRaises(TypeError, self.inputs.updateVols,
+                          OrderedDict([(nums[0], {0: 7}), (nums[1], {0.0: 8})]))
+        self.assertEqual(self.inputs.getVols(nums[0])[0]['volume'], '100')
+
+    def test_clearVols(self):
+        self.assertEqual(self.inputs.clearVols(timeInt='9 9'), 0)
+        self.assertEqual(self.v.sections.dirty, set())
+        comps = {}
+        for num in self.inputs:
+            for vol in self.inputs.getVols(num):
+                comps.setdefault(vol['vehComp'], []).append(num)
+        comp = sorted(comps)[0]
+        self.assertEqual(self.inputs.clearVols(vehComp=comp),
+                         len(comps[comp]))
+        for num in self.inputs:
+            for vol in self.inputs.getVols(num):
+                if vol['vehComp'] == comp:
+                    self.assertEqual(vol['volume'], '0')
+        self.assertEqual(self.inputs.clearVols(timeInt='9 9'), 0)
+
     def test_createInput(self):
         defaults = {'anmFlag': 'false', 'name': 'test', 'no': '6000'}
         answer = {'anmFlag': 'false', 'name': 'test', 'no': '6000',
@@ -258,7 +452,7 @@ class input_unittest(unittest.TestCase):
 class staticrouting_unittest(unittest.TestCase):
     def setUp(self):
         self.v = vissim.Vissim(network_path)
-        self.routing = self.v.routing
+        self.routing = self.v.StaticRouting
 
     def test_getRouting(self):
         answer = {'name': '', 'no': '1', 'anmFlag': 'false', 'pos': '0.000000',
@@ -274,27 +468,27 @@ class staticrouting_unittest(unittest.TestCase):
                          answer)
 
     def test_getVehicleClasses(self):
-        answer = [{'key': '10'}, {'key': '20'}]
+        answer = ['30']
         self.assertEqual(self.routing.getVehicleClasses(10), answer)
 
     def test_setVehicleClasses(self):
-        answer = [{'key': '10'}, {'key': '20'}, {'key': '30'}, {'key': '40'}]
+        answer = ['30', '30', '40']
         classes = [30, 40]
         self.assertEqual(self.routing.setVehicleClasses(10, classes), answer)
 
     def test_getRoutes(self):
-        answer = [{'destLink': '3', 'destPos': '383.900000', 'name': '',
-                   'no': '1', 'relFlow': '2 0:64.000000'},
-                  {'destLink': '1', 'destPos': '208.500000', 'name': '',
-                   'no': '2', 'relFlow': '2 0:4.000000'},
-                  {'destLink': '13', 'destPos': '74.400000', 'name': '',
-                   'no': '3', 'relFlow': '2 0:6.000000'},
-                  {'destLink': '23', 'destPos': '100.600000', 'name': '',
-                   'no': '4', 'relFlow': '2 0:7.000000'},
-                  {'destLink': '4', 'destPos': '336.200000', 'name': '',
-                   'no': '5', 'relFlow': '2 0:17.000000'},
-                  {'destLink': '10', 'destPos': '157.200000', 'name': '',
-                   'no': '6', 'relFlow': '2 0:2.000000'}]
+        answer = {'1': {'destLink': '3', 'destPos': '383.900000', 'name': '',
+                        'no': '1', 'relFlow': '2 0:64.000000'},
+                  '2': {'destLink': '1', 'destPos': '208.500000', 'name': '',
+                        'no': '2', 'relFlow': '2 0:4.000000'},
+                  '3': {'destLink': '13', 'destPos': '74.400000', 'name': '',
+                        'no': '3', 'relFlow': '2 0:6.000000'},
+                  '4': {'destLink': '23', 'destPos': '100.600000', 'name': '',
+                        'no': '4', 'relFlow': '2 0:7.000000'},
+                  '5': {'destLink': '4', 'destPos': '336.200000', 'name': '',
+                        'no': '5', 'relFlow': '2 0:17.000000'},
+                  '6': {'destLink': '10', 'destPos': '157.200000', 'name': '',
+                        'no': '6', 'relFlow': '2 0:2.000000'}}
         self.assertEqual(self.routing.getRoutes(1), answer)
 
     def test_getRoute(self):
@@ -312,6 +506,39 @@ class staticrouting_unittest(unittest.TestCase):
                   'relFlow': '2 0:100', 'name': ''}
         self.assertEqual(self.routing.updateFlow(1, 1, 100), answer)
 
+    def test_updateFlows(self):
+        self.routing.setRoute(1, 2, 'name', 'left')
+        rows = [(1, 1, 100), (1, 3, 50), (2, 1, 25)]
+        self.assertEqual(self.routing.updateFlows(rows), 3)
+        self.assertEqual(self.routing.getRoute(1, 'no', 1)['relFlow'],
+                         '2 0:100')
+        self.assertEqual(self.routing.getRoute(2, 'no', 1)['relFlow'],
+                         '2 0:25')
+        self.assertEqual(self.routing.updateFlows([(1, 'left', 10)],
+                                                  by='name'), 1)
+        self.assertEqual(self.routing.getRoute(1, 'no', 2)['relFlow'],
+                         '2 0:10')
+        self.assertRaises(KeyError, self.routing.updateFlows,
+                          [(1, 1, 5), (1, 999, 5)])
+        self.assertEqual(self.routing.getRoute(1, 'no', 1)['relFlow'],
+                         '2 0:100')
+
+    def test_clearFlows(self):
+        self.assertEqual(self.routing.clearFlows(vehClass=999), 0)
+        self.assertEqual(self.v.sections.dirty, set())
+        self.assertTrue(self.routing.clearFlows(timeInt='2 0') > 0)
+        self.assertEqual(self.routing.getRoute(1, 'no', 1)['relFlow'],
+                         '2 0:0')
+        # One interval is zeroed on its own, all of them collapse to the
+        # first interval as updateFlow(..., 0) does
+        self.routing.setRoute(1, 1, 'relFlow', '2 0:64,3 0:10,4 0:5')
+        self.routing.clearFlows(timeInt='3 0')
+        self.assertEqual(self.routing.getRoute(1, 'no', 1)['relFlow'],
+                         '2 0:64,3 0:0,4 0:5')
+        self.routing.clearFlows()
+        self.assertEqual(self.routing.getRoute(1, 'no', 1)['relFlow'],
+                         '2 0:0')
+
     def test_removeRouting(self):
         answer = {'name': '', 'no': '1', 'anmFlag': 'false', 'pos': '0.000000',
                   'link': '3', 'combineStaRoutDec': 'false',
@@ -328,15 +555,15 @@ class staticrouting_unittest(unittest.TestCase):
         self.assertRaises(KeyError, self.routing.getRoute, 1, 'no', 1)
 
     def test_getRouteSeqs(self):
-        answer = [{'key': '10028'}]
+        answer = ['10028']
         self.assertEqual(self.routing.getRouteSeqs(1, 2), answer)
 
     def test_addRouteSeq(self):
-        answer = [{'key': '10028'}, {'key': '1029'}, {'key': '1030'}]
+        answer = ['10028', '1029', '1030']
         self.assertEqual(self.routing.addRouteSeq(1, 2, [1029, 1030]), answer)
 
     def test_updateRouteSeq(self):
-        answer = [{'key': '100'}]
+        answer = ['100']
         self.assertEqual(self.routing.updateRouteSeq(1, 2, 0, 100), answer)
 
     def test_createRouting(self):
@@ -361,6 +588,395 @@ class staticrouting_unittest(unittest.TestCase):
                          answer)
 
 
+class network_unittest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.v = vissim.Vissim(network_path, lazy=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def test_lazyLoad(self):
+        sections = self.v.sections.byTag
+        self.assertFalse(sections['links'].loaded)
+        self.assertEqual(self.v.Links.getLink(1)['no'], '1')
+        self.assertTrue(sections['links'].loaded)
+        self.assertFalse(sections['vehicleInputs'].loaded)
+        eager = vissim.Vissim(network_path)
+        self.assertEqual(self.v.Links._getNewNum('link'),
+                         eager.Links._getNewNum('link'))
+        self.assertEqual(sorted(self.v.Links), sorted(eager.Links))
+
+    def test_lazyExport(self):
+        filename = os.path.join(self.tmp, 'lazy.inpx')
+        self.v.Links.setLink(1, 'name', 'test')
+        self.v.export(filename, incremental=True)
+        source = self._read(network_path)
+        section = self.v.sections.byTag['vehicleInputs']
+        self.assertTrue(self._read(filename).find(
+            source[section.start:section.end]) > -1)
+        v = vissim.Vissim(filename)
+        self.assertEqual(v.Links.getLink(1)['name'], 'test')
+        self.assertEqual(sorted(v.Inputs), sorted(self.v.Inputs))
+
+    def test_incrementalExport(self):
+        filename = os.path.join(self.tmp, 'incremental.inpx')
+        v = vissim.Vissim(network_path)
+        v.export(filename, incremental=True)
+        self.assertEqual(self._read(filename), self._read(network_path))
+        inputNum = next(iter(v.Inputs))
+        v.Inputs.updateVol(inputNum, 0, 123)
+        v.export(filename, incremental=True)
+        source = self._read(network_path).splitlines()
+        export = self._read(filename).splitlines()
+        self.assertEqual(len(source), len(export))
+        lines = set(source)
+        changed = [i for i in export if i not in lines]
+        self.assertEqual(len(changed), 1)
+        self.assertTrue('volume="123"' in changed[0])
+        # Direct edits to the document are written by a full export
+        v.data.find('links/link').set('name', 'direct')
+        v.export(filename)
+        self.assertEqual(vissim.Vissim(filename).Links.getLink(1)['name'],
+                         'direct')
+
+    def test_snapshotCache(self):
+        cache = os.path.join(self.tmp, 'cache')
+        v = vissim.Vissim(network_path, cache=cache)
+        self.assertFalse(v.sections.lazy)
+        self.assertEqual(len(os.listdir(cache)), 1)
+        cached = vissim.Vissim(network_path, cache=cache)
+        self.assertFalse(cached.sections.lazy)
+        self.assertTrue(cached.sections.byTag['links'].loaded)
+        self.assertTrue(all(i.loaded for i in cached.sections.sections))
+        lazy = vissim.Vissim(network_path, lazy=True, cache=cache)
+        self.assertTrue(lazy.sections.lazy)
+        self.assertFalse(lazy.sections.byTag['links'].loaded)
+        self.assertEqual(dict(lazy.params), dict(v.params))
+        self.assertEqual(dict(cached.params), dict(v.params))
+        self.assertEqual(cached.Links._getNewNum('link'),
+                         v.Links._getNewNum('link'))
+        # Changed file contents must not hit the old snapshot
+        filename = os.path.join(self.tmp, 'changed.inpx')
+        v.Links.createLink()
+        v.export(filename)
+        changed = vissim.Vissim(filename, cache=cache)
+        self.assertFalse(changed.sections.lazy)
+        self.assertEqual(len(os.listdir(cache)), 2)
+
+    def test_scenario(self):
+        inputNum = list(self.v.Inputs)[0]
+        volume = self.v.Inputs.getVols(inputNum)[0]['volume']
+        demand = self.v.scenario()
+        demand.Inputs.updateVol(inputNum, 0, 1234)
+        link = demand.scenario()
+        link.Links.setLink(1, 'name', 'changed')
+        # Only the edited elements are copied, nothing else is
+        self.assertEqual(demand.sections.owned, set())
+        self.assertEqual(link.sections.owned, set())
+        self.assertEqual(len(demand.sections.changes('vehicleInputs')), 1)
+        self.assertEqual(len(link.sections.changes('links')), 1)
+        self.assertEqual(link.sections.changes('vehicleInputs'), [])
+        self.assertIsInstance(link.params['link'], vissim.NumberLayer)
+        self.assertIs(link.Links.geometry.coords,
+                      self.v.Links.geometry.coords)
+        self.assertEqual(self.v.Inputs.getVols(inputNum)[0]['volume'],
+                         volume)
+        self.assertEqual(link.Inputs.getVols(inputNum)[0]['volume'],
+                         '1234')
+        self.assertNotEqual(demand.Links.getLink(1)['name'], 'changed')
+        # Unedited sections are exported from the source file verbatim
+        filename = os.path.join(self.tmp, 'base.inpx')
+        self.v.export(filename, incremental=True)
+        self.assertEqual(self._read(filename), self._read(network_path))
+        filename = os.path.join(self.tmp, 'link.inpx')
+        link.export(filename)
+        reloaded = vissim.Vissim(filename)
+        self.assertEqual(reloaded.Links.getLink(1)['name'], 'changed')
+        self.assertEqual(reloaded.Inputs.getVols(inputNum)[0]['volume'],
+                         '1234')
+
+    def test_exportMany(self):
+        variants = {}
+        for i in range(3):
+            variant = self.v.scenario()
+            variant.Links.setLink(1, 'name', 'variant %d' % (i))
+            variants[os.path.join(self.tmp, '%d.inpx' % (i))] = variant
+        timing = vissim.exportMany(variants, processes=2)
+        self.assertEqual(sorted(timing), sorted(variants))
+        for filename, variant in variants.items():
+            name = variant.Links.getLink(1)['name']
+            self.assertEqual(vissim.Vissim(filename).Links.getLink(1)['name'],
+                             name)
+        # Without fork workers get the changed sections and the source name
+        forked = {i: self._read(i) for i in variants}
+        timing = vissim.exportMany(variants, processes=2, incremental=True,
+                                   fork=False)
+        self.assertEqual(sorted(timing), sorted(variants))
+        for filename in variants:
+            self.assertEqual(self._read(filename), forked[filename])
+
+    def test_diff(self):
+        self.assertEqual(len(vissim.diff(self.v, self.v.scenario())), 0)
+        changed = self.v.scenario()
+        changed.Links.setLink(1, 'name', 'changed')
+        changed.Links.updateGeometry(2, 0, (1, 2, 0))
+        changed.Links.removeLink(3)
+        new = changed.Links.createLink()['no']
+        patch = vissim.diff(self.v, changed)
+        self.assertEqual(patch.changed['links']['1']['attrib'],
+                         {'name': ('', 'changed')})
+        self.assertEqual(patch.changed['links']['2']['children']['geometry']
+                         [1][0], {'x': '1', 'y': '2', 'zOffset': '0'})
+        self.assertEqual(patch.removed['links'], ['3'])
+        self.assertEqual(list(patch.added['links']), [new])
+        # Other edits to the patched network are kept
+        other = vissim.Vissim(network_path)
+        other.Links.setLink(2, 'name', 'other')
+        self.assertEqual(patch.apply(other), 4)
+        self.assertEqual(other.Links.getLink(2)['name'], 'other')
+        self.assertEqual(list(other.Links.geometry.points(2)[0]), [1, 2, 0])
+        self.assertEqual(list(vissim.diff(changed, other).changed['links']),
+                         ['2'])
+        self.assertRaises(KeyError, patch.apply, other)
+
+    def test_validate(self):
+        self.assertEqual(self.v.validate(), [])
+        self.v.PTStop.createptStop(lane='1 1')
+        self.assertEqual(self.v.validate(), [])
+        self.v.Links.setConnector(10028, 'lane', '1 9')
+        self.v.Inputs.setInput(list(self.v.Inputs)[0], 'link', 99999)
+        findings = self.v.validate()
+        self.assertIn({'type': 'link', 'no': '10028',
+                       'field': 'fromLinkEndPt',
+                       'message': 'lanes 9-9 exceed the 1 lanes of link 1'},
+                      findings)
+        self.assertIn({'type': 'vehicleRouteStatic', 'no': ('1', '2'),
+                       'field': 'linkSeq',
+                       'message': 'link 3 does not lead to link 10028'},
+                      findings)
+        self.assertIn('link 99999 does not exist',
+                      [i['message'] for i in findings
+                       if i['type'] == 'vehicleInput'])
+
+    def test_profile(self):
+        with self.v.profile():
+            self.v.Links.getLink(1)
+            self.v.Links.getLink(2)
+            self.v.Inputs.getInput('link', 3)
+        stats = self.v.stats()
+        self.assertEqual(stats['Links.getLink']['calls'], 2)
+        # The first lookup builds the index
+        self.assertEqual(stats['Links._buildIndex']['calls'], 1)
+        self.assertEqual(stats['Links.getLink']['xpath'], 1)
+        # The index build returns every link, each keyed lookup one
+        links = len(list(self.v.Links))
+        self.assertEqual(stats['Links._buildIndex']['returned'], links)
+        self.assertEqual(stats['Links.getLink']['returned'], links + 2)
+        self.assertEqual(stats['Inputs.getInput']['xpath'], 1)
+        # Keyed lookups scan nothing, the index build and XPath lookups
+        # every object of the section
+        self.assertEqual(stats['Links._buildIndex']['scanned'], links)
+        self.assertEqual(stats['Links.getLink']['scanned'], links)
+        self.assertEqual(stats['Inputs.getInput']['scanned'],
+                         len(list(self.v.Inputs)))
+        self.assertGreater(stats['Sections.load']['calls'], 0)
+        # Nothing is recorded once the scope is closed
+        self.assertNotIn('getLink', vars(self.v.Links))
+        self.v.Links.getLink(1)
+        self.assertEqual(self.v.stats(reset=True), stats)
+        self.assertEqual(self.v.stats(), {})
+
+    def test_benchmarks(self):
+        from vissim_v8 import benchmarks
+        results = benchmarks.benchmark('grid', 20, self.tmp)
+        operations = [r['operation'] for r in results]
+        self.assertEqual(operations[:3], ['build', 'load', 'loadLazy'])
+        self.assertIn('export', operations)
+        old = {'results': [dict(r, seconds=1.0) for r in results]}
+        new = {'results': [dict(r, seconds=2.0) for r in results]}
+        self.assertEqual(benchmarks.compare(old, old), [])
+        self.assertEqual(len(benchmarks.compare(old, new)), len(results))
+
+
+class osm_graph_unittest(unittest.TestCase):
+    def setUp(self):
+        # Two primary ways crossing at node 3, a footway and a building
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'map.osm')
+        nodes = ''.join('<node id="%d" lat="37.%d" lon="-122.%d"/>' %
+                        (i, i, i) for i in range(1, 11))
+        with open(self.path, 'w') as f:
+            f.write('<osm version="0.6">' + nodes +
+                    '<node id="11" lat="37.11" lon="-122.11">'
+                    '<tag k="highway" v="traffic_signals"/></node>'
+                    '<way id="1"><nd ref="1"/><nd ref="2"/><nd ref="3"/>'
+                    '<nd ref="4"/><tag k="highway" v="primary"/></way>'
+                    '<way id="2"><nd ref="5"/><nd ref="3"/><nd ref="11"/>'
+                    '<tag k="highway" v="primary"/>'
+                    '<tag k="oneway" v="-1"/></way>'
+                    '<way id="3"><nd ref="4"/><nd ref="6"/>'
+                    '<tag k="highway" v="footway"/></way>'
+                    '<way id="4"><nd ref="7"/><nd ref="8"/><nd ref="9"/>'
+                    '<tag k="building" v="yes"/></way></osm>')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_read_osm(self):
+        from vissim_v8 import osm_to_graph
+        G, osm = osm_to_graph.read_osm(self.path, highway_cat='primary')
+        # Nodes of other ways and loose nodes are not kept
+        self.assertEqual(sorted(osm.nodes), ['1', '11', '2', '3', '4', '5'])
+        self.assertEqual(sorted(osm.ways), ['1-0', '1-1', '2-0', '2-1'])
+        self.assertEqual(osm.ways['1-1'].nds, ['3', '4'])
+        self.assertEqual(osm.nodes['11'].tags, {'highway': 'traffic_signals'})
+        self.assertTrue(G.has_edge('11', '3'))
+        self.assertEqual(osm.nodes.getLatLng('5'), (37.5, -122.5))
+        # Downloads can only be read once and give the same result; the
+        # building and its nodes are skipped while parsing
+        G2, osm2 = osm_to_graph.read_osm(urllib.urlopen('file://' +
+                                                        self.path))
+        self.assertEqual(sorted(osm2.nodes),
+                         ['1', '11', '2', '3', '4', '5', '6'])
+        self.assertEqual(len(osm2.ways), 5)
+
+    def test_splitWay(self):
+        from vissim_v8 import osm_to_graph
+        way = osm_to_graph.Way('7', None)
+        # Longer than the recursion limit, shared at every third node
+        way.nds = [str(i) for i in range(3001)]
+        shared = dict((n, 2 if i % 3 == 0 else 1)
+                      for i, n in enumerate(way.nds))
+        pieces = way.split(shared)
+        self.assertEqual(len(pieces), 1000)
+        self.assertEqual(pieces[1].nds, ['3', '4', '5', '6'])
+        self.assertEqual((pieces[1].id, pieces[1].parent, pieces[1].span),
+                         ('7-1', '7', (3, 6)))
+        self.assertEqual(pieces[-1].span, (2997, 3000))
+        G, osm = osm_to_graph.read_osm(self.path)
+        self.assertEqual(osm.pieces['1'], ['1-0', '1-1'])
+        self.assertEqual(osm.ways['2-1'].span, (1, 2))
+
+    def test_osmFilter(self):
+        from vissim_v8 import osm_to_graph
+        read = lambda **kwargs: osm_to_graph.read_osm(
+            self.path, only_roads=False,
+            osm_filter=osm_to_graph.OSMFilter(**kwargs))[1]
+        osm = read(highway='primary', exclude={'oneway': '-1'})
+        self.assertEqual(sorted(osm.ways), ['1-0'])
+        self.assertEqual(sorted(osm.nodes), ['1', '2', '3', '4'])
+        osm = read(require=['building'])
+        self.assertEqual(sorted(osm.nodes), ['7', '8', '9'])
+        # Ways that touch the box are kept whole, so way 1 is no longer
+        # split where way 2 crossed it
+        osm = read(bbox=(-122.45, 37.35, -122.35, 37.45))
+        self.assertEqual(sorted(osm.ways), ['1-0', '3-0'])
+        self.assertEqual(sorted(osm.nodes), ['1', '2', '3', '4', '6'])
+        with self.assertRaises(ValueError):
+            osm_to_graph.OSMFilter(bbox=(1, 2, 0, 3))
+        with self.assertRaises(ValueError):
+            osm_to_graph.read_osm(self.path, highway_cat='primary',
+                                  osm_filter=osm_to_graph.OSMFilter())
+
+    def test_tileStore(self):
+        from vissim_v8 import osm_to_graph, osm_tiles
+        fetched = []
+
+        def fetcher(*args):
+            fetched.append(args[:4])
+            return osm_tiles.fileFetcher(self.path)(*args)
+        store = osm_tiles.TileStore(os.path.join(self.tmp, 'tiles'), fetcher,
+                                    tileSize=0.25)
+        self.assertEqual(store.tiles(-122.5, 37.0, -122.25, 37.25),
+                         [(-490, 148)])
+        self.assertEqual(store.tileBox((-490, 148)),
+                         (-122.5, 37.0, -122.25, 37.25))
+        # Ways 1 and 2 are in several tiles and are merged once
+        stream = store.open(-122.6, 37.0, -122.0, 37.6, 'primary|footway')
+        self.assertEqual(len(fetched), 9)
+        G, osm = osm_to_graph.read_osm(stream)
+        G2, osm2 = osm_to_graph.read_osm(self.path,
+                                         highway_cat='primary|footway')
+        self.assertEqual(sorted(osm.ways), sorted(osm2.ways))
+        self.assertEqual(list(osm.nodes), list(osm2.nodes))
+        self.assertEqual(sorted(G.edges()), sorted(G2.edges()))
+        # Overlapping areas reuse the stored tiles
+        store.open(-122.4, 37.2, -122.1, 37.4, 'primary|footway')
+        self.assertEqual(len(fetched), 9)
+        store.open(-122.4, 37.2, -122.1, 37.4, 'primary')
+        self.assertEqual(len(fetched), 13)
+
+    def test_download_osm(self):
+        import BaseHTTPServer
+        import threading
+        from vissim_v8 import osm_to_graph, osm_tiles
+        requests = []
+        path = self.path
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests.append(self.path)
+                self.send_response(500 if 'motorway' in self.path else 200)
+                self.end_headers()
+                with open(path) as f:
+                    self.wfile.write(f.read())
+
+            def log_message(self, *args):
+                pass
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = ('http://127.0.0.1:%d/%%(highway)s/%%(left)f,%%(bottom)f,'
+                   '%%(right)f,%%(top)f' % (server.server_port))
+            store = osm_tiles.TileStore(os.path.join(self.tmp, 'tiles'),
+                                        osm_tiles.urlFetcher(url),
+                                        tileSize=0.25)
+            for i in range(2):
+                G, osm = osm_to_graph.read_osm(osm_to_graph.download_osm(
+                    -122.6, 37.0, -122.0, 37.6, 'primary', cache=store))
+                self.assertEqual(len(requests), 9)
+            self.assertIn('/primary/-122.500000,37.000000,-122.250000,'
+                          '37.250000', requests)
+            # The server ignores the query, the building is left out
+            self.assertEqual(len(osm.ways), 5)
+            with self.assertRaises(IOError):
+                osm_to_graph.download_osm(-122.6, 37.0, -122.0, 37.6,
+                                          'motorway', cache=store)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_nodeStore(self):
+        from vissim_v8 import osm_to_graph
+        nodes = osm_to_graph.NodeStore()
+        nodes.add('30', -122.3, 37.3, {'highway': 'traffic_signals'})
+        nodes.add('10', -122.1, 37.1, {'name': 'corner'})
+        nodes.add('20', -122.2, 37.2, {'highway': 'bus_stop'}, busStop=True)
+        nodes.add('10', 0.0, 0.0)
+        self.assertEqual(list(nodes), ['10', '20', '30'])
+        self.assertEqual(nodes.getLatLng('30'), (37.3, -122.3))
+        # The first of several nodes with the same id is kept
+        self.assertEqual(nodes.getLatLng(10), (37.1, -122.1))
+        lat, lon = nodes.getLatLngs(['30', '10'])
+        self.assertEqual(lat.tolist(), [37.3, 37.1])
+        self.assertEqual(nodes.missing(['10', '15', '40']), ['15', '40'])
+        with self.assertRaises(KeyError):
+            nodes.getLatLng('15')
+        self.assertNotIn('x', nodes)
+        # Tags are only kept for nodes such as signals and bus stops
+        self.assertEqual(nodes['10'].tags, {})
+        self.assertEqual(nodes['30'].tags, {'highway': 'traffic_signals'})
+        self.assertIs(type(nodes['20']), osm_to_graph.BusStopNode)
+        self.assertEqual(nodes['20'].lon, -122.2)
+
+
 class osm_unittest(unittest.TestCase):
     def setUp(self):
         self.osm = vissim.OSM(osm_path)
@@ -372,6 +988,11 @@ if __name__ == '__main__':
     inputs = unittest.TestLoader().loadTestsFromTestCase(input_unittest)
     routing = (unittest.TestLoader().loadTestsFromTestCase
                (staticrouting_unittest))
+    network = unittest.TestLoader().loadTestsFromTestCase(network_unittest)
+    osm_graph = (unittest.TestLoader().loadTestsFromTestCase
+                 (osm_graph_unittest))
     unittest.TextTestRunner(verbosity=v).run(links)
     unittest.TextTestRunner(verbosity=v).run(inputs)
     unittest.TextTestRunner(verbosity=v).run(routing)
+    unittest.TextTestRunner(verbosity=v).run(network)
+    unittest.TextTestRunner(verbosity=v).run(osm_graph)
@@ -1,51 +1,518 @@
 #!/usr/bin/env python
 """ VISSIM Objects
     The following objects are defined in the library:
+    AttributeView - read-only view of an element's attributes
+    Params - registry of object numbers in use
+    NumberLayer - set of numbers kept as changes to a shared set
+    IndexLayer - element index kept as changes to a shared index
+    GeometryStore - columnar link geometry
+    Topology - link and connector adjacency
     Vissim - base network object
+    Scenario - copy-on-write variant of a network
+    exportMany - export many networks in parallel
     Links - network links and connectors
     Input - vehicle demands
     StaticRouting - vehicle routing decisions and routes
 """
+import numpy as np
+import multiprocessing
+import os
+import time
+from hashlib import sha1
 from lxml import etree
-from copy import deepcopy
-from scipy.spatial.distance import cdist
+from collections import Mapping, MutableMapping, MutableSet
 from os import path
 import geo_math as geo
+from inpx_sections import Sections, Overlay, writePieces
+from inpx_cache import SnapshotCache
+from inpx_validate import checkReferences
+from profiler import Profiler
+from spatial_index import SegmentIndex
+
+__all__ = ['AttributeView', 'Params', 'NumberLayer', 'IndexLayer',
+           'GeometryStore', 'Topology', 'Vissim', 'Scenario', 'exportMany',
+           'Links', 'PTStop', 'Inputs', 'StaticRouting']
+
+
+class AttributeView(Mapping):
+    """ Read-only mapping over an element's attributes that avoids copying
+        them on every read. Lane references ('link lane') are presented as
+        connectLink and connectLane. The view is live, so it reflects later
+        changes to the element; use copy() for a snapshot.
+    """
+    def __init__(self, attrib):
+        self._attrib = attrib
+
+    def __getitem__(self, key):
+        attrib = self._attrib
+        if 'lane' in attrib:
+            if key == 'connectLink':
+                return attrib['lane'].split(' ')[0]
+            elif key == 'connectLane':
+                return attrib['lane'].split(' ')[1]
+            elif key == 'lane':
+                raise KeyError(key)
+        return attrib[key]
 
+    def __iter__(self):
+        for key in self._attrib:
+            if key == 'lane':
+                yield 'connectLink'
+                yield 'connectLane'
+            else:
+                yield key
 
-class Vissim(object):
-    def __init__(self, filename=None):
-        if filename is None:
-            here = path.abspath(path.dirname(__file__))
-            self.filename = here + '/default/default.inpx'
-            self.data = self._load(self.filename)
+    def __len__(self):
+        if 'lane' in self._attrib:
+            return len(self._attrib) + 1
+        return len(self._attrib)
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def copy(self):
+        """ Return the attributes as a new dict.
+        """
+        return dict(self.items())
+
+
+class NumberLayer(MutableSet):
+    """ Set of numbers kept as additions to and removals from a base set,
+        which is never changed.
+        Input: base set
+    """
+    def __init__(self, base):
+        self.base = base
+        self.added = set()
+        self.removed = set()
+
+    def __contains__(self, num):
+        return num in self.added or (num in self.base and
+                                     num not in self.removed)
+
+    def __iter__(self):
+        for num in self.base:
+            if num not in self.removed:
+                yield num
+        for num in self.added:
+            yield num
+
+    def __len__(self):
+        return len(self.base) - len(self.removed) + len(self.added)
+
+    def add(self, num):
+        if num in self.base:
+            self.removed.discard(num)
         else:
-            self.filename = filename
-            self.data = self._load(filename)
-        self.params = None
-        self._getParams()
-        #print self._getParams()
-        self.Links = Links(self.data, self.params)
-        self.PTStop = PTStop(self.data, self.params)
-        self.Inputs = Inputs(self.data, self.params)
-        self.StaticRouting = StaticRouting(self.data, self.params)
-        self.defaultWidth = 3.6
+            self.added.add(num)
 
-    def _load(self, filename):
-        """ Load XML file """
-        parser = etree.XMLParser(remove_blank_text=True)
-        return etree.parse(filename, parser)
+    def discard(self, num):
+        if num in self.base:
+            self.removed.add(num)
+        else:
+            self.added.discard(num)
+
+
+class IndexLayer(MutableMapping):
+    """ Element index kept as changes to a base index, which is never
+        changed. Keys of the base that were removed or set again are hidden.
+        Input: base dict of number -> element
+    """
+    def __init__(self, base):
+        self.base = base
+        self.own = {}
+        self.hidden = set()
+
+    def __getitem__(self, key):
+        if key in self.own:
+            return self.own[key]
+        if key in self.hidden:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.own[key] = value
+        if key in self.base:
+            self.hidden.add(key)
+
+    def __delitem__(self, key):
+        if key in self.own:
+            del self.own[key]
+        elif key in self.base and key not in self.hidden:
+            self.hidden.add(key)
+        else:
+            raise KeyError(key)
 
-    def export(self, filename):
-        """ Write XML file to disk """
-        self.filename = filename
-        self.data.write(filename, encoding="UTF-8", standalone=False,
-                        pretty_print=True)
+    def __iter__(self):
+        for key in self.base:
+            if key not in self.hidden:
+                yield key
+        for key in self.own:
+            yield key
+
+    def __len__(self):
+        return len(self.base) - len(self.hidden) + len(self.own)
+
+
+class Params(dict):
+    """ Registry of the object numbers in use, keyed by object type. Kept up
+        to date incrementally as objects are created, removed and renumbered
+        so that new and default numbers can be read without a rescan. Types
+        that have not been registered yet are read through the loader on
+        first use, or layered over the sets of a base registry, which are
+        then shared instead of copied.
+        Input: loader function of object type -> numbers (optional), base
+               Params (optional)
+    """
+    def __init__(self, loader=None, base=None):
+        dict.__init__(self)
+        self.loader = loader
+        self.base = base
+        self.maxNum = {}
+
+    def __missing__(self, key):
+        if self.base is not None:
+            nums = NumberLayer(self.base[key])
+            self[key] = nums
+            self.maxNum[key] = self.base.newNum(key) - 1
+            return nums
+        nums = set() if self.loader is None else set(self.loader(key))
+        self[key] = nums
+        self.maxNum[key] = max(nums) if nums else 0
+        return nums
+
+    def reset(self, paramDict):
+        """ Replace the registry contents.
+            Input: dict of object type -> set of numbers
+            Output: None
+        """
+        self.clear()
+        self.update(paramDict)
+        self.maxNum = {k: max(v) if v else 0 for k, v in paramDict.items()}
+
+    def add(self, key, num):
+        """ Register a number as used.
+            Input: object type, number
+            Output: None
+        """
+        num = int(num)
+        self[key].add(num)
+        if num > self.maxNum[key]:
+            self.maxNum[key] = num
+
+    def discard(self, key, num):
+        """ Release a number.
+            Input: object type, number
+            Output: None
+        """
+        num = int(num)
+        nums = self[key]
+        nums.discard(num)
+        if num == self.maxNum[key]:
+            # Only the removal of the current maximum needs a rescan
+            self.maxNum[key] = max(nums) if nums else 0
+
+    def newNum(self, key):
+        """ Next free number for an object type.
+        """
+        self[key]
+        return self.maxNum[key] + 1
 
-    def _getParams(self):
-        """ Gets VISSIM network object parameters for integrity checks.
+    def defaultNum(self, key):
+        """ First registered number for an object type.
+        """
+        for num in self[key]:
+            return num
+        raise IndexError('No %s numbers in use' % (key))
+
+
+class GeometryStore(object):
+    """ Columnar store of link geometry: one contiguous (n, 3) float64 array
+        of x, y, zOffset rows plus per-link row offsets, for vectorized work
+        across the whole network. Edits are kept per link and merged in to
+        the columns the next time they are read, so a run of edits does not
+        copy the whole array each time.
+        Input: link numbers, (m + 1,) row offsets, (n, 3) coordinates, dict
+               of link number -> row (optional, the numbers and rows are
+               then shared with another store)
+    """
+    def __init__(self, nums=(), offsets=None, coords=None, row=None):
+        if offsets is None:
+            offsets = np.zeros(1, dtype=np.int64)
+        if coords is None:
+            coords = np.zeros((0, 3))
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.coords = np.asarray(coords, dtype=np.float64)
+        if row is None:
+            self.nums = [str(num) for num in nums]
+            self.row = {num: i for i, num in enumerate(self.nums)}
+        else:
+            self.nums = nums
+            self.row = row
+        # Shared numbers and rows are replaced, never changed in place
+        self._shared = row is not None
+        self.pending = {}
+        self.added = []
+        self._segments = None
+
+    @classmethod
+    def fromElement(cls, links):
+        """ Read the geometry of links.
+            Input: iterable of <link> elements
+            Output: GeometryStore
         """
-        params = ['colorDistribution', 'conflictArea', 'desAcceleration',
+        nums = []
+        counts = []
+        values = []
+        for link in links:
+            points = link.findall('geometry/points3D/point3D')
+            nums.append(link.get('no'))
+            counts.append(len(points))
+            for point in points:
+                values.extend((point.get('x'), point.get('y'),
+                               point.get('zOffset', '0')))
+        offsets = np.zeros(len(nums) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        coords = np.array(values, dtype=np.float64).reshape(-1, 3)
+        return cls(nums, offsets, coords)
+
+    def points(self, num):
+        """ Geometry of a single link.
+            Input: link number
+            Output: (k, 3) array of x, y, zOffset
+        """
+        num = str(num)
+        if num in self.pending:
+            points = self.pending[num]
+        elif num in self.row:
+            i = self.row[num]
+            points = self.coords[self.offsets[i]:self.offsets[i + 1]]
+        else:
+            points = None
+        if points is None:
+            raise KeyError('Link %s does not exist' % (num))
+        return points
+
+    def set(self, num, points):
+        """ Replace the geometry of a link, adding the link if it is new.
+            Input: link number, list of x,y,z tuples
+            Output: None
+        """
+        num = str(num)
+        if num not in self.row and num not in self.pending:
+            self.added.append(num)
+        points = np.array(points, dtype=np.float64).reshape(-1, 3)
+        self.pending[num] = points
+        if self._segments is not None:
+            self._segments.update(num, points)
+
+    def remove(self, num):
+        """ Drop a link from the store.
+            Input: link number
+            Output: None
+        """
+        num = str(num)
+        if num in self.row or num in self.pending:
+            self.pending[num] = None
+            if self._segments is not None:
+                self._segments.remove(num)
+
+    def rename(self, old, new):
+        """ Move a link's geometry to a new number.
+            Input: old link number, new link number
+            Output: None
+        """
+        old, new = str(old), str(new)
+        points = self.points(old)
+        if new in self.row or new in self.pending or self._shared:
+            # The number was freed by remove(), its entry takes the points;
+            # shared rows are not renamed in place either
+            self.remove(old)
+            self.set(new, points)
+            return
+        if old in self.row:
+            i = self.row.pop(old)
+            self.nums[i] = new
+            self.row[new] = i
+        else:
+            self.added[self.added.index(old)] = new
+        if old in self.pending:
+            self.pending[new] = self.pending.pop(old)
+        if self._segments is not None:
+            self._segments.rename(old, new)
+
+    def layer(self):
+        """ Store that starts out with this store's geometry and keeps its
+            own edits. The columns, numbers and rows are shared until either
+            store merges its edits.
+            Output: GeometryStore
+        """
+        nums, offsets, coords = self.columns()
+        self._shared = True
+        return GeometryStore(nums, offsets, coords, self.row)
+
+    def columns(self):
+        """ Geometry of every link in columnar form.
+            Output: list of link numbers, (m + 1,) row offsets in to the
+                    (n, 3) coordinate array, coordinate array
+        """
+        if self.pending:
+            self._merge()
+        return self.nums, self.offsets, self.coords
+
+    def segments(self):
+        """ Spatial index over the segments of every link. Edits update
+            the cells of the links they touch; the grid is only built again
+            once more segments were put back in than it was built with.
+            Output: SegmentIndex
+        """
+        if (self._segments is None or
+                self._segments.edited() > len(self._segments.a)):
+            self._segments = SegmentIndex(*self.columns())
+        return self._segments
+
+    def _merge(self):
+        """ Fold pending edits in to the contiguous arrays.
+        """
+        nums = []
+        arrays = []
+        for num in self.nums + self.added:
+            if num in self.pending and self.pending[num] is None:
+                continue
+            arrays.append(self.points(num))
+            nums.append(num)
+        self.offsets = np.zeros(len(nums) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum([len(a) for a in arrays])
+        if arrays:
+            self.coords = np.ascontiguousarray(np.concatenate(arrays))
+        else:
+            self.coords = np.zeros((0, 3))
+        self.nums = nums
+        self.row = {num: i for i, num in enumerate(nums)}
+        self._shared = False
+        self.pending = {}
+        self.added = []
+
+
+class Topology(object):
+    """ Adjacency of links and connectors read from the connector end
+        points: link -> outgoing connectors -> downstream links, and the
+        reverse. Lane-level queries follow the lanes each connector joins.
+    """
+    def __init__(self):
+        # connector -> (from link, from lane, to link, to lane, lanes)
+        self.connectors = {}
+        self.outgoing = {}
+        self.incoming = {}
+
+    @classmethod
+    def fromElement(cls, links):
+        """ Read the connectors among links.
+            Input: iterable of <link> elements
+            Output: Topology
+        """
+        topology = cls()
+        for link in links:
+            topology.add(link)
+        return topology
+
+    def add(self, element):
+        """ Register a connector. Links without end points are ignored.
+            Input: <link> element
+            Output: None
+        """
+        fromPt = element.find('fromLinkEndPt')
+        toPt = element.find('toLinkEndPt')
+        if fromPt is None or toPt is None:
+            return
+        num = element.get('no')
+        fromLink, fromLane = fromPt.get('lane').split(' ')
+        toLink, toLane = toPt.get('lane').split(' ')
+        lanes = len(element.findall('lanes/lane'))
+        self.connectors[num] = (fromLink, int(fromLane), toLink, int(toLane),
+                                lanes)
+        self.outgoing.setdefault(fromLink, set()).add(num)
+        self.incoming.setdefault(toLink, set()).add(num)
+
+    def remove(self, num):
+        """ Drop a connector.
+            Input: connector number
+            Output: None
+        """
+        connector = self.connectors.pop(str(num), None)
+        if connector is not None:
+            self.outgoing[connector[0]].discard(str(num))
+            self.incoming[connector[2]].discard(str(num))
+
+    def downstream(self, linkNum):
+        """ Links reached from a link through its outgoing connectors. For
+            a connector this is the link it leads to.
+            Input: link number
+            Output: sorted list of link numbers
+        """
+        linkNum = str(linkNum)
+        if linkNum in self.connectors:
+            return [self.connectors[linkNum][2]]
+        return sorted({self.connectors[i][2] for i in
+                       self.outgoing.get(linkNum, ())}, key=int)
+
+    def upstream(self, linkNum):
+        """ Links that feed a link through its incoming connectors. For a
+            connector this is the link it starts from.
+            Input: link number
+            Output: sorted list of link numbers
+        """
+        linkNum = str(linkNum)
+        if linkNum in self.connectors:
+            return [self.connectors[linkNum][0]]
+        return sorted({self.connectors[i][0] for i in
+                       self.incoming.get(linkNum, ())}, key=int)
+
+    def downstreamLanes(self, linkNum, lane):
+        """ Lanes reached from a lane. For a link these are the lanes at
+            the far end of its outgoing connectors; for a connector, the
+            lane of the link it leads to.
+            Input: link number, lane number
+            Output: sorted list of (connector, link, lane) tuples
+        """
+        linkNum, lane = str(linkNum), int(lane)
+        if linkNum in self.connectors:
+            fromLink, fromLane, toLink, toLane, lanes = \
+                self.connectors[linkNum]
+            if 1 <= lane <= lanes:
+                return [(linkNum, toLink, toLane + lane - 1)]
+            return []
+        reached = []
+        for i in self.outgoing.get(linkNum, ()):
+            fromLink, fromLane, toLink, toLane, lanes = self.connectors[i]
+            if fromLane <= lane < fromLane + lanes:
+                reached.append((i, toLink, toLane + lane - fromLane))
+        return sorted(reached)
+
+    def upstreamLanes(self, linkNum, lane):
+        """ Lanes that feed a lane. For a link these are the lanes at the
+            start of its incoming connectors; for a connector, the lane of
+            the link it starts from.
+            Input: link number, lane number
+            Output: sorted list of (connector, link, lane) tuples
+        """
+        linkNum, lane = str(linkNum), int(lane)
+        if linkNum in self.connectors:
+            fromLink, fromLane, toLink, toLane, lanes = \
+                self.connectors[linkNum]
+            if 1 <= lane <= lanes:
+                return [(linkNum, fromLink, fromLane + lane - 1)]
+            return []
+        feeding = []
+        for i in self.incoming.get(linkNum, ()):
+            fromLink, fromLane, toLink, toLane, lanes = self.connectors[i]
+            if toLane <= lane < toLane + lanes:
+                feeding.append((i, fromLink, fromLane + lane - toLane))
+        return sorted(feeding)
+
+
+class Vissim(object):
+    paramTypes = ['colorDistribution', 'conflictArea', 'desAcceleration',
                   'desDeceleration', 'desSpeedDistribution', 'displayType',
                   'drivingBehavior', 'linkBehaviorType', 'link',
                   'locatinDistribution', 'maxAcceleration', 'maxDeceleration',
@@ -56,18 +523,254 @@ class Vissim(object):
                   'vehicleComposition', 'vehicleInput',
                   'vehicleRoutingDecisionStatic', 'vehicleType',
                   'walkingBehavior', 'weightDistribution', 'ptStop']
-        paramDict = {}
-        for key in params:
-            if key == 'maxDeceleration' or key == 'maxAcceleration':
-                path = './' + key + 'Functions/' + key + '/@no'
-            elif key == 'vehicleRoutingDecisionStatic':
-                path = './vehicleRoutingDecisionsStatic/' + key + '/@no'
-            elif key == 'vehicleClass':
-                path = './vehicleClasses/' + key + '/@no'
+    # Object type of the base network an object type of a scenario follows
+    base = None
+
+    def __init__(self, filename=None, lazy=False, cache=None):
+        if filename is None:
+            here = path.abspath(path.dirname(__file__))
+            self.filename = here + '/default/default.inpx'
+        else:
+            self.filename = filename
+        self.params = None
+        self.profiler = Profiler()
+        snapshot = None
+        if cache is None:
+            self.data = self._load(self.filename, lazy)
+            self._getParams()
+        else:
+            cache = SnapshotCache(cache)
+            key, snapshot = self._loadCached(self.filename, lazy, cache)
+        #print self._getParams()
+        self.Links = Links(self.data, self.params, self.sections)
+        self.PTStop = PTStop(self.data, self.params, self.sections)
+        self.Inputs = Inputs(self.data, self.params, self.sections)
+        self.StaticRouting = StaticRouting(self.data, self.params,
+                                           self.sections)
+        self.defaultWidth = 3.6
+        if snapshot is not None:
+            self.Links._geometry = GeometryStore(*snapshot['geometry'])
+        elif cache is not None:
+            cache.save(key, self._snapshot())
+
+    def _load(self, filename, lazy=False):
+        """ Load XML file. In lazy mode only the top level is parsed and
+            each section is parsed when it is first used.
+        """
+        self.sections = Sections(filename, lazy)
+        return self.sections.data
+
+    def _loadCached(self, filename, lazy, cache):
+        """ Load XML file through a snapshot cache. A snapshot of the same
+            file contents supplies the section layout, parameter registry and
+            link geometry, so the file is parsed without scanning it for
+            sections or reading it for numbers; lazy still defers the
+            sections. Otherwise the file is loaded normally.
+            Input: filename, lazy flag, SnapshotCache
+            Output: content hash, snapshot (None on a cache miss)
+        """
+        with open(filename, 'rb') as f:
+            raw = f.read()
+        key = cache.key(raw)
+        snapshot = cache.load(key)
+        if snapshot is None:
+            self.sections = Sections(filename, lazy, raw)
+            self.data = self.sections.data
+            self._getParams()
+        else:
+            self.sections = Sections(filename, lazy, raw, snapshot['layout'])
+            self.data = self.sections.data
+            self._getParams(snapshot['params'])
+        return key, snapshot
+
+    def _snapshot(self):
+        """ State stored by the snapshot cache.
+            Input: None
+            Output: dict of section layout, parameter registry and columnar
+                    link geometry
+        """
+        return {'layout': self.sections.layout,
+                'params': {k: set(self.params[k]) for k in self.paramTypes},
+                'geometry': self.Links.geometry.columns()}
+
+    def loadSections(self, *names):
+        """ Parse sections deferred by a lazy load, e.g. before working on
+            self.data directly.
+            Input: section tags (all sections if none are given)
+            Output: None
+        """
+        if len(names) == 0:
+            self.sections.loadAll()
+        for name in names:
+            self.sections.attach(name)
+
+    def scenario(self):
+        """ Start a copy-on-write variant of the network. The scenario shares
+            this network's sections, number registry and link geometry, and
+            copies an object element only when it is first edited, so the
+            base stays untouched and each scenario can be exported on its
+            own. Objects a scenario has not edited follow the base.
+            Input: None
+            Output: Scenario
+        """
+        return Scenario(self)
+
+    def export(self, filename, incremental=False):
+        """ Write XML file to disk. With incremental=True only sections
+            changed through the object model are serialized again and the
+            rest is copied from the source file byte for byte, so direct
+            edits to self.data need markDirty() first.
+            Input: filename, incremental flag
+            Output: written file
+        """
+        self.filename = filename
+        self.sections.write(filename, incremental)
+
+    def validate(self):
+        """ Check the network's cross-references: connector end points,
+            route link sequences, vehicle inputs, routing decisions and
+            ptStops against the links, lanes and numbers they refer to.
+            Input: None
+            Output: list of finding dicts (type, no, field, message), empty
+                    if the network is consistent
+        """
+        return checkReferences(self)
+
+    def profile(self):
+        """ Context manager that counts calls, XPath evaluations, elements
+            scanned and results returned by lookups and wall time per method
+            of the network's objects while it is open, e.g.
+                with v.profile():
+                    v.Links.createLinks(records)
+                print v.profiler.table()
+            Input: None
+            Output: context manager
+        """
+        objects = [self, self.Links, self.PTStop, self.Inputs,
+                   self.StaticRouting]
+        return self.profiler.scope(objects, self.sections)
+
+    def stats(self, reset=False):
+        """ Counters recorded by profile().
+            Input: reset flag (clear the counters after reading them)
+            Output: dict of 'Class.method' -> dict of calls, time (seconds),
+                    xpath, scanned and returned
+        """
+        return self.profiler.report(reset)
+
+    def markDirty(self, *names):
+        """ Flag sections as changed so that export serializes them.
+            Input: section tags
+            Output: None
+        """
+        for name in names:
+            self.sections.markDirty(name)
+
+    @property
+    def index(self):
+        """ Element index of the object type, built on first use and again
+            whenever the section's children are replaced (a lazy parse or a
+            scenario copying the whole section).
+        """
+        version = self.sections.version(self._sectionTag())
+        if self._index is None or self._index[0] != version:
+            self._index = (version, self._buildIndex())
+        return self._index[1]
+
+    def _sectionTag(self):
+        """ Tag of the object type's section.
+        """
+        return self.path.split('/')[1]
+
+    def _section(self, name=None):
+        """ Return a top-level section element, parsing it if it was
+            deferred. A scenario copies the whole section first.
+            Input: section tag (the object type's own section by default)
+            Output: section element, None if the network has no such section
+        """
+        if name is None:
+            name = self._sectionTag()
+        return self.sections.load(name)
+
+    def _objects(self):
+        """ Elements of the object type in document order.
+            Input: None
+            Output: iterator of elements
+        """
+        return self.sections.objects(self._sectionTag(), self.name)
+
+    def _edit(self, element):
+        """ Make an object element writable. A scenario copies the element
+            from its base the first time, and the copy takes its place in
+            the index.
+            Input: object element
+            Output: element to change
+        """
+        edited = self.sections.edit(self._sectionTag(), element)
+        if edited is not element:
+            self.index[edited.get('no')] = edited
+        return edited
+
+    def _editSection(self, name=None):
+        """ Flag a section as changed and return the element that new
+            children are appended to. The object type's own section is
+            created if the network has none yet.
+            Input: section tag (the object type's own section by default)
+            Output: section element, None if the network has no such section
+        """
+        section = self.sections.parent(name or self._sectionTag())
+        if section is None and name is None:
+            tag = self._sectionTag()
+            section = etree.Element(tag)
+            root = self.data.getroot()
+            # Sections are stored in roughly alphabetical order
+            for i, child in enumerate(root.iterchildren(tag=etree.Element)):
+                if child.tag.lower() > tag.lower():
+                    child.addprevious(section)
+                    break
             else:
-                path = './' + key + 's/' + key + '/@no'
-            paramDict[key] = {int(i) for i in self.data.xpath(path)}
-        self.params = paramDict
+                root.append(section)
+        return section
+
+    def _sectionPath(self):
+        """ XPath of the object type relative to its section element.
+        """
+        return './' + self.path.split('/', 2)[2]
+
+    def _getParams(self, paramDict=None):
+        """ Gets VISSIM network object parameters for integrity checks.
+            The registry is maintained incrementally afterwards; calling this
+            again rebuilds it from the document in place.
+            Input: precomputed dict of object type -> numbers (optional)
+        """
+        if paramDict is None:
+            paramDict = {}
+            if not self.sections.lazy:
+                # Lazy networks read each type when it is first needed
+                for key in self.paramTypes:
+                    paramDict[key] = self._paramNums(key)
+        if self.params is None:
+            self.params = Params(self._paramNums)
+        self.params.reset(paramDict)
+
+    def _paramSection(self, key):
+        """ Tag of the section that holds an object type.
+        """
+        if key == 'maxDeceleration' or key == 'maxAcceleration':
+            return key + 'Functions'
+        elif key == 'vehicleRoutingDecisionStatic':
+            return 'vehicleRoutingDecisionsStatic'
+        elif key == 'vehicleClass':
+            return 'vehicleClasses'
+        return key + 's'
+
+    def _paramNums(self, key):
+        """ Read the numbers in use for an object type from the document.
+            Input: object type
+            Output: set of numbers
+        """
+        return {int(i) for i in self.sections.xpath(self._paramSection(key),
+                                                    './' + key + '/@no')}
 
     def _laneParse(self, lane):
         """ Takes lane attribute and splits it in to link and lane attributes.
@@ -85,65 +788,106 @@ class Vissim(object):
         """ List keys for iterable.
         """
         child = '' if children is None else children
-        xpath = (str(self.path) + child + '/@' + str(attr))
-        data = self.data.xpath(xpath)
-        return iter(data)
+        xpath = (self._sectionPath() + child + '/@' + str(attr))
+        return iter(self.sections.xpath(self._sectionTag(), xpath))
+
+    def _buildIndex(self):
+        """ Map object numbers to their elements so that keyed lookups do not
+            have to scan the document. A scenario layers its element copies
+            over the index of its base.
+            Input: None
+            Output: dict of number -> element
+        """
+        tag = self._sectionTag()
+        if self.base is None or tag in self.sections.owned:
+            return {e.get('no'): e for e in self._objects()}
+        index = IndexLayer(self.base.index)
+        changes = self.sections.changes(tag)
+        for old, new in changes:
+            if old is not None:
+                index.pop(old.get('no'), None)
+        for old, new in changes:
+            if new is not None and new.tag == self.name:
+                index[new.get('no')] = new
+        return index
+
+    def _addToIndex(self, element):
+        """ Register a newly created object element in the index and the
+            parameter registry.
+        """
+        self.index[element.get('no')] = element
+        self.params.add(self.name, element.get('no'))
+        return element
 
-    def _getAttributes(self, attr, value, children=None, duplicate=True):
-        """ Uses XPath to return attributes of Vissim object.
+    def _getElements(self, attr, value, children=None, edit=False):
+        """ Resolve the elements of a Vissim object. Lookups by number go
+            through the element index, other attributes fall back to XPath.
             Input: root attribute, root value, path to children (optional),
-                   deep copy by default.
-            Output: attribute dict of selected object
+                   edit flag (make the objects writable before their
+                   children are resolved)
+            Output: list of matching elements
         """
         child = '' if children is None else children
+        if attr == 'no':
+            element = self.index.get(str(value))
+            if element is None:
+                return []
+            if edit:
+                element = self._edit(element)
+            if child == '':
+                return [element]
+            return element.xpath('.' + child)
+        xpath = (self._sectionPath() + '[@' + str(attr) + '="' + str(value) +
+                 '"]')
+        if not edit:
+            return self.sections.xpath(self._sectionTag(), xpath + child)
+        elements = [self._edit(i) for i in
+                    self.sections.xpath(self._sectionTag(), xpath)]
+        if child == '':
+            return elements
+        return [i for element in elements for i in element.xpath('.' + child)]
+
+    def _getAttributes(self, attr, value, children=None, duplicate=False):
+        """ Return attributes of Vissim object.
+            Input: root attribute, root value, path to children (optional),
+                   copy to a dict (optional, read-only view by default).
+            Output: attribute mapping of selected object
+        """
         if attr not in self.types:
             raise KeyError('%s not a valid attribute' % (attr))
-        xpath = (str(self.path) + '[@' + str(attr) + '="' + str(value) + '"]' +
-                 str(child))
-	#print ' xpath is %s' %(xpath)
-        data = self.data.xpath(xpath)
+        data = self._getElements(attr, value, children)
         if len(data) == 0:
             raise KeyError('Key does not exist')
         if len(data) > 1:
             print 'KeyError(Number of elements > 1)'
-            #else: 
-	attribs = data[0].attrib
-	if duplicate:
-	    attribs = deepcopy(attribs)
-	if 'lane' in attribs:
-	    lane = self._laneParse(attribs['lane'])
-	    attribs.pop('lane')
-	    return dict(attribs, **lane)
-	else:
-	    return attribs
-
-    def _getChildren(self, attr, value, children, duplicate=True):
-        """ Uses XPath to return children of a Vissim object
-            Input: root attribute, root value, path to children, deep copy by
-                   default.
+        attribs = AttributeView(data[0].attrib)
+        if duplicate:
+            return attribs.copy()
+        else:
+            return attribs
+
+    def _getChildren(self, attr, value, children, duplicate=False):
+        """ Return children of a Vissim object
+            Input: root attribute, root value, path to children, copy to
+                   dicts (optional, read-only views by default).
             Output: List of children
         """
         if attr not in self.types:
             raise KeyError('%s not a valid attribute' % (attr))
-        xpath = (self.path + '[@' + str(attr) + '="' + str(value) + '"]' +
-                 str(children))
-        if len(self.data.xpath(xpath)) == 0:
-	    err = 'Key %s does not exist' %(xpath)
+        data = self._getElements(attr, value, children)
+        if len(data) == 0:
+            err = 'Key %s="%s"%s does not exist' % (attr, value, children)
             raise KeyError(err)
+        elif duplicate:
+            return [AttributeView(i.attrib).copy() for i in data]
         else:
-            childList = [i.attrib for i in self.data.xpath(xpath)]
-            if duplicate:
-                return deepcopy(childList)
-            else:
-                return childList
+            return [AttributeView(i.attrib) for i in data]
 
     def _setAttribute(self, attr, value, setAttr, setValue, children=None):
-        child = '' if children is None else children
-        path = (self.path + '[@' + str(attr) + '="' + str(value) + '"]' +
-                str(child))
-	#print ' path is %s' %(path)
-        data = self.data.xpath(path)
+        data = self._getElements(attr, value, children, edit=True)
         setValue = str(setValue)
+        if len(data) == 0:
+            raise KeyError('Key does not exist')
         if len(data) > 1:
             #raise KeyError('Number of elements > 1')
             print 'KeyError(Number of elements > 1)'
@@ -153,56 +897,84 @@ class Vissim(object):
             data[0].set('lane', self._laneConcat(setValue, connectLane))
         elif setAttr == 'connectLane' and 'lane' in data[0].attrib.keys():
             attr = self._getAttributes(attr, value, children=children)
-            connectLane = attr['connectLink']
+            connectLink = attr['connectLink']
             data[0].set('lane', self._laneConcat(connectLink, setValue))
         elif setAttr in data[0].attrib.keys():
             if setAttr == 'no' and int(setValue) in self.params[self.name]:
                 raise KeyError('Numbering conflict')
+            oldValue = data[0].get(setAttr)
             data[0].set(setAttr, setValue)
-            if setAttr == 'no':
-                self._getParams()
+            if setAttr == 'no' and children is None:
+                self.index.pop(oldValue, None)
+                self.index[setValue] = data[0]
+                self.params.discard(self.name, oldValue)
+                self.params.add(self.name, setValue)
         else:
-            raise KeyError('%s not an attribute of element') % (setAttr)
+            raise KeyError('%s not an attribute of element' % (setAttr))
 
     def _setChild(self, attr, value, element, elemAttr, children=None):
-        child = '' if children is None else children
-        path = (self.path + '[@' + str(attr) + '="' + str(value) + '"]' +
-                str(child))
-	#print ' path is %s' %(path)
-        data = self.data.xpath(path)
+        data = self._getElements(attr, value, children, edit=True)
         if len(data) > 1:
             #raise KeyError('Number of elements > 1')
             print 'KeyError(Number of elements > 1)'
         elif len(data) == 0:
-            raise KeyError('%s path generates zero elements' % (path))
+            raise KeyError('%s="%s"%s generates zero elements' %
+                           (attr, value, children or ''))
         if elemAttr is None:
             etree.SubElement(data[0], element)
         else:
             elemAttr = {str(k): str(v) for k, v in elemAttr.items()}
             etree.SubElement(data[0], element, attrib=elemAttr)
-            if 'no' in elemAttr:
-                self._getParams()
 
-    def _removeElements(self, path):
-            data = self.data.xpath(self.path + path)
-            for child in data:
-                data.remove(child)
+    def _removeElements(self, num, children):
+        """ Remove the children of a Vissim object.
+            Input: object number, path to children
+            Output: Removed child elements
+        """
+        for child in self._getElements('no', num, children, edit=True):
+            child.getparent().remove(child)
 
-    def _removeChild(self, parent, child):
-        data = self.data.xpath(parent)[0]
-        data.remove(self.data.xpath(child)[0])
-        self._getParams()
+    def _removeObject(self, num):
+        """ Remove a Vissim object and drop it from the element index.
+            Input: object number
+            Output: Removed element
+        """
+        element = self.index.pop(str(num), None)
+        if element is None:
+            raise KeyError('Key %s does not exist' % (num))
+        self.sections.remove(self._sectionTag(), element)
+        self.params.discard(self.name, num)
+
+    def _removeChild(self, num, children):
+        """ Remove a single child element of a Vissim object.
+            Input: object number, path to child
+            Output: Removed child element
+        """
+        data = self._getElements('no', num, children, edit=True)
+        if len(data) == 0:
+            raise KeyError('Key %s%s does not exist' % (num, children))
+        data[0].getparent().remove(data[0])
+
+    def _apply(self, updates, children, setAttr, value):
+        """ Set an attribute on children of objects that were resolved
+            before anything was changed, making each object writable once.
+            Input: list of (object element, child position, value) tuples,
+                   path to the children, attribute, function of (child,
+                   value) -> new attribute value
+            Output: None
+        """
+        edited = {}
+        for element, i, new in updates:
+            if element not in edited:
+                edited[element] = self._edit(element).findall(children)
+            child = edited[element][i]
+            child.set(setAttr, str(value(child, new)))
 
     def _getNewNum(self, key):
-        nums = self.params[key]
-        if len(nums) == 0:
-            return str(1)
-        else:
-            return str(max(nums) + 1)
+        return str(self.params.newNum(key))
 
     def _getDefaultNum(self, key):
-        nums = self.params[key]
-        return str(list(nums)[0])
+        return str(self.params.defaultNum(key))
 
     def _parseLane(self, laneStr):
         """ Parse lane strings in to link and lane number """
@@ -215,7 +987,8 @@ class Vissim(object):
             Input: x, y points
             Output: reference network
         """
-        if not self.data.xpath('./netPara'):
+        netPara = self._editSection('netPara')
+        if netPara is None:
             a = {'concatMaxLen': "255", 'concatSeparator': ",",
                  'databFilename': "", 'drivSimActive': "false",
                  'leftHandTraffic': "false", 'northDir': "0",
@@ -228,19 +1001,22 @@ class Vissim(object):
                  'unitLenLong': "IMPERIAL", 'unitLenShort': "IMPERIAL",
                  'unitLenVeryShort': "IMPERIAL", 'unitSpeed': "METRIC",
                  'unitSpeedSmall': "METRIC", 'useGradFromZCoord': "false"}
-            etree.SubElement(self.data.getroot(), 'netPara', attrib=a)
-        etree.SubElement(self.data.xpath('./netPara')[0], 'refPointMap',
+            netPara = etree.SubElement(self.data.getroot(), 'netPara',
+                                       attrib=a)
+        etree.SubElement(netPara, 'refPointMap',
                          attrib={'x': str(x), 'y': str(y)})
-        etree.SubElement(self.data.xpath('./netPara')[0], 'refPointNet',
+        etree.SubElement(netPara, 'refPointNet',
                          attrib={'x': '0', 'y': '0'})
 
 class PTStop(Vissim):
-    def __init__(self, data, params):
-        self.name = 'ptstop'
+    def __init__(self, data, params, sections):
+        self.name = 'ptStop'
         self.path = './ptStops/ptStop'
         self.data = data
         self.params = params
+        self.sections = sections
         self.types={'anmid': int, 'lane': str, 'length': float, 'name': str, 'no': int, 'pos': float}
+        self._index = None
 
     #Added by Cherry
     def createptStop(self, **kwargs):
@@ -250,10 +1026,9 @@ class PTStop(Vissim):
         """
         num = self._getNewNum('ptStop')
         defaults = {'anmid': '99', 'lane': '99999 1', 'length': '10.9', 'name': '', 'no': num, 'pos': ''}
-        data = self.data
         a = {k: str(kwargs.get(k, v)) for k, v in defaults.items()}
-        etree.SubElement(data.xpath('./ptStops')[0], 'ptStop', attrib=a)
-        self._getParams() #Note that there is no ptStop attribute in params list.
+        self._addToIndex(etree.SubElement(self._editSection(), 'ptStop',
+                                          attrib=a))
         return self.getptStop(a['no'])
 
     #Added by Cherry
@@ -266,11 +1041,12 @@ class PTStop(Vissim):
 
 
 class Links(Vissim):
-    def __init__(self, data, params):
+    def __init__(self, data, params, sections):
         self.name = 'link'
         self.path = './links/link'
         self.data = data
         self.params = params
+        self.sections = sections
         self.types = {'assumSpeedOncom': float, 'costPerKm': float,
                       'direction': str, 'displayType': int,
                       'emergStopDist': float, 'gradient': float,
@@ -285,18 +1061,84 @@ class Links(Vissim):
                       'showVeh': bool, 'surch1': float, 'surch2': float,
                       'thickness': float, 'vehRecAct': bool, 'geometry': list,
                       'lanes': list}
+        self._index = None
+        self._geometry = None
+        self._topology = None
 
     def __iter__(self):
         return self._listAttributes('no')
 
     def __getitem__(self, idx):
-        links = self.getLink(idx)
+        links = self.getLink(idx).copy()
         geos = [(i['x'], i['y'], i['zOffset']) for i in
                 self.getGeometries(idx)]
         lanes = [i['width'] for i in self.getLanes(idx)]
         links.update({'point3D': geos, 'lane': lanes})
         return links
 
+    @property
+    def geometry(self):
+        """ Columnar geometry store of all links, built on first use and
+            kept in sync by the Links methods. A scenario layers the links
+            it edited over the geometry of its base.
+        """
+        if self._geometry is None:
+            if self.base is None or 'links' in self.sections.owned:
+                self._geometry = GeometryStore.fromElement(self._objects())
+            else:
+                self._geometry = self.base.geometry.layer()
+                changes = self.sections.changes('links')
+                for old, new in changes:
+                    if old is not None:
+                        self._geometry.remove(old.get('no'))
+                for old, new in changes:
+                    if new is not None:
+                        points = new.iterfind('geometry/points3D/point3D')
+                        self._geometry.set(new.get('no'), [
+                            (i.get('x'), i.get('y'), i.get('zOffset', '0'))
+                            for i in points])
+        return self._geometry
+
+    def _syncGeometry(self, linkNum):
+        """ Re-read a link's point set in to the geometry store after it
+            was edited.
+        """
+        if self._geometry is not None:
+            points = [(i.get('x'), i.get('y'), i.get('zOffset', '0')) for i in
+                      self._getElements('no', linkNum,
+                                        '/geometry/points3D/point3D')]
+            self._geometry.set(linkNum, points)
+
+    @property
+    def topology(self):
+        """ Link and connector adjacency, built on first use and kept in
+            sync by the Links methods.
+        """
+        if self._topology is None:
+            self._topology = Topology.fromElement(self._objects())
+        return self._topology
+
+    def _syncTopology(self, linkNum):
+        """ Re-read a connector in to the topology after it was created,
+            edited or removed.
+        """
+        if self._topology is not None:
+            self._topology.remove(linkNum)
+            element = self.index.get(str(linkNum))
+            if element is not None:
+                self._topology.add(element)
+
+    def _syncLink(self, linkNum):
+        """ Re-read a link in to the geometry store and the topology after it
+            was replaced, patched or removed as a whole.
+        """
+        if self._geometry is not None:
+            if str(linkNum) in self.index:
+                self._syncGeometry(linkNum)
+            else:
+                self._geometry.remove(linkNum)
+        self._syncTopology(linkNum)
+
     def getLink(self, linkNum):
         """ Get attributes of link.
             Input: link number
@@ -322,6 +1164,13 @@ class Links(Vissim):
             Output: Changed link attribute
         """
         self._setAttribute('no', linkNum, attr, value)
+        if attr == 'no' and self._geometry is not None:
+            self._geometry.rename(linkNum, value)
+        if attr == 'no':
+            self._syncTopology(linkNum)
+            self._syncTopology(value)
+            return self.getLink(value)
+        return self.getLink(linkNum)
 
     def setConnector(self, linkNum, attr, value, fromLink=True):
         if fromLink:
@@ -329,6 +1178,7 @@ class Links(Vissim):
         elif not fromLink:
             child = '/toLinkEndPt'
         self._setAttribute('no', linkNum, attr, value, child)
+        self._syncTopology(linkNum)
         return self.getConnector(linkNum)
 
     def getGeometries(self, linkNum):
@@ -344,20 +1194,20 @@ class Links(Vissim):
             Input: link number
             Output: Removed <point3D> elements from a link.
         """
-        self._removeElements('[@no="' + str(linkNum) +
-                            '"]/geometry/points3D/point3D')
+        self._removeElements(linkNum, '/geometry/points3D/point3D')
+        self._syncGeometry(linkNum)
 
     def addGeometry(self, linkNum, points):
         """ Add points to link's point set.
             Input: link number, list of x,y,z tuples
             Output: Added <point3D> elements to <points3D> elements
         """
-        self.removeGeometry(linkNum)
         children = '/geometry/points3D'
         if isinstance(points, list):
             for x, y, z in points:
                 a = {'x': x, 'y': y, 'zOffset': z}
                 self._setChild('no', linkNum, 'point3D', a, children)
+            self._syncGeometry(linkNum)
             return self.getGeometries(linkNum)
         else:
             raise TypeError('points must be list of tuples')
@@ -368,10 +1218,13 @@ class Links(Vissim):
             Output: return updated point set
         """
         children = '/geometry/points3D/point3D'
-        geos = self._getChildren('no', linkNum, children, duplicate=False)
+        geos = self._getElements('no', linkNum, children, edit=True)
         if len(geos) > index:
-            geos[index].replace({'x': point[0], 'y': point[1],
-                                 'zOffset': point[2]})
+            geos[index].set('x', str(point[0]))
+            geos[index].set('y', str(point[1]))
+            geos[index].set('zOffset', str(point[2]))
+            self._syncGeometry(linkNum)
+            return self.getGeometries(linkNum)
         else:
             raise IndexError('Index value does not exist in geos list')
 
@@ -380,14 +1233,14 @@ class Links(Vissim):
             Input: link number
             Output: Removed <lane> elements from a link.
         """
-        self._removeElements('[@no="' + str(linkNum) + '"]/lanes/lane')
+        self._removeElements(linkNum, '/lanes/lane')
+        self._syncTopology(linkNum)
 
     def getLanes(self, linkNum):
         """ Get lane widths.
             Input: link number
             Output: List of lane widths beginning with lane 1 (in meters)
         """
-	print 'Getting lanes for link %s' %(linkNum)
         return self._getChildren('no', linkNum, '/lanes/lane')
 
     def addLane(self, linkNum, lanes):
@@ -397,10 +1250,10 @@ class Links(Vissim):
             Output: Added <lane> elements to <lanes> element
         """
         if isinstance(lanes, list):
-            self.removeLanes(linkNum)
             for width in lanes:
                 self._setChild('no', linkNum, 'lane',
                                {'width': width}, '/lanes')
+            self._syncTopology(linkNum)
             return self.getLanes(linkNum)
         else:
             raise TypeError('lanes must be a list of width values')
@@ -410,10 +1263,10 @@ class Links(Vissim):
             Input: link number, index to update, update lane width value
             Output: return updated lane set
         """
-        lanes = self._getChildren('no', linkNum, '/lanes/lane',
-                                  duplicate=False)
+        lanes = self._getElements('no', linkNum, '/lanes/lane', edit=True)
         if len(lanes) > index:
-            lanes[index].replace({'width': str(width)})
+            lanes[index].set('width', str(width))
+            return self.getLanes(linkNum)
         else:
             raise IndexError('Index value does not exist in lanes list')
 
@@ -422,18 +1275,101 @@ class Links(Vissim):
             Input: link number
             Output: link length in meters
         """
-        geos = [(i['x'], i['y'], i['zOffset']) for i in
-                self.getGeometries(linkNum)]
-        return sum(cdist(geos[:-1], geos[1:]).diagonal())
+        geos = self.geometry.points(linkNum)
+        return np.sqrt((np.diff(geos, axis=0) ** 2).sum(axis=1)).sum()
 
-    def createLink(self, **kwargs):
-        """ Create a new link in the model.
-            Input: link number, link, point3D and lane attributes as dict
-            Output: Added <link> element to <links> element.
+    def _chainage(self):
+        """ Cumulative distance along the point sets of all links, measured
+            from the first point of the whole coordinate array.
+            Input: None
+            Output: list of link numbers, row offsets, (n,) distances
+        """
+        nums, offsets, coords = self.geometry.columns()
+        steps = np.sqrt((np.diff(coords, axis=0) ** 2).sum(axis=1))
+        return nums, offsets, np.concatenate([[0.0], np.cumsum(steps)])
+
+    def _linkRows(self, linkNums, nums):
+        """ Positions of links in the geometry store.
+            Input: list of link numbers (all links if None), stored numbers
+            Output: list of link numbers, array of positions
+        """
+        if linkNums is None:
+            return nums, np.arange(len(nums))
+        linkNums = [str(i) for i in linkNums]
+        row = self.geometry.row
+        for i in linkNums:
+            if i not in row:
+                raise KeyError('Link %s does not exist' % (i))
+        return linkNums, np.array([row[i] for i in linkNums], dtype=np.int64)
+
+    def getLinkLengths(self, linkNums=None):
+        """ Calculate the lengths of many links in one vectorized pass.
+            Input: list of link numbers (optional, all links by default)
+            Output: dict of link number -> link length in meters
+        """
+        nums, offsets, distance = self._chainage()
+        linkNums, rows = self._linkRows(linkNums, nums)
+        start = offsets[rows]
+        end = offsets[rows + 1] - 1
+        lengths = np.where(end > start,
+                           distance[np.maximum(end, 0)] -
+                           distance[np.minimum(start, len(distance) - 1)],
+                           0.0)
+        return dict(zip(linkNums, lengths))
+
+    def getNearestSegment(self, x, y):
+        """ Find the link segment nearest to a point.
+            Input: x, y coordinates
+            Output: dict of link number, segment index, offset along the link
+                    and distance (None if there are no link segments)
+        """
+        return self.geometry.segments().nearest([(x, y)])[0]
+
+    def getNearestSegments(self, points):
+        """ Find the link segment nearest to each of many points.
+            Input: list of x, y tuples
+            Output: list of dicts as returned by getNearestSegment
+        """
+        return self.geometry.segments().nearest(points)
+
+    def getSegmentsInRadius(self, x, y, radius):
+        """ Find the link segments within a distance of a point.
+            Input: x, y coordinates, radius in meters
+            Output: list of dicts of link number, segment index, offset along
+                    the link and distance, nearest first
+        """
+        return self.geometry.segments().radius([(x, y)], radius)[0]
+
+    def getSegmentsInBox(self, xmin, ymin, xmax, ymax):
+        """ Find the link segments crossing a bounding box.
+            Input: box corner coordinates
+            Output: list of dicts of link number, segment index and offset
+                    along the link where the segment enters the box
+        """
+        return self.geometry.segments().bbox([(xmin, ymin, xmax, ymax)])[0]
+
+    def getChainages(self, linkNums=None):
+        """ Cumulative distance of each point from the start of its link,
+            for linear referencing along links.
+            Input: list of link numbers (optional, all links by default)
+            Output: dict of link number -> array of distances in meters,
+                    one per point (the last value is the link length)
+        """
+        nums, offsets, distance = self._chainage()
+        linkNums, rows = self._linkRows(linkNums, nums)
+        chainages = {}
+        for num, i in zip(linkNums, rows):
+            chainage = distance[offsets[i]:offsets[i + 1]]
+            if len(chainage) > 0:
+                chainage = chainage - chainage[0]
+            chainages[num] = chainage
+        return chainages
+
+    def _linkDefaults(self, num, connector=False):
+        """ Default attributes of a new link or connector.
+            Input: link number, connector flag
+            Output: dict of attributes
         """
-        #RV get a new num if this is really a new link
-	num = self._getNewNum('link')
-	#print 'link number max + 1 %s' %(num)
         defaults = {'assumSpeedOncom': '60.00000', 'costPerKm': '0.00000',
                     'direction': 'ALL',
                     'displayType': self._getDefaultNum('displayType'),
@@ -450,32 +1386,130 @@ class Links(Vissim):
                     'showVeh': 'true', 'surch1': '0.00000',
                     'surch2': '0.00000', 'thickness': '0.00000',
                     'vehRecAct': 'true', 'no': num}
-        data = self.data
+        if connector:
+            defaults.pop('level')
+            defaults['lnChgDistIsPerLn'] = 'false'
+        return defaults
+
+    def _buildLink(self, parent, attrib, points, lanes, fromAttr=None,
+                   toAttr=None):
+        """ Build a <link> element with its geometry, lanes and (for
+            connectors) end points directly, without per-child lookups.
+            Input: <links> element, link attributes, list of x,y,z tuples,
+                   list of lane widths (None for connector lanes), connector
+                   from/to end point attributes
+            Output: new <link> element, not yet indexed
+        """
+        if not isinstance(points, list):
+            raise TypeError('points must be list of tuples')
+        link = etree.SubElement(parent, 'link', attrib=attrib)
+        if fromAttr is not None:
+            etree.SubElement(link, 'fromLinkEndPt',
+                             attrib={k: str(v) for k, v in fromAttr.items()})
+        points3D = etree.SubElement(etree.SubElement(link, 'geometry'),
+                                    'points3D')
+        for x, y, z in points:
+            etree.SubElement(points3D, 'point3D',
+                             attrib={'x': str(x), 'y': str(y),
+                                     'zOffset': str(z)})
+        laneSet = etree.SubElement(link, 'lanes')
+        for width in lanes:
+            if width is None:
+                etree.SubElement(laneSet, 'lane')
+            else:
+                etree.SubElement(laneSet, 'lane', attrib={'width': str(width)})
+        if toAttr is not None:
+            etree.SubElement(link, 'toLinkEndPt',
+                             attrib={k: str(v) for k, v in toAttr.items()})
+        return link
+
+    def _linkSpec(self, num, kwargs):
+        """ Resolve the attributes, geometry and lanes of a new link.
+            Input: default link number, link attributes as dict
+            Output: attributes, points, lane widths
+        """
+        defaults = self._linkDefaults(num)
         a = {k: str(kwargs.get(k, v)) for k, v in defaults.items()}
-        etree.SubElement(data.xpath('./links')[0], 'link', attrib=a)
-        self._setChild('no', a['no'], 'geometry', None)
-        self._setChild('no', a['no'], 'points3D', None, '/geometry')
-	#print 'Adding geometry for %s' %(num)
-        self.addGeometry(a['no'], kwargs.get('point3D',
-                         [('0', '0', '0'), ('1', '1', '0')]))
-        laneCount =  kwargs.get('lane', ['3.500000'])
-	if (laneCount > 0):
-        	self._setChild('no', a['no'], 'lanes', None)
-        	self.addLane(a['no'], kwargs.get('lane', ['3.500000']))
-	else:
-		print "lane count is not a positive number" 
-        self._getParams()
+        points = kwargs.get('point3D', [('0', '0', '0'), ('1', '1', '0')])
+        lanes = kwargs.get('lane', ['3.500000'])
+        if not isinstance(lanes, list):
+            raise TypeError('lanes must be a list of width values')
+        return a, points, lanes
+
+    def createLink(self, **kwargs):
+        """ Create a new link in the model.
+            Input: link number, link, point3D and lane attributes as dict
+            Output: Added <link> element to <links> element.
+        """
+        a, points, lanes = self._linkSpec(self._getNewNum('link'), kwargs)
+        self._addToIndex(self._buildLink(self._editSection(), a, points,
+                                         lanes))
+        if self._geometry is not None:
+            self._geometry.set(a['no'], points)
         return self.getLink(a['no'])
 
-    def connectorLocation(self, linkNum, lane, lanes):
-        """ Calculate the start and end points of a connector
-            Input: link number, lane number, total number of lanes
-                   being connected
+    def _batchNums(self, records):
+        """ Hand out link numbers for a batch of records. Records without a
+            number get consecutive new numbers that skip the numbers given
+            elsewhere in the batch. Numbers given in the batch must be
+            free and unique, otherwise nothing is created.
+            Input: list of attribute dicts
+            Output: list of numbers (None where the record has its own)
+        """
+        taken = set()
+        for record in records:
+            if 'no' in record:
+                num = int(record['no'])
+                if num in taken or num in self.params['link']:
+                    raise KeyError('Numbering conflict')
+                taken.add(num)
+        num = self.params.newNum('link')
+        nums = []
+        for record in records:
+            if 'no' in record:
+                nums.append(None)
+                continue
+            while num in taken:
+                num += 1
+            nums.append(str(num))
+            num += 1
+        return nums
+
+    def createLinks(self, records):
+        """ Create many links in one pass. Elements are built directly and
+            the index and numbering are updated once at the end.
+            Input: iterable of link attribute dicts as accepted by createLink
+            Output: list of new link numbers
+        """
+        records = list(records)
+        nums = self._batchNums(records)
+        specs = [self._linkSpec(num, kwargs)
+                 for num, kwargs in zip(nums, records)]
+        parent = self._editSection()
+        created = [self._buildLink(parent, *spec) for spec in specs]
+        for link, spec in zip(created, specs):
+            self._addToIndex(link)
+            if self._geometry is not None:
+                self._geometry.set(link.get('no'), spec[1])
+        return [link.get('no') for link in created]
+
+    def _linkElement(self, linkNum):
+        """ Return the element of an existing link.
+            Input: link number
+            Output: <link> element
+        """
+        data = self._getElements('no', linkNum)
+        if len(data) == 0:
+            raise KeyError('Link %s does not exist' % (linkNum))
+        return data[0]
+
+    def _laneOffset(self, width, lane, lanes):
+        """ Calculate the offset of a group of lanes from the centerline.
+            Input: list of lane widths, lane number, number of lanes
             Output: clockwise direction and offset
         """
-        width = [float(v['width']) for v in self.getLanes(linkNum)]
         centerline = sum(width) / 2.0
-        laneIdx = len(self.getLanes(linkNum)) - lane
+        laneIdx = len(width) - lane
         # beginning from the left, sum all lanes not being connected
         left = sum(width[:laneIdx+1-lanes])
         # median width of the lanes being connected
@@ -487,87 +1521,116 @@ class Links(Vissim):
         else:
             return True, 0
 
+    def connectorLocation(self, linkNum, lane, lanes):
+        """ Calculate the start and end points of a connector
+            Input: link number, lane number, total number of lanes
+                   being connected
+            Output: clockwise direction and offset
+        """
+        width = [float(v['width']) for v in self.getLanes(linkNum)]
+        return self._laneOffset(width, lane, lanes)
+
+    def _connectorSpec(self, num, fromLink, fromLane, toLink, toLane, lanes,
+                       kwargs):
+        """ Resolve the attributes, geometry, lanes and end points of a new
+            connector from the elements of the links it joins.
+            Input: default link number, from link, from lane, to link,
+                   to lane, number of lanes, attributes as dict
+            Output: attributes, points, lanes, from and to end points
+        """
+        fromElem = self._linkElement(fromLink)
+        toElem = self._linkElement(toLink)
+        fromWidth = [float(i.get('width')) for i in
+                     fromElem.xpath('./lanes/lane')]
+        toWidth = [float(i.get('width')) for i in toElem.xpath('./lanes/lane')]
+        # Check number of lanes doesn't exceed the number of from/to lanes
+        if len(fromWidth) < lanes or len(toWidth) < lanes:
+            raise ValueError('Number of lanes exceeds number of from/to lanes')
+        defaults = self._linkDefaults(num, connector=True)
+        a = {k: str(kwargs.get(k, v)) for k, v in defaults.items()}
+        fromAttr = {'lane': self._laneConcat(fromLink, fromLane),
+                    'pos': kwargs.get('fromPos', None)}
+        if fromAttr['pos'] is None:
+            fromAttr['pos'] = self.getLinkLength(fromLink)
+        if 'point3D' in kwargs:
+            points = kwargs['point3D']
+        else:
+            fromPoint = self.geometry.points(fromLink)[-2:]
+            clockwise, fromDist = self._laneOffset(fromWidth, fromLane, lanes)
+            fromPoint = geo.offsetParallel(fromPoint, fromDist,
+                                           clockwise=clockwise)
+            toPoint = self.geometry.points(toLink)[:2]
+            clockwise, toDist = self._laneOffset(toWidth, toLane, lanes)
+            toPoint = geo.offsetParallel(toPoint, toDist, clockwise=clockwise)
+            points = [tuple(fromPoint[-1]), tuple(toPoint[0])]
+        toAttr = {'lane': self._laneConcat(toLink, toLane),
+                  'pos': kwargs.get('toPos', '0.0000')}
+        return a, points, [None] * lanes, fromAttr, toAttr
+
     def createConnector(self, fromLink, fromLane, toLink, toLane, lanes,
                         **kwargs):
         """ Create a new connector in the model.
             Input: from link, from lane, to link, to lane, attributes
             Output: Added <link> element to <links> element.
         """
-        num = self._getNewNum('link')
-        defaults = {'assumSpeedOncom': '60.00000', 'costPerKm': '0.00000',
-                    'direction': 'ALL',
-                    'displayType': self._getDefaultNum('displayType'),
-                    'emergStopDist': '5.00000', 'gradient': '0.00000',
-                    'hasOvtLn': 'false', 'isPedArea': 'false',
-                    'linkBehavType': self._getDefaultNum('linkBehaviorType'),
-                    'linkEvalAct': 'false',
-                    'linkEvalSegLen': '10.00000', 'lnChgDist': '200.00000',
-                    'lnChgDistIsPerLn': 'false',
-                    'lnChgEvalAct': 'true', 'lookAheadDistOvt': '250.00000',
-                    'mesoFollowUpGap': '0.00000', 'mesoSpeed': '50.00000',
-                    'mesoSpeedModel': 'VEHICLEBASED', 'name': '',
-                    'ovtOnlyPT': 'false', 'ovtSpeedFact': '1.300000',
-                    'showClsfValues': 'true', 'showLinkBar': 'true',
-                    'showVeh': 'true', 'surch1': '0.00000',
-                    'surch2': '0.00000', 'thickness': '0.00000',
-                    'vehRecAct': 'true', 'no': num}
-        data = self.data
-        a = {k: str(kwargs.get(k, v)) for k, v in defaults.items()}
-        etree.SubElement(data.xpath('./links')[0], 'link', attrib=a)
-        fromAttr = {'lane': str(fromLink) + ' ' + str(fromLane),
-                    'pos': kwargs.get('fromPos', self.getLinkLength(fromLink))}
-        self._setChild('no', a['no'], 'fromLinkEndPt', fromAttr)
-        self._setChild('no', a['no'], 'geometry', None)
-        self._setChild('no', a['no'], 'points3D', None, '/geometry')
-        fromGeo = self.getGeometries(fromLink)[-2:]
-        fromPoint = [(v['x'], v['y'], v['zOffset']) for v in fromGeo]
-        clockwise, fromDist = self.connectorLocation(fromLink, fromLane, lanes)
-        fromPoint = geo.offsetParallel(fromPoint, fromDist,
-                                       clockwise=clockwise)
-        toGeo = self.getGeometries(toLink)[:2]
-        toPoint = [(v['x'], v['y'], v['zOffset']) for v in toGeo]
-        clockwise, toDist = self.connectorLocation(toLink, toLane, lanes)
-        toPoint = geo.offsetParallel(toPoint, toDist, clockwise=clockwise)
-        point3D = kwargs.get('point3D', [fromPoint[-1], toPoint[0]])
-        self.addGeometry(a['no'], point3D)
-        self._setChild('no', a['no'], 'lanes', None)
-        # Check number of lanes doesn't exceed the number of from/to lanes
-        if (len(self.getLanes(fromLink)) >= lanes and
-                len(self.getLanes(toLink)) >= lanes):
-            for lane in range(lanes):
-                self._setChild('no', a['no'], 'lane', None, '/lanes')
-        else:
-            raise ValueError('Number of lanes exceeds number of from/to lanes')
-        toAttr = {'lane': str(toLink) + ' ' + str(toLane),
-                  'pos': kwargs.get('toPos', '0.0000')}
-        self._setChild('no', a['no'], 'toLinkEndPt', toAttr)
-        self._getParams()
-        return self.getConnector(a['no'])
+        spec = self._connectorSpec(self._getNewNum('link'), fromLink,
+                                   fromLane, toLink, toLane, lanes, kwargs)
+        self._addToIndex(self._buildLink(self._editSection(), *spec))
+        if self._geometry is not None:
+            self._geometry.set(spec[0]['no'], spec[1])
+        self._syncTopology(spec[0]['no'])
+        return self.getConnector(spec[0]['no'])
+
+    def createConnectors(self, records):
+        """ Create many connectors in one pass. Elements are built directly
+            and the index and numbering are updated once at the end.
+            Input: iterable of dicts with fromLink, fromLane, toLink, toLane
+                   and lanes keys plus optional createConnector attributes
+            Output: list of new connector numbers
+        """
+        records = list(records)
+        specs = []
+        for num, record in zip(self._batchNums(records), records):
+            kwargs = dict(record)
+            args = [kwargs.pop(k) for k in ('fromLink', 'fromLane', 'toLink',
+                                            'toLane', 'lanes')]
+            specs.append(self._connectorSpec(num, *(args + [kwargs])))
+        parent = self._editSection()
+        created = [self._buildLink(parent, *spec) for spec in specs]
+        for link, spec in zip(created, specs):
+            self._addToIndex(link)
+            if self._geometry is not None:
+                self._geometry.set(link.get('no'), spec[1])
+            if self._topology is not None:
+                self._topology.add(link)
+        return [link.get('no') for link in created]
 
     def removeLink(self, linkNum):
         """ Remove an existing link or connector from the model.
             Input: link number
             Output: Removed <link> element from <links> element
         """
-        parent = './links'
-        child = self.path + '[@no="' + str(linkNum) + '"]'
-        self._removeChild(parent, child)
-        self._getParams()
+        self._removeObject(linkNum)
+        if self._geometry is not None:
+            self._geometry.remove(linkNum)
+        self._syncTopology(linkNum)
 
 
 class Inputs(Vissim):
-    def __init__(self, data, params):
-        self.name = 'input'
+    def __init__(self, data, params, sections):
+        self.name = 'vehicleInput'
         self.path = './vehicleInputs/vehicleInput'
         self.data = data
         self.params = params
+        self.sections = sections
         self.types = {'anmFlag': bool, 'link': int, 'name': str, 'no': int}
+        self._index = None
 
     def __iter__(self):
         return self._listAttributes('no')
 
     def __getitem__(self, idx):
-        inps = self.getInput('no', idx)
+        inps = self.getInput('no', idx).copy()
         inps.update({'timeIntervalVehVolume': self.getVols(idx)})
         return inps
 
@@ -617,29 +1680,82 @@ class Inputs(Vissim):
             Output: Updated list of volume profiles
         """
         children = '/timeIntVehVols/timeIntervalVehVolume'
-        vols = self._getChildren('no', inputNum, children, duplicate=False)
+        vols = self._getElements('no', inputNum, children, edit=True)
         if len(vols) > index:
-            vols[index]['volume'] = str(vol)
+            vols[index].set('volume', str(vol))
             return self.getVols(inputNum)
         else:
             raise IndexError('Index value does not exist in volume list')
 
-    def clearVols(self, vehComp=None):
-        """ Set all input demands to zero.
-            Input: None
-            Output: Changed input demands
-        """
-        inputs = self._listAttributes('no')
-        for inputNum in inputs:
-            child = ('[@no="' + inputNum +
-                     '"]/timeIntVehVols/timeIntervalVehVolume')
-            vols = self._listAttributes('vehComp', child)
-            for idx, comp in enumerate(vols):
-                if vehComp:
-                    if comp == vehComp:
-                        self.updateVol(inputNum, idx, 0)
+    def updateVols(self, volumes, inputNums=None):
+        """ Update many volumes in one pass. All targets are resolved before
+            anything is changed, so an invalid entry leaves the model as it
+            was.
+            Input: dict of input number -> dict of interval index (int) or
+                   timeInt string (e.g. '1 0') -> volume, or a 2D array with
+                   one row per input and one column per interval index (NaN
+                   entries are skipped); rows follow inputNums, or all inputs
+                   in document order by default
+            Output: number of volumes updated
+        """
+        children = 'timeIntVehVols/timeIntervalVehVolume'
+        if isinstance(volumes, Mapping):
+            items = volumes.items()
+        else:
+            volumes = np.asarray(volumes, dtype=np.float64)
+            if inputNums is None:
+                inputNums = list(self)
+            if volumes.ndim != 2 or len(volumes) != len(inputNums):
+                raise ValueError('volumes must have one row per input')
+            items = [(num, {i: vol for i, vol in enumerate(row)
+                            if not np.isnan(vol)})
+                     for num, row in zip(inputNums, volumes)]
+        updates = []
+        for inputNum, intervals in items:
+            element = self.index.get(str(inputNum))
+            if element is None:
+                raise KeyError('Input %s does not exist' % (inputNum))
+            vols = element.findall(children)
+            timeInts = None
+            for key, vol in intervals.items():
+                if isinstance(key, basestring):
+                    if timeInts is None:
+                        timeInts = {v.get('timeInt'): i
+                                    for i, v in enumerate(vols)}
+                    if key not in timeInts:
+                        raise KeyError('Input %s has no interval %s' %
+                                       (inputNum, key))
+                    updates.append((element, timeInts[key], vol))
+                elif not isinstance(key, (int, long, np.integer)):
+                    raise TypeError('Interval %r of input %s must be an '
+                                    'index or a timeInt string' %
+                                    (key, inputNum))
+                elif 0 <= key < len(vols):
+                    updates.append((element, key, vol))
                 else:
-                    self.updateVol(inputNum, idx, 0)
+                    raise IndexError('Index value does not exist in volume '
+                                     'list of input %s' % (inputNum))
+        self._apply(updates, children, 'volume', lambda vol, value: value)
+        return len(updates)
+
+    def clearVols(self, vehComp=None, timeInt=None):
+        """ Set all input demands to zero in a single pass over the
+            volumes.
+            Input: vehicle composition and time interval (e.g. '1 0') to
+                   clear (optional, all by default)
+            Output: number of volumes cleared
+        """
+        children = 'timeIntVehVols/timeIntervalVehVolume'
+        updates = []
+        for element in self._objects():
+            for i, vol in enumerate(element.iterfind(children)):
+                if vehComp is not None and vol.get('vehComp') != str(vehComp):
+                    continue
+                if timeInt is not None and vol.get('timeInt') != str(timeInt):
+                    continue
+                updates.append((element, i, 0))
+        self._apply(updates, children, 'volume', lambda vol, value: value)
+        return len(updates)
 
     def createInput(self, linkNum, vol, **kwargs):
         """ Create a new input in the model.
@@ -648,11 +1764,10 @@ class Inputs(Vissim):
         """
         defaults = {'anmFlag': 'false', 'name': '',
                     'no': self._getNewNum('vehicleInput')}
-        data = self.data
         a = {k: str(kwargs.get(k, v)) for k, v in defaults.items()}
         a['link'] = str(linkNum)
-        etree.SubElement(data.xpath('./vehicleInputs')[0], 'vehicleInput',
-                         attrib=a)
+        self._addToIndex(etree.SubElement(self._editSection(),
+                                          'vehicleInput', attrib=a))
         self._setChild('no', a['no'], 'timeIntVehVols', None)
         self.addVol(a['no'], vol, **kwargs)
         return self.getInput('no', a['no'])
@@ -662,29 +1777,29 @@ class Inputs(Vissim):
             Input: input number
             Output: Removed <vehicleInput> element from <vehicleInputs> element
         """
-        parent = './vehicleInputs'
-        child = self.path + '[@no="' + str(inputNum) + '"]'
-        self._removeChild(parent, child)
+        self._removeObject(inputNum)
 
 
 class StaticRouting(Vissim):
-    def __init__(self, data, params):
+    def __init__(self, data, params, sections):
         self.name = 'vehicleRoutingDecisionStatic'
         self.path = ('./vehicleRoutingDecisionsStatic/'
                      'vehicleRoutingDecisionStatic')
         self.data = data
         self.params = params
+        self.sections = sections
         self.types = {'allVehTypes': bool, 'anmFlag': bool,
                       'combineStaRoutDec': bool, 'link': int, 'name': str,
                       'no': int, 'pos': float, 'destLink': int,
                       'destPos': float, 'relFlow': float}
+        self._index = None
 
     def __iter__(self):
         return self._listAttributes('no')
 
     def __getitem__(self, idx):
-        routing = self.getRouting('no', idx)
-        routes = self.getRoutes(idx)
+        routing = self.getRouting('no', idx).copy()
+        routes = {k: v.copy() for k, v in self.getRoutes(idx).items()}
         for k, v in routes.items():
             v.update({'linkSeq': self.getRouteSeqs(idx, k)})
         routing.update({'vehClasses': self.getVehicleClasses(idx),
@@ -697,14 +1812,11 @@ class StaticRouting(Vissim):
             Output: Removed <vehicleRouteStatic> element from
             <vehRoutSta> element
         """
-        parent = self.path + '[@no="' + str(routingNum) + '"]/vehRoutSta'
-        child = parent + '/vehicleRouteStatic[@no="' + str(routeNum) + '"]'
-        self._removeChild(parent, child)
+        child = '/vehRoutSta/vehicleRouteStatic[@no="' + str(routeNum) + '"]'
+        self._removeChild(routingNum, child)
 
     def removeRouting(self, routingNum):
-        parent = './vehicleRoutingDecisionsStatic'
-        child = (self.path + '[@no="' + str(routingNum) + '"]')
-        self._removeChild(parent, child)
+        self._removeObject(routingNum)
 
     def getRouting(self, attr, value):
         """ Get attributes for a given routing decision based on attribute
@@ -778,22 +1890,41 @@ class StaticRouting(Vissim):
         self._setAttribute('no', routingNum, attr, value, child)
         return self.getRoute(routingNum, 'no', routeNum)
 
-    def clearFlows(self, vehClass=None):
-        """ Set all relative flows to zero.
-            Input: None
-            Output: Changed flow values
+    def clearFlows(self, vehClass=None, timeInt=None):
+        """ Set all relative flows to zero in a single pass over the
+            routing decisions. Without a time interval each route's relFlow
+            becomes a single zero flow for its first interval, as
+            updateFlow(..., 0) does; with one only the flow of that interval
+            is zeroed and the other intervals are kept.
+            Input: vehicle class of the routing decisions and time interval
+                   (e.g. '2 0') to clear (optional, all by default)
+            Output: number of routes changed
         """
-        routings = self._listAttributes('no')
-        for routingNum in routings:
-            if vehClass:
-                classes = self.getVehicleClasses(routingNum)
+        children = 'vehRoutSta/vehicleRouteStatic'
+        updates = []
+        for routing in self._objects():
+            if vehClass is not None:
+                classes = [i.get('key') for i in
+                           routing.iterfind('vehClasses/intObjectRef')]
                 if str(vehClass) not in classes:
                     continue
-            child = ('[@no="' + routingNum +
-                     '"]/vehRoutSta/vehicleRouteStatic')
-            routes = self._listAttributes('no', child)
-            for routeNum in routes:
-                self.updateFlow(routingNum, routeNum, 0)
+            for i, route in enumerate(routing.iterfind(children)):
+                if timeInt is None:
+                    flow = route.get('relFlow', '').split(':')[0] + ':0'
+                    if flow != route.get('relFlow'):
+                        updates.append((routing, i, flow))
+                    continue
+                flows = route.get('relFlow', '').split(',')
+                changed = False
+                for idx, flow in enumerate(flows):
+                    prefix = flow.split(':')[0]
+                    if prefix.strip() == str(timeInt):
+                        flows[idx] = prefix + ':0'
+                        changed = True
+                if changed:
+                    updates.append((routing, i, ','.join(flows)))
+        self._apply(updates, children, 'relFlow', lambda route, value: value)
+        return len(updates)
 
     def updateFlow(self, routingNum, routeNum, volume):
         """ Update the relative flow value of a given route in a routing
@@ -803,12 +1934,48 @@ class StaticRouting(Vissim):
         """
         child = ('/vehRoutSta/vehicleRouteStatic[@no="' +
                  str(routeNum) + '"]')
-        flow = self._getAttributes('no', routingNum, child, duplicate=False)
+        flow = self._getAttributes('no', routingNum, child)
         prefix = flow['relFlow'].split(':')[0]
         value = prefix + ':' + str(volume)
         self.setRoute(routingNum, routeNum, 'relFlow', value)
         return self.getRoute(routingNum, 'no', routeNum)
 
+    def updateFlows(self, flows, by='no'):
+        """ Update the relative flows of many routes in one pass. Routes
+            are resolved through one lookup per routing decision and all
+            targets are resolved before anything is changed.
+            Input: iterable of (routing decision number, route number or
+                   name, flow) rows, route attribute to match on ('no' or
+                   'name')
+            Output: number of routes updated
+        """
+        if by not in ('no', 'name'):
+            raise KeyError('%s not a valid route attribute' % (by))
+        children = 'vehRoutSta/vehicleRouteStatic'
+        lookup = {}
+        updates = []
+        for routingNum, route, flow in flows:
+            routingNum = str(routingNum)
+            if routingNum not in lookup:
+                element = self.index.get(routingNum)
+                if element is None:
+                    raise KeyError('Routing decision %s does not exist' %
+                                   (routingNum))
+                routes = {}
+                for i, child in enumerate(element.iterfind(children)):
+                    routes.setdefault(child.get(by), i)
+                lookup[routingNum] = (element, routes)
+            element, routes = lookup[routingNum]
+            target = routes.get(str(route))
+            if target is None:
+                raise KeyError('Route %s="%s" does not exist in routing '
+                               'decision %s' % (by, route, routingNum))
+            updates.append((element, target, flow))
+        relFlow = lambda route, flow: (route.get('relFlow', '').split(':')[0] +
+                                       ':' + str(flow))
+        self._apply(updates, children, 'relFlow', relFlow)
+        return len(updates)
+
     def getRouteSeqs(self, routingNum, routeNum):
         """ Get sequence of links that a given route traverses.
             Input: routing decision number, route number
@@ -848,16 +2015,17 @@ class StaticRouting(Vissim):
         """
         children = ('/vehRoutSta/vehicleRouteStatic[@no="' + str(routeNum) +
                     '"]/linkSeq/intObjectRef')
-        seqs = self._getChildren('no', routingNum, children, duplicate=False)
+        seqs = self._getElements('no', routingNum, children, edit=True)
         if len(seqs) > index:
-            seqs[index]['key'] = str(link)
+            seqs[index].set('key', str(link))
             return self.getRouteSeqs(routingNum, routeNum)
         else:
             raise IndexError('Index value does not exist in sequence list')
 
     def createRoute(self, routingNum, destLink, **kwargs):
-        num = (self.data.xpath(self.path + '[@no="' + str(routingNum) +
-               '"]/vehRoutSta/vehicleRouteStatic/@no'))
+        num = [int(i.get('no')) for i in
+               self._getElements('no', routingNum,
+                                 '/vehRoutSta/vehicleRouteStatic')]
         if len(num) == 0:
             num = '1'
         else:
@@ -882,13 +2050,117 @@ class StaticRouting(Vissim):
         num = self._getNewNum('vehicleRoutingDecisionStatic')
         defaults = {'allVehTypes': 'false', 'anmFlag': 'false', 'no': num,
                     'combineStaRoutDec': 'false', 'name': '', 'pos': '0.0000'}
-        data = self.data
         a = {k: kwargs.get(k, v) for k, v in defaults.items()}
         a['link'] = str(linkNum)
-        etree.SubElement(data.xpath('./vehicleRoutingDecisionsStatic')[0],
-                         'vehicleRoutingDecisionStatic', attrib=a)
+        self._addToIndex(etree.SubElement(
+            self._editSection(), 'vehicleRoutingDecisionStatic',
+            attrib=a))
         self._setChild('no', a['no'], 'vehClasses', None)
         self.setVehicleClasses(a['no'], kwargs.get('vehClasses',
                                self._getDefaultNum('vehicleClass')))
         self._setChild('no', a['no'], 'vehRoutSta', None)
         return self.getRouting('no', a['no'])
+
+
+class Scenario(Vissim):
+    """ Variant of a network that records its edits in an overlay of the
+        base network's sections. The number registry, element indexes and
+        link geometry are layered over those of the base, so a scenario
+        holds only what it changed. Use Vissim.scenario() to create one.
+        Input: base Vissim (or Scenario)
+    """
+    def __init__(self, base):
+        self.base = base
+        self.filename = base.filename
+        self.profiler = Profiler()
+        self.sections = Overlay(base.sections)
+        self.data = self.sections.data
+        self.params = Params(base=base.params)
+        self.Links = Links(self.data, self.params, self.sections)
+        self.PTStop = PTStop(self.data, self.params, self.sections)
+        self.Inputs = Inputs(self.data, self.params, self.sections)
+        self.StaticRouting = StaticRouting(self.data, self.params,
+                                           self.sections)
+        for name in ('Links', 'PTStop', 'Inputs', 'StaticRouting'):
+            getattr(self, name).base = getattr(base, name)
+        self.defaultWidth = base.defaultWidth
+
+
+# Networks being exported by exportMany, inherited by forked workers
+_exportJobs = {}
+
+
+def _exportJob(job):
+    filename, incremental = job
+    start = time.time()
+    _exportJobs[filename].export(filename, incremental)
+    return filename, time.time() - start
+
+
+def _writeJob(job):
+    filename, source, digest, pieces, elapsed = job
+    start = time.time()
+    with open(source, 'rb') as f:
+        raw = f.read()
+    if sha1(raw).hexdigest() != digest:
+        raise IOError('%s changed since the network was read' % (source))
+    with open(filename, 'wb') as f:
+        writePieces(f, raw, pieces)
+    return filename, elapsed + time.time() - start
+
+
+def exportMany(variants, processes=None, incremental=False, fork=None):
+    """ Export many networks at once across worker processes. Forked
+        workers are started after the networks are built, so they share
+        the base document and each scenario's copied elements with the
+        parent instead of receiving pickled trees. Without fork (e.g. on
+        Windows, where the calling script needs an
+        if __name__ == '__main__' guard) incremental exports are split up:
+        the parent serializes the changed sections and each worker gets the
+        source file name and those bytes only, copying the rest from the
+        source file, which must not have changed since it was read. Other
+        exports are written one file at a time then.
+        Input: dict of filename -> Vissim or Scenario, number of worker
+               processes (all cores by default), incremental flag, fork
+               flag (by default fork where the platform can)
+        Output: dict of filename -> export time in seconds
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(variants))
+    if fork is None:
+        fork = hasattr(os, 'fork')
+    if processes <= 1 or not fork and not incremental:
+        timing = {}
+        for filename, variant in variants.items():
+            start = time.time()
+            variant.export(filename, incremental)
+            timing[filename] = time.time() - start
+        return timing
+    if fork:
+        _exportJobs.update(variants)
+        jobs = [(filename, incremental) for filename in variants]
+        worker = _exportJob
+    else:
+        digests = {}
+        jobs = []
+        for filename, variant in variants.items():
+            start = time.time()
+            sections = variant.sections
+            if id(sections.raw) not in digests:
+                digests[id(sections.raw)] = sha1(sections.raw).hexdigest()
+            jobs.append((filename, sections.filename,
+                         digests[id(sections.raw)], sections.pieces(),
+                         time.time() - start))
+        worker = _writeJob
+    pool = multiprocessing.Pool(processes)
+    try:
+        timing = dict(pool.imap_unordered(worker, jobs))
+    finally:
+        pool.terminate()
+        pool.join()
+        for filename in variants:
+            _exportJobs.pop(filename, None)
+    for filename, variant in variants.items():
+        variant.filename = filename
+    return timing
@@ -4,6 +4,7 @@ import geojson
 
 class GeoJSON():
     def __init__(self, v):
+        v.loadSections('netPara', 'links')
         self.data = v.data
         self.refX, self.refY = self.getMapReference()
         self.startX, self.startY = self.getStartReference()